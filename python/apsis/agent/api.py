@@ -1,7 +1,5 @@
 import asyncio
-import brotli
 import functools
-import gzip
 import logging
 import os
 from   pathlib import Path
@@ -9,13 +7,18 @@ import sanic
 import socket
 import traceback
 import ujson
-import zlib
 
+from   apsis.lib.cmpr import (
+    BR_CHUNKED, COMPRESSIONS, choose_quality, compress_chunks, get_service)
+from   apsis.lib.parse import parse_range
 from   apsis.lib.sys import get_username, to_signal
 from   .processes import NoSuchProcessError
 
 log = logging.getLogger("api")
 
+# Size of chunks in which to stream output.
+OUTPUT_CHUNK_SIZE = 1024 * 1024
+
 #-------------------------------------------------------------------------------
 
 def response(jso, status=200):
@@ -73,6 +76,26 @@ def proc_to_jso(proc):
     }
 
 
+def _get_list_arg(req, name):
+    """
+    Returns values of a repeated or comma-separated query param, or none if
+    it's absent.
+    """
+    vals = req.args.getlist(name, None)
+    return None if vals is None else [
+        v for val in vals for v in val.split(",") if v != "" ]
+
+
+def _read_chunks(file, start, stop, size=OUTPUT_CHUNK_SIZE):
+    """
+    Generates chunks of data from `file` in `[start, stop)`.
+    """
+    file.seek(start)
+    while start < stop and len(chunk := file.read(min(size, stop - start))) > 0:
+        yield chunk
+        start += len(chunk)
+
+
 def build_env(inherit, vars, *, base=None):
     """
     :param inherit:
@@ -101,6 +124,10 @@ def build_env(inherit, vars, *, base=None):
 
 API = sanic.Blueprint("v1")
 
+# Default and maximum time in sec to hold a process wait request.
+WAIT_TIMEOUT = 20
+MAX_WAIT_TIMEOUT = 60
+
 def auth(handler):
     """
     Wraps a handler to authorize the operation.
@@ -139,10 +166,41 @@ async def process_running(req):
     return response({"running": True})
 
 
+@API.route("/load", methods={"GET"})
+@auth
+async def load_get(req):
+    """
+    Returns the host's load averages and number of CPUs, and the number of
+    processes running in this agent.
+    """
+    processes = req.app.ctx.processes
+    return response({"load": {
+        "loadavg"       : list(os.getloadavg()),
+        "num_cpus"      : os.cpu_count(),
+        "num_running"   : sum( p.state == "run" for p in processes ),
+    }})
+
+
 @API.route("/processes", methods={"GET"})
 @auth
 async def processes_get(req):
-    procs = req.app.ctx.processes
+    """
+    Returns processes.
+
+    The `proc_id` query param, repeated or comma-separated, limits results to
+    those processes; unknown proc IDs are omitted.  Likewise, `state` limits
+    results to processes in those states.
+    """
+    processes = req.app.ctx.processes
+    proc_ids = _get_list_arg(req, "proc_id")
+    if proc_ids is None:
+        procs = iter(processes)
+    else:
+        procs = ( processes.get(i) for i in proc_ids )
+        procs = ( p for p in procs if p is not None )
+    states = _get_list_arg(req, "state")
+    if states is not None:
+        procs = ( p for p in procs if p.state in states )
     return response({"processes": [ proc_to_jso(p) for p in procs ]})
 
 
@@ -169,6 +227,26 @@ async def processes_post(req):
     return response({"process": proc_to_jso(proc)}, 201)
 
 
+@API.route("/processes/wait", methods={"POST"})
+@auth
+async def processes_wait(req):
+    """
+    Waits for any of several processes to complete.
+
+    Returns as soon as any of the requested processes is not running, or after
+    a timeout, with the processes that are not running and the proc IDs that
+    are unknown.  Both are empty on timeout.
+    """
+    proc_ids = req.json["proc_ids"]
+    timeout = float(req.json.get("timeout", WAIT_TIMEOUT))
+    timeout = min(timeout, MAX_WAIT_TIMEOUT)
+    procs, missing = await req.app.ctx.processes.wait(proc_ids, timeout)
+    return response({
+        "processes" : [ proc_to_jso(p) for p in procs ],
+        "missing"   : missing,
+    })
+
+
 @API.route("/processes/<proc_id>", methods={"GET"})
 @auth
 async def process_get(req, proc_id):
@@ -179,34 +257,98 @@ async def process_get(req, proc_id):
 @API.route("/processes/<proc_id>/output", methods={"GET"})
 @auth
 async def process_get_output(req, proc_id):
+    """
+    Returns process output.
+
+    If `head` or `tail` is given and the output is longer than their sum,
+    returns only that many bytes from the start of the output followed by that
+    many bytes from the end.
+
+    Otherwise, streams the output, or the single byte range given by a `Range`
+    header.  The output is read, and compressed if requested, in chunks off the
+    event loop.
+
+    Alternately, `start` and `stop` give offsets of the output to stream; these
+    are clipped to the current output, so a client can tail a running process's
+    output by repeatedly requesting from the length it has already received.
+    The `X-Output-Start` header gives the offset of the first byte returned.
+    """
     try:
         compression, = req.args["compression"]
     except KeyError:
         compression = None
     else:
-        if compression not in {"br", "deflate", "gzip"}:
+        if compression not in COMPRESSIONS - {BR_CHUNKED}:
             return error(f"unknown compression: {compression!r}", 400)
+    try:
+        head = int(req.args.get("head", 0))
+        tail = int(req.args.get("tail", 0))
+        start = int(req.args.get("start", 0))
+        stop = req.args.get("stop", None)
+        stop = None if stop is None else int(stop)
+    except ValueError as exc:
+        return error(str(exc), 400)
 
     proc = req.app.ctx.processes[proc_id]
     with open(proc.proc_dir.out_path, "rb") as file:
-        data = file.read()
-
-    # Indicate the raw (uncompressed) length in a header.
-    headers = {"X-Raw-Length": str(len(data))}
-
-    match compression:
-        case None:
-            pass
-        case "br":
-            data = brotli.compress(data, mode=brotli.MODE_TEXT, quality=3)
-        case "deflate":
-            data = zlib.compress(data)
-        case "gzip":
-            data = gzip.compress(data, mtime=0, compresslevel=3)
-    if compression is not None:
-        headers |= {"X-Compression": compression}
-
-    return sanic.response.raw(data, status=200, headers=headers)
+        length = os.fstat(file.fileno()).st_size
+        # Indicate the raw (uncompressed) length in a header.
+        headers = {"X-Raw-Length": str(length)}
+        if compression is not None:
+            headers |= {"X-Compression": compression}
+
+        if 0 < head + tail < length:
+            # Read only the head and tail.
+            data = file.read(head)
+            if tail > 0:
+                file.seek(length - tail)
+                data += file.read(tail)
+            if compression is not None:
+                # Compress off the event loop.
+                data = await get_service().compress(data, compression)
+            return sanic.response.raw(data, status=200, headers=headers)
+
+        status = 200
+        start = min(max(start, 0), length)
+        stop = length if stop is None else min(max(stop, start), length)
+        try:
+            byte_range = parse_range(req.headers.get("Range"), length)
+        except ValueError as exc:
+            rsp = error(exc, 416)
+            rsp.headers["Content-Range"] = f"bytes */{length}"
+            return rsp
+        if byte_range is not None:
+            status = 206
+            start, stop = byte_range
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+        headers["X-Output-Start"] = str(start)
+
+        chunks = _read_chunks(file, start, stop)
+        if compression is None:
+            headers["Content-Length"] = str(stop - start)
+        else:
+            quality = choose_quality(compression, stop - start)
+            chunks = compress_chunks(chunks, compression, quality=quality)
+
+        # Construct the response explicitly; otherwise, sanic reuses the
+        # previous response on a keepalive connection.
+        rsp = await req.respond(sanic.response.HTTPResponse(
+            status=status, headers=headers,
+            content_type="application/octet-stream",
+        ))
+        loop = asyncio.get_running_loop()
+        while True:
+            # Read, and compress, off the event loop.
+            chunk = await (
+                loop.run_in_executor(None, next, chunks, None)
+                if compression is None
+                else get_service().run(next, chunks, None)
+            )
+            if chunk is None:
+                break
+            elif len(chunk) > 0:
+                await rsp.send(chunk)
+        await rsp.eof()
 
 
 @API.route("/processes/<proc_id>/signal/<signal>", methods={"PUT"})
@@ -287,3 +429,23 @@ def _schedule_auto_stop(app, delay):
     _auto_stop_task = asyncio.ensure_future(_stop())
 
 
+# Maximum interval in sec between checks for orphaned processes.
+COLLECT_INTERVAL = 60
+
+async def collect_processes(app, ttl):
+    """
+    Periodically deletes finished processes not accessed for `ttl` sec.
+
+    Schedules auto stop, if this leaves no processes.
+    """
+    processes = app.ctx.processes
+    while True:
+        await asyncio.sleep(min(ttl, COLLECT_INTERVAL))
+        if (
+                processes.collect(ttl) > 0
+                and len(processes) == 0
+                and app.config.auto_stop is not None
+        ):
+            _schedule_auto_stop(app, app.config.auto_stop)
+
+
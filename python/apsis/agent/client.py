@@ -19,13 +19,16 @@ import httpx
 import itertools
 import logging
 import os
+from   pathlib import Path
 import shlex
 import subprocess
 import sys
 import tempfile
+import time
 import ujson
 from   urllib.parse import quote_plus
 import warnings
+import weakref
 
 import apsis.lib.asyn
 from   apsis.lib.py import if_none
@@ -45,6 +48,15 @@ if HTTP_IMPL not in {"httpx", "aiohttp"}:
     warnings.warn(f"unknown APSIS_ASYNC_HTTP={HTTP_IMPL}; using httpx")
     HTTP_IMPL = "httpx"
 
+# HTTP/2 requires the h2 package, and an agent that supports it.
+HTTP2 = os.environ.get("APSIS_AGENT_HTTP2", "0") not in {"", "0"}
+if HTTP2:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        warnings.warn("APSIS_AGENT_HTTP2 requires h2; using HTTP/1.1")
+        HTTP2 = False
+
 #-------------------------------------------------------------------------------
 
 class NoAgentError(RuntimeError):
@@ -136,6 +148,19 @@ async def _load_data(rsp):
             return await rsp.read()
 
 
+async def _iter_data(rsp, chunk_size):
+    """
+    Generates chunks of response data.
+    """
+    match HTTP_IMPL:
+        case "httpx":
+            async for chunk in rsp.aiter_bytes(chunk_size):
+                yield chunk
+        case "aiohttp":
+            async for chunk in rsp.content.iter_chunked(chunk_size):
+                yield chunk
+
+
 async def _get_jso(rsp):
     match HTTP_IMPL:
         case "httpx":
@@ -196,6 +221,203 @@ def get_http_client():
     return _get_http_client(asyncio.get_event_loop())
 
 
+#-------------------------------------------------------------------------------
+
+class ConnectionPool:
+    """
+    Persistent HTTP connections to a single agent.
+
+    Connections are kept alive between requests, and reused.  Before reusing
+    an idle connection, httpcore checks whether the agent has closed it; a
+    connection may still be closed while a request is being sent on it, in
+    which case an idempotent request is retried once on a new connection.
+
+    A connection that fails is dropped by httpcore, without affecting other
+    connections.  To stop using all connections, `reset()` swaps in a new
+    client, and closes the old one once its requests are finished.
+    """
+
+    TIMEOUT = 30
+
+    # Time in sec to keep an idle connection open.  This is shorter than the
+    # agent's keepalive timeout, so that usually we close connections first.
+    KEEPALIVE_EXPIRY = 30
+
+    MAX_CONNECTIONS = 32
+
+    # Exceptions that indicate the agent closed a reused connection.
+    STALE_ERRORS = (
+        httpx.RemoteProtocolError, httpx.ReadError, httpx.WriteError)
+
+    def __init__(self, name):
+        self.__name = name
+        self.__loop = None
+        self.__client = None
+        # Number of requests in flight and responses not yet released, by
+        # client, including replaced clients that are still in use.
+        self.__active = {}
+        # Client of each response not yet released.
+        self.__responses = {}
+        _POOLS.add(self)
+
+
+    def __get_client(self):
+        loop = asyncio.get_running_loop()
+        if self.__loop is not loop:
+            # Connections belong to an event loop.
+            self.__client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.TIMEOUT),
+                # See _get_http_client() about server verification.
+                verify=False,
+                http2=HTTP2,
+                limits=httpx.Limits(
+                    max_connections=self.MAX_CONNECTIONS,
+                    max_keepalive_connections=self.MAX_CONNECTIONS,
+                    keepalive_expiry=self.KEEPALIVE_EXPIRY,
+                ),
+            )
+            self.__loop = loop
+            self.__active = {self.__client: 0}
+            self.__responses = {}
+            with contextlib.suppress(AttributeError):
+                loop.on_close(self.__client.aclose())
+        return self.__client
+
+
+    async def __finish(self, client):
+        """
+        Notes that a request on `client` is finished, and closes the client if
+        it has been replaced and this was its last request.
+        """
+        if client not in self.__active:
+            # Already closed.
+            return
+        count = self.__active[client] = self.__active[client] - 1
+        if count == 0 and client is not self.__client:
+            del self.__active[client]
+            await client.aclose()
+
+
+    async def reset(self):
+        """
+        Stops using the pooled connections.
+
+        Subsequent requests use new connections.  Requests in flight on the
+        old connections, including streamed responses, are allowed to finish
+        before these are closed.
+        """
+        client, self.__client, self.__loop = self.__client, None, None
+        if client is not None and self.__active.get(client, 0) == 0:
+            self.__active.pop(client, None)
+            await client.aclose()
+
+
+    async def close(self):
+        """
+        Closes all pooled connections, including those in use.
+        """
+        client, self.__client, self.__loop = self.__client, None, None
+        if client is not None:
+            self.__active.pop(client, None)
+            await client.aclose()
+
+
+    async def request(
+            self, method, url, *, retry=False, stream=False, **kw_args):
+        """
+        Sends a request on a pooled connection.
+
+        :param retry:
+          If true, the request is idempotent, and is retried on a new
+          connection if the reused connection turns out to be stale.
+        :param stream:
+          If true, doesn't read the response body.
+        :return:
+          The response, which the caller must pass to `release()`.
+        """
+        client = self.__get_client()
+        self.__active[client] += 1
+        try:
+            rsp = await self.__send(client, method, url, retry, stream, kw_args)
+        except BaseException:
+            await self.__finish(client)
+            raise
+        self.__responses[rsp] = client
+        return rsp
+
+
+    async def release(self, rsp):
+        """
+        Closes a response returned by `request()`.
+        """
+        try:
+            await rsp.aclose()
+        finally:
+            if (client := self.__responses.pop(rsp, None)) is not None:
+                await self.__finish(client)
+
+
+    async def __send(self, client, method, url, retry, stream, kw_args):
+        while True:
+            connected = False
+
+            async def trace(event, info):
+                nonlocal connected
+                match event:
+                    case "connection.connect_tcp.complete":
+                        connected = True
+                        _STATS["num_connects"] += 1
+                    case "connection.start_tls.complete":
+                        _STATS["num_handshakes"] += 1
+
+            _STATS["num_requests"] += 1
+            try:
+                request = client.build_request(
+                    method, url, extensions={"trace": trace}, **kw_args)
+                rsp = await client.send(request, stream=stream)
+            except self.STALE_ERRORS as exc:
+                if retry and not connected:
+                    # The agent closed the connection we reused.
+                    log.info(f"{self.__name}: stale connection: {exc}")
+                    _STATS["num_stale"] += 1
+                    retry = False
+                    continue
+                else:
+                    raise
+
+            if not connected:
+                _STATS["num_reused"] += 1
+            return rsp
+
+
+
+_POOLS = weakref.WeakSet()
+
+_STATS = {
+    "num_requests"      : 0,
+    "num_reused"        : 0,
+    "num_connects"      : 0,
+    "num_handshakes"    : 0,
+    "num_stale"         : 0,
+    "num_discoveries"   : 0,
+    "num_discovery_errors": 0,
+    "num_discovery_shared": 0,
+    "num_health_checks" : 0,
+}
+
+def get_stats():
+    """
+    Returns connection stats for all agents.
+    """
+    num_requests = _STATS["num_requests"]
+    return _STATS | {
+        "num_agents"        : len(_POOLS),
+        "reuse_rate"        : (
+            _STATS["num_reused"] / num_requests if num_requests > 0 else None),
+        "http2"             : HTTP2,
+    }
+
+
 #-------------------------------------------------------------------------------
 
 # FIXME-CONFIG: Configure how we become other users and log in to other hosts.
@@ -209,6 +431,28 @@ SSH_OPTIONS = dict(
     StrictHostKeyChecking   ="no",  # FIXME-CONFIG
 )
 
+# If set, time in sec to keep a multiplexed SSH master connection to each agent
+# host open, so that later agent starts reuse it rather than each making a new
+# SSH connection.
+SSH_CONTROL_PERSIST = os.environ.get("APSIS_AGENT_SSH_CONTROL_PERSIST", "")
+
+def _get_ssh_options():
+    """
+    Returns SSH options for starting agents.
+    """
+    if SSH_CONTROL_PERSIST in {"", "0"}:
+        return SSH_OPTIONS
+    else:
+        # Keep control sockets in a private dir.
+        path = Path(tempfile.gettempdir()) / f"apsis-ssh-{os.getuid()}"
+        path.mkdir(mode=0o700, exist_ok=True)
+        return SSH_OPTIONS | dict(
+            ControlMaster           ="auto",
+            ControlPath             =str(path / "%C"),
+            ControlPersist          =SSH_CONTROL_PERSIST,
+        )
+
+
 def _get_agent_argv(*, host=None, user=None, connect=None, state_dir=None):
     """
     Returns the argument vector to start the agent on `host` as `user`.
@@ -236,7 +480,7 @@ def _get_agent_argv(*, host=None, user=None, connect=None, state_dir=None):
             "/usr/bin/ssh",
             *itertools.chain.from_iterable(
                 ["-o", f"{k}={v}"]
-                for k, v in SSH_OPTIONS.items()
+                for k, v in _get_ssh_options().items()
             )
         ]
         if user is not None:
@@ -307,6 +551,160 @@ async def start_agent(
         raise AgentStartError(proc.returncode, err.decode())
 
 
+#-------------------------------------------------------------------------------
+
+class AgentSupervisor:
+    """
+    Discovers and caches the port and token of the agent for one host, user,
+    and state dir.
+
+    Discovery, which may start the agent over SSH, is single-flight: concurrent
+    callers share one discovery in flight, and its result or error.  After
+    discovery fails, callers fail immediately for `FAILURE_TTL`, rather than
+    each attempting another SSH connection.
+
+    A cached port and token is trusted for `TTL` after it was last used
+    successfully.  After that, the agent is health-checked before it is used.
+    """
+
+    # Time in sec to trust a port and token without a health check.
+    TTL = 60
+
+    # Time in sec after a failed discovery to fail without retrying.
+    FAILURE_TTL = 5
+
+    def __init__(self, host, user, connect, state_dir):
+        self.__host         = host
+        self.__user         = user
+        self.__connect      = connect
+        self.__state_dir    = state_dir
+
+        # The port and token, and monotonic time it was last verified.
+        self.__conn         = None
+        self.__conn_time    = None
+        # Discovery in flight.
+        self.__discovery    = None
+        # Monotonic time and exception of the last failed discovery.
+        self.__error        = None
+
+
+    def __str__(self):
+        return _get_agent_name(self.__user, self.__host, None)
+
+
+    @property
+    def conn(self):
+        """
+        The cached port and token, or none.
+        """
+        return self.__conn
+
+
+    async def __discover(self, check):
+        conn = self.__conn
+        if conn is not None:
+            # Check that the cached agent is still there.
+            _STATS["num_health_checks"] += 1
+            if await check(*conn):
+                self.__conn_time = time.monotonic()
+                return conn
+            log.info(f"{self}: health check failed")
+            self.__conn = None
+
+        log.debug(f"{self}: starting")
+        _STATS["num_discoveries"] += 1
+        try:
+            conn = await start_agent(
+                host        =self.__host,
+                user        =self.__user,
+                connect     =self.__connect,
+                state_dir   =self.__state_dir,
+            )
+        except Exception as exc:
+            _STATS["num_discovery_errors"] += 1
+            self.__error = time.monotonic(), exc
+            raise
+        log.debug(f"{self}: started")
+
+        self.__error = None
+        self.__conn = conn
+        self.__conn_time = time.monotonic()
+        return conn
+
+
+    async def get(self, check):
+        """
+        Returns the agent port and token, discovering the agent if necessary.
+
+        :param check:
+          Async function that takes the port and token, and returns true if the
+          agent is running.
+        :raise AgentStartError:
+          Discovery failed, possibly recently.
+        """
+        if (
+                self.__conn is not None
+                and time.monotonic() - self.__conn_time < self.TTL
+        ):
+            return self.__conn
+
+        loop = asyncio.get_running_loop()
+        discovery = self.__discovery
+        if discovery is not None and discovery.get_loop() is loop:
+            # Share the discovery in flight.
+            _STATS["num_discovery_shared"] += 1
+
+        else:
+            if (
+                    self.__error is not None
+                    and time.monotonic() - self.__error[0] < self.FAILURE_TTL
+            ):
+                raise self.__error[1]
+
+            discovery = self.__discovery = asyncio.ensure_future(
+                self.__discover(check))
+
+            def done(future):
+                if self.__discovery is future:
+                    self.__discovery = None
+                # Retrieve any exception, even if all callers were canceled.
+                if not future.cancelled():
+                    future.exception()
+
+            discovery.add_done_callback(done)
+
+        # Don't cancel the discovery if this caller is canceled.
+        return await asyncio.shield(discovery)
+
+
+    def verified(self, port, token):
+        """
+        Notes that the agent at `port` with `token` just responded.
+        """
+        if self.__conn == (port, token):
+            self.__conn_time = time.monotonic()
+
+
+    def invalidate(self, port, token) -> bool:
+        """
+        Forgets the agent at `port` with `token`, if it's the cached one.
+
+        :return:
+          True if it was the cached agent.
+        """
+        if self.__conn == (port, token):
+            self.__conn = None
+            return True
+        else:
+            return False
+
+
+
+@functools.cache
+def _get_supervisor(host, user, connect, state_dir):
+    return AgentSupervisor(host, user, connect, state_dir)
+
+
 #-------------------------------------------------------------------------------
 
 class Agent:
@@ -315,6 +713,15 @@ class Agent:
     # attempts is the number of delays.
     START_DELAYS = [ 0.5 * i**2 for i in range(6) ]
 
+    # Time in sec the agent holds a process wait request open.
+    WAIT_TIMEOUT = 20
+
+    # Interval in sec between polls, for agents that don't support waiting.
+    POLL_INTERVAL = 1
+
+    # Max number of processes to request in one poll.
+    POLL_BATCH_SIZE = 100
+
     def __init__(self, host=None, user=None, *, connect=None, state_dir=DEFAULT):
         """
         :param host:
@@ -333,11 +740,19 @@ class Agent:
 
         self.__host         = host
         self.__user         = user
-        self.__connect      = connect
-        self.__state_dir    = state_dir
 
-        self.__lock         = asyncio.Lock()
+        # Shared by all clients of the same agent.
+        self.__supervisor   = _get_supervisor(host, user, connect, state_dir)
         self.__conn         = None
+        self.__pool         = ConnectionPool(_get_agent_name(user, host, None))
+
+        # Futures waiting for process completion, by proc ID.
+        self.__waiters      = {}
+        # Set when a new proc ID is added to the waiters.
+        self.__waiters_changed = None
+        self.__wait_task    = None
+        # False if the agent doesn't support waiting, and we poll instead.
+        self.__can_wait     = True
 
 
     def __str__(self):
@@ -345,6 +760,35 @@ class Agent:
         return _get_agent_name(self.__user, self.__host, port)
 
 
+    def __get_url(self, port, endpoint, args={}):
+        url_host = if_none(self.__host, "localhost")
+        # FIXME: Use library.
+        url = f"https://{url_host}:{port}/api/v1" + endpoint
+        if len(args) > 0:
+            url += "?" + "&".join(
+                f"{k}={quote_plus(v)}" for k, v in args.items()
+            )
+        return url
+
+
+    async def __check(self, port, token):
+        """
+        Returns true if the agent at `port` is running and accepts `token`.
+        """
+        if HTTP_IMPL != "httpx":
+            # Rely on requests failing instead.
+            return True
+        try:
+            rsp = await self.__pool.request(
+                "GET", self.__get_url(port, "/running"),
+                retry=True, headers={"X-Auth-Token": token},
+            )
+        except httpx.RequestError:
+            return False
+        await self.__pool.release(rsp)
+        return rsp.status_code == 200
+
+
     async def connect(self):
         """
         Attempts to start or connect to the agent.
@@ -352,30 +796,34 @@ class Agent:
         :return:
           The agent port and token.
         """
-        async with self.__lock:
-            if self.__conn is None:
-                log.debug(f"{self}: starting")
-                port, token = await start_agent(
-                    host        =self.__host,
-                    user        =self.__user,
-                    connect     =self.__connect,
-                    state_dir   =self.__state_dir,
-                )
-                log.debug(f"{self}: started")
+        conn = self.__conn
+        if conn is None or conn == self.__supervisor.conn:
+            # Use the shared agent, which the supervisor health-checks.
+            conn = self.__conn = await self.__supervisor.get(self.__check)
+        # Otherwise, keep using our agent until it fails.
+        return conn
 
-                self.__conn = port, token
 
-            return self.__conn
+    async def disconnect(self, port, token, *, reset=False):
+        """
+        Stops using the agent at `port` with `token`, after a request to it
+        failed.
 
+        Other requests in flight to the agent are unaffected.  A connection
+        that failed is already dropped from the pool.
 
-    async def disconnect(self, port, token):
-        log.debug(f"{self}: waiting to disconnect")
-        async with self.__lock:
-            if self.__conn == (port, token):
-                log.debug(f"{self}: disconnecting")
-                self.__conn = None
-            else:
-                log.debug(f"{self}: conn changed; not disconnecting")
+        :param reset:
+          If true, also stops using the pooled connections, once their
+          requests in flight are finished.
+        """
+        self.__supervisor.invalidate(port, token)
+        if self.__conn == (port, token):
+            log.debug(f"{self}: disconnecting")
+            self.__conn = None
+            if reset:
+                await self.__pool.reset()
+        else:
+            log.debug(f"{self}: conn changed; not disconnecting")
 
 
     @contextlib.asynccontextmanager
@@ -384,7 +832,10 @@ class Agent:
             data=None,
             *,
             args={},
+            headers={},
             restart=False,
+            idempotent=False,
+            stream=False,
             client=None,
     ):
         """
@@ -397,9 +848,18 @@ class Agent:
           API endpoint path fragment.
         :param data:
           Payload data, to send as JSON.
+        :param headers:
+          Additional request headers.
         :param restart:
           If true, the client will attempt to start an agent automatically
           if the agent conenction fails.
+        :param idempotent:
+          If true, the request may be retried if the connection is stale.  GET
+          requests are always considered idempotent.
+        :param stream:
+          If true, the response body is not read, and may be streamed.
+        :param client:
+          HTTP client to use, instead of this agent's pooled connections.
         :raise RequestError:
           The request returned 4xx.
         :raise InternalServiceError:
@@ -408,34 +868,39 @@ class Agent:
         # Delays in sec before each attempt to connect.
         delays = self.START_DELAYS if restart else [0]
 
-        if client is None:
+        if client is None and HTTP_IMPL == "aiohttp":
             client = get_http_client()
+        idempotent = idempotent or method == "GET"
 
         for delay in delays:
             if delay > 0:
                 await asyncio.sleep(delay)
 
             port, token = await self.connect()
-            url_host = if_none(self.__host, "localhost")
-            # FIXME: Use library.
-            url = f"https://{url_host}:{port}/api/v1" + endpoint
-            if len(args) > 0:
-                url += "?" + "&".join(
-                    f"{k}={quote_plus(v)}" for k, v in args.items() 
-                )
+            url = self.__get_url(port, endpoint, args)
 
             try:
                 match HTTP_IMPL:
                     case "httpx":
-                        rsp = await client.request(
-                            method, url,
+                        kw_args = dict(
                             headers={
                                 # The auth header, so the agent accepts us.
                                 "X-Auth-Token": token,
                                 "Content-Type": "application/json",
+                                **headers,
                             },
                             content=ujson.dumps(data),
                         )
+                        if client is None:
+                            rsp = await self.__pool.request(
+                                method, url, retry=idempotent, stream=stream,
+                                **kw_args
+                            )
+                        else:
+                            rsp = await client.send(
+                                client.build_request(method, url, **kw_args),
+                                stream=stream,
+                            )
                         status = rsp.status_code
 
                     case "aiohttp":
@@ -446,6 +911,7 @@ class Agent:
                                 # The auth header, so the agent accepts us.
                                 "X-Auth-Token": token,
                                 "Content-Type": "application/json",
+                                **headers,
                             },
                             data=ujson.dumps(data),
                         )
@@ -458,11 +924,12 @@ class Agent:
                         # Forbidden.  A different agent is running on that port.  We
                         # should start our own.
                         log.debug(f"{self}: wrong agent")
-                        await self.disconnect(port, token)
+                        await self.disconnect(port, token, reset=True)
                         continue
 
                     elif 200 <= status < 300:
                         # Request submitted successfully.
+                        self.__supervisor.verified(port, token)
                         yield rsp
                         return
 
@@ -484,7 +951,7 @@ class Agent:
                 finally:
                     match HTTP_IMPL:
                         case "httpx":
-                            await rsp.aclose()
+                            await self.__pool.release(rsp)
                         case "aiohttp":
                             pass
                             # await rsp.release()
@@ -526,9 +993,43 @@ class Agent:
             return True
 
 
-    async def get_processes(self):
-        async with self.__request("GET", "/processes") as rsp:
-            return (await _get_jso(rsp))["processes"]
+    async def get_load(self):
+        """
+        Returns the load on the agent's host.
+
+        :return:
+          A JSO with `loadavg`, the 1, 5, and 15 min load averages; `num_cpus`;
+          and `num_running`, the number of processes this agent is running.
+        """
+        async with self.__request("GET", "/load", restart=True) as rsp:
+            return (await _get_jso(rsp))["load"]
+
+
+    async def get_processes(self, *, proc_ids=None, state=None, restart=False):
+        """
+        Returns processes.
+
+        :param proc_ids:
+          If not none, returns only these processes, if the agent knows them.
+        :param state:
+          If not none, returns only processes in this state.
+        """
+        args = (
+              ({} if proc_ids is None else {"proc_id": ",".join(proc_ids)})
+            | ({} if state is None else {"state": state})
+        )
+        async with self.__request(
+                "GET", "/processes", args=args, restart=restart
+        ) as rsp:
+            procs = (await _get_jso(rsp))["processes"]
+
+        # Older agents ignore the query; filter here too.
+        if proc_ids is not None:
+            proc_ids = set(proc_ids)
+            procs = [ p for p in procs if p["proc_id"] in proc_ids ]
+        if state is not None:
+            procs = [ p for p in procs if p["state"] == state ]
+        return procs
 
 
     async def start_process(
@@ -568,16 +1069,149 @@ class Agent:
             raise NoSuchProcessError(proc_id)
 
 
-    async def get_process_output(self, proc_id, *, compression=None, client=None):
+    async def __wait_any(self, proc_ids):
+        """
+        Waits for any of `proc_ids` to complete.
+
+        :return:
+          Completed processes, and proc IDs unknown to the agent.
+        """
+        if self.__can_wait:
+            data = {"proc_ids": proc_ids, "timeout": self.WAIT_TIMEOUT}
+            try:
+                async with self.__request(
+                        "POST", "/processes/wait", data=data, restart=True,
+                        idempotent=True,
+                ) as rsp:
+                    jso = await _get_jso(rsp)
+                return jso["processes"], jso["missing"]
+
+            except (
+                    RequestError, InternalServiceError, RequestJsonError
+            ) as exc:
+                # Probably an older agent without this endpoint.
+                log.warning(f"{self}: can't wait for processes; polling: {exc}")
+                self.__can_wait = False
+
+        # Poll all the processes, in batches.
+        await asyncio.sleep(self.POLL_INTERVAL)
+        procs = []
+        for i in range(0, len(proc_ids), self.POLL_BATCH_SIZE):
+            procs.extend(await self.get_processes(
+                proc_ids=proc_ids[i : i + self.POLL_BATCH_SIZE],
+                restart=True,
+            ))
+        found = { p["proc_id"] for p in procs }
+        return (
+            [ p for p in procs if p["state"] != "run" ],
+            [ i for i in proc_ids if i not in found ],
+        )
+
+
+    async def __wait_loop(self):
+        """
+        Waits for completion of all processes with waiters, with one request
+        at a time to the agent.
+        """
+        try:
+            while len(self.__waiters) > 0:
+                self.__waiters_changed.clear()
+                proc_ids = list(self.__waiters)
+                wait = asyncio.ensure_future(self.__wait_any(proc_ids))
+                changed = asyncio.ensure_future(self.__waiters_changed.wait())
+                try:
+                    await asyncio.wait(
+                        {wait, changed}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    changed.cancel()
+                if not wait.done():
+                    # More processes to wait for; reissue the request.
+                    wait.cancel()
+                    continue
+
+                try:
+                    procs, missing = wait.result()
+                except Exception as exc:
+                    # Fail all waiters.
+                    waiters, self.__waiters = self.__waiters, {}
+                    for futures in waiters.values():
+                        for future in futures:
+                            if not future.done():
+                                future.set_exception(exc)
+                    break
+
+                results = (
+                      [ (p["proc_id"], p, None) for p in procs ]
+                    + [ (i, None, NoSuchProcessError(i)) for i in missing ]
+                )
+                for proc_id, proc, exc in results:
+                    for future in self.__waiters.pop(proc_id, []):
+                        if future.done():
+                            pass
+                        elif exc is None:
+                            future.set_result(proc)
+                        else:
+                            future.set_exception(exc)
+
+        finally:
+            self.__wait_task = None
+
+
+    async def wait_process(self, proc_id):
+        """
+        Waits for a process to complete.
+
+        Waits for all processes on this agent are multiplexed into a single
+        long-poll request to the agent, which returns when any completes.
+
+        :return:
+          The completed process.
+        :raise NoSuchProcessError:
+          The agent doesn't know the process.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.__wait_task is None:
+            self.__waiters_changed = asyncio.Event()
+            self.__wait_task = asyncio.ensure_future(self.__wait_loop())
+        elif proc_id not in self.__waiters:
+            # Reissue the current wait request to include this process.
+            self.__waiters_changed.set()
+        self.__waiters.setdefault(proc_id, []).append(future)
+
+        try:
+            return await future
+        finally:
+            # Remove the waiter, if it's still there.
+            futures = self.__waiters.get(proc_id, [])
+            if future in futures:
+                futures.remove(future)
+                if len(futures) == 0:
+                    del self.__waiters[proc_id]
+
+
+    async def get_process_output(
+            self, proc_id, *, compression=None, head=None, tail=None,
+            client=None
+    ):
         """
         Returns process output.
 
+        :param head:
+          If not none, with `tail`, the number of bytes to return from the
+          start of the output, if the output is longer than `head + tail`.
+        :param tail:
+          Likewise, the number of bytes to return from the end.
         :return:
-          The output, its uncompressed length, and the actual compression
-          format.
+          The output, its total uncompressed length, and the actual compression
+          format.  The returned output is shorter than the length if only the
+          head and tail were returned.
         """
         path = f"/processes/{proc_id}/output"
-        args = {} if compression is None else {"compression": compression}
+        args = (
+              ({} if compression is None else {"compression": compression})
+            | ({} if head is None else {"head": head})
+            | ({} if tail is None else {"tail": tail})
+        )
         try:
             async with self.__request("GET", path, args=args, client=client) as rsp:
                 length = int(rsp.headers["X-Raw-Length"])
@@ -589,6 +1223,48 @@ class Agent:
             raise NoSuchProcessError(proc_id)
 
 
+    async def iter_process_output(
+            self, proc_id, *, start=0, stop=None, chunk_size=1024 * 1024):
+        """
+        Streams uncompressed process output.
+
+        The process may still be running, in which case this returns the
+        output it has produced so far.
+
+        :param start:
+          Offset of the first byte to return.
+        :param stop:
+          Offset past the last byte to return, or none for the end.
+        :return:
+          Async iterator of chunks of output data.
+        """
+        if stop is not None and stop <= start:
+            return
+        path = f"/processes/{proc_id}/output"
+        args = (
+            ({} if start == 0 else {"start": str(start)})
+            | ({} if stop is None else {"stop": str(stop)})
+        )
+        try:
+            async with self.__request(
+                    "GET", path, args=args, stream=True) as rsp:
+                # An agent that doesn't support offsets sends all the output.
+                pos = int(rsp.headers.get("X-Output-Start", 0))
+                async for chunk in _iter_data(rsp, chunk_size):
+                    data = chunk[
+                        max(start - pos, 0)
+                        : None if stop is None else max(stop - pos, 0)
+                    ]
+                    pos += len(chunk)
+                    if len(data) > 0:
+                        yield data
+                    if stop is not None and pos >= stop:
+                        break
+
+        except NotFoundError:
+            raise NoSuchProcessError(proc_id)
+
+
     async def del_process(self, proc_id, *, client=None):
         """
         Deltes a process.  The process may not be running.
@@ -620,9 +1296,30 @@ class Agent:
         Shuts down an agent, if there are no remaining processes.
         """
         async with self.__request("POST", "/stop") as rsp:
-            return (await _get_jso(rsp))["stop"]
+            stop = (await _get_jso(rsp))["stop"]
+        if stop:
+            # Don't reuse connections to the stopping agent, nor let other
+            # clients discover it.
+            if self.__conn is not None:
+                self.__supervisor.invalidate(*self.__conn)
+            await self.__pool.reset()
+        return stop
+
 
 
+@functools.cache
+def _get_agent(host, user):
+    return Agent(host=host, user=user)
+
+
+def get_agent(host=None, user=None):
+    """
+    Returns the agent client for `host` and `user`, shared by all callers, so
+    that they share its connections.
+    """
+    # Normalize args, so they match the cache key.
+    return _get_agent(host, user)
+
 
 @functools.cache
 def get_test_state_dir():
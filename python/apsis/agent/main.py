@@ -15,7 +15,7 @@ import sys
 from   . import SSL_CERT, SSL_KEY
 from   ..lib.daemon import daemonize
 from   ..lib.pidfile import PidFile
-from   .api import API
+from   .api import API, collect_processes
 from   .base import get_default_state_dir
 from   .processes import Processes
 
@@ -145,6 +145,9 @@ def main():
     parser.add_argument(
         "--stop-time", metavar="SECS", default=300,
         help="wait SECS after last process before stopping [def: 300]")
+    parser.add_argument(
+        "--process-ttl", metavar="SECS", type=float, default=86400,
+        help="delete finished processes not accessed for SECS [def: 86400]")
     args = parser.parse_args()
 
     if args.log_level is not None:
@@ -198,7 +201,12 @@ def main():
         app.ctx.token = token
 
         app.ctx.processes = Processes(state_dir)
-        signal.signal(signal.SIGCHLD, app.ctx.processes.sigchld)
+        if app.ctx.processes.use_pidfd:
+            logging.info("watching processes with pidfds")
+        else:
+            signal.signal(signal.SIGCHLD, app.ctx.processes.sigchld)
+        if args.process_ttl > 0:
+            app.add_task(collect_processes(app, args.process_ttl))
 
         def remove_pid_file():
             pid_file.unlock()
@@ -12,6 +12,7 @@ import shlex
 import signal
 from   subprocess import SubprocessError
 import tempfile
+import time
 import uuid
 
 log = logging.getLogger("processes")
@@ -38,6 +39,34 @@ def now():
     return datetime.datetime.now(datetime.timezone.utc).isoformat()
 
 
+def pidfd_open(pid):
+    """
+    Returns a pidfd for child `pid`, or none if pidfds aren't supported.
+    """
+    try:
+        return os.pidfd_open(pid)
+    except AttributeError:
+        # Python not built with pidfd_open; not Linux.
+        return None
+    except OSError as exc:
+        if exc.errno == errno.ENOSYS:
+            # Kernel older than 5.3.
+            return None
+        raise
+
+
+def _check_pidfd():
+    """
+    Returns true if pidfds are supported.
+    """
+    fd = pidfd_open(os.getpid())
+    if fd is None:
+        return False
+    else:
+        os.close(fd)
+        return True
+
+
 def start(argv, cwd, env, stdin_fd, out_fd):
     """
     Starts a program in a subprocess.
@@ -249,6 +278,8 @@ class Processes:
             self.rusage     = None
             self.start_time = None
             self.end_time   = None
+            # Monotonic time the process finished or was last accessed.
+            self.access_time = time.monotonic()
 
 
         @property
@@ -278,6 +309,54 @@ class Processes:
         self.__dir_path = dir_path
         self.__procs = {}
         self.__pids = {}
+        # Set and replaced whenever a process changes state.
+        self.__changed = asyncio.Event()
+        # If true, we watch each child with a pidfd.  Otherwise, the caller
+        # must install `sigchld` as the SIGCHLD handler.
+        self.use_pidfd = _check_pidfd()
+
+
+    def __notify(self):
+        """
+        Wakes up waiters, as a process has changed state.
+        """
+        self.__changed.set()
+        self.__changed = asyncio.Event()
+
+
+    def __watch(self, proc):
+        """
+        Watches `proc` with a pidfd, and reaps it when it completes.
+        """
+        pidfd = pidfd_open(proc.pid)
+        loop = asyncio.get_running_loop()
+
+        def on_exit():
+            # The pidfd is readable once the process has terminated.  Until we
+            # reap it, the pid can't be reused, so reaping it by pid is exact.
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid == 0:
+                # Not terminated after all.
+                return
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+            log.info(f"reaped child: pid={pid} status={status}")
+            del self.__pids[pid]
+            self.__done(proc, status, rusage)
+
+        loop.add_reader(pidfd, on_exit)
+
+
+    def __done(self, proc, status, rusage):
+        if proc.state != "run":
+            log.error(f"reaped child in state {proc.state}")
+
+        proc.state = "done"
+        proc.end_time = now()
+        proc.access_time = time.monotonic()
+        proc.status = status
+        proc.rusage = rusage
+        self.__notify()
 
 
     def start(self, argv, cwd, env, stdin):
@@ -313,8 +392,11 @@ class Processes:
             log.info(f"started: pid={proc.pid}")
 
             proc.state = "run"
-            # FIXME: SIGCHLD may be handled asynchronously before we get here.
             self.__pids[proc.pid] = proc
+            if self.use_pidfd:
+                self.__watch(proc)
+            # Otherwise, SIGCHLD reaping is scheduled on the event loop, so
+            # can't run before we get here.
 
         except Exception as exc:
             log.info(f"start error: {exc}")
@@ -337,6 +419,8 @@ class Processes:
         """
         Reaps one completed child process, if available.
 
+        Used only if pidfds are not supported.
+
         :return:
           True if a process was reaped.
         """
@@ -360,13 +444,7 @@ class Processes:
             log.error(f"reaped unknown child pid {pid}")
             return True
 
-        if proc.state != "run":
-            log.error(f"reaped child in state {proc.state}")
-
-        proc.state = "done"
-        proc.end_time = now()
-        proc.status = status
-        proc.rusage = rusage
+        self.__done(proc, status, rusage)
         return True
 
 
@@ -374,7 +452,8 @@ class Processes:
         """
         SIGCHLD handler.
 
-        Called to indicate a child process has terminated.
+        Called to indicate a child process has terminated.  Used only if pidfds
+        are not supported.
         """
         assert signum == signal.SIGCHLD
 
@@ -392,15 +471,60 @@ class Processes:
         asyncio.get_event_loop().call_soon(reap_all)
 
 
+    async def wait(self, proc_ids, timeout):
+        """
+        Waits until any of `proc_ids` is no longer running.
+
+        :param timeout:
+          Maximum time in sec to wait.
+        :return:
+          The processes that are not running, and the proc IDs that are not
+          known.  Both are empty if the timeout expired.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            procs = []
+            missing = []
+            for proc_id in proc_ids:
+                try:
+                    proc = self.__procs[proc_id]
+                except KeyError:
+                    missing.append(proc_id)
+                else:
+                    if proc.state != "run":
+                        proc.access_time = time.monotonic()
+                        procs.append(proc)
+            if len(procs) > 0 or len(missing) > 0:
+                return procs, missing
+
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return [], []
+            try:
+                await asyncio.wait_for(self.__changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return [], []
+
+
     def __len__(self):
         return len(self.__procs)
 
 
     def __getitem__(self, proc_id):
         try:
-            return self.__procs[proc_id]
+            proc = self.__procs[proc_id]
         except KeyError:
             raise NoSuchProcessError(proc_id)
+        proc.access_time = time.monotonic()
+        return proc
+
+
+    def get(self, proc_id, default=None):
+        try:
+            return self[proc_id]
+        except NoSuchProcessError:
+            return default
 
 
     def __delitem__(self, proc_id):
@@ -423,6 +547,28 @@ class Processes:
         return iter(self.__procs.values())
 
 
+    def collect(self, ttl):
+        """
+        Deletes finished processes not accessed for `ttl` sec.
+
+        A client normally deletes a process once it has retrieved the results.
+        This cleans up processes whose client never does, and their process
+        dirs.
+
+        :return:
+          The number of processes deleted.
+        """
+        cutoff = time.monotonic() - ttl
+        proc_ids = [
+            p.proc_id for p in self.__procs.values()
+            if p.state != "run" and p.access_time < cutoff
+        ]
+        for proc_id in proc_ids:
+            log.warning(f"deleting orphaned process: {proc_id}")
+            del self[proc_id]
+        return len(proc_ids)
+
+
     def kill(self, proc_id, signum):
         """
         Sends signal `signum` to the process.
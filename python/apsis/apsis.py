@@ -11,14 +11,20 @@ import traceback
 
 from   . import procstar
 from   .actions import Action
+from   .agent import client as agent_client
 from   .cond.base import PolledCondition, RunStoreCondition, NonmonotonicRunStoreCondition
+from   .exc import JobsDirErrors
+from   . import host_group
 from   .host_group import config_host_groups
-from   .jobs import Jobs, load_jobs_dir, diff_jobs_dirs
+from   .jobs import Jobs, load_jobs_dir, diff_jobs_dirs, update_jobs_dir
+from   .launcher import get_launcher
+from   .lib import cmpr
 from   .lib.api import run_to_summary_jso
 from   .lib.asyn import TaskGroup, Publisher, KeyPublisher
-from   .lib.py import more_gc_stats
+from   .lib.inotify import TreeWatcher
+from   .lib.py import more_gc_stats, get_cfg
 from   .lib.sys import to_signal
-from   .output import OutputStore
+from   .output import OutputIndexer, OutputStore
 from   .program.base import _InternalProgram
 from   .program.base import Output, OutputMetadata
 from   . import runs
@@ -26,7 +32,7 @@ from   .run_log import RunLog
 from   .run_snapshot import snapshot_run
 from   .running import _process_updates
 from   .runs import Run, RunStore, RunError, MissingArgumentError, ExtraArgumentError
-from   .runs import validate_args, bind
+from   .runs import validate_args, bind, get_bind_stats, get_template_stats
 from   .scheduled import ScheduledRuns
 from   .scheduler import Scheduler, get_insts_to_schedule
 from   .service import messages
@@ -115,7 +121,21 @@ class Apsis:
                 except Exception as exc:
                     log.info(f"failed to bind {run}: {exc}")
 
-        self.outputs = OutputStore(db.output_db)
+        output_cfg = cfg.get("output", {})
+        cmpr.set_service(cmpr.CompressionService(
+            max_threads     =get_cfg(output_cfg, "compression.threads", None),
+            max_processes   =get_cfg(output_cfg, "compression.processes", 0),
+            process_min_size=get_cfg(
+                output_cfg, "compression.process_min_size", 64 * 1024 * 1024),
+        ))
+        search_db = db.output_search_db
+        self.outputs = OutputStore(
+            db.output_db,
+            run_max     =get_cfg(output_cfg, "memory.run_max", None),
+            total_max   =get_cfg(output_cfg, "memory.total_max", None),
+            spill_dir   =output_cfg.get("spill_dir", None),
+            indexer     =None if search_db is None else OutputIndexer(search_db),
+        )
 
         # Continue scheduling from the last time we handled scheduled jobs.
         # FIXME: Rename: schedule horizon?
@@ -200,13 +220,26 @@ class Apsis:
         procstar_cfg = self.cfg.get("procstar", {}).get("agent", {})
         if procstar_cfg.get("enable", False):
             log.info("starting procstar server")
-            run_agent_server = procstar.start_agent_server(procstar_cfg)
+            run_agent_server = procstar.start_agent_server(
+                procstar_cfg, get_job_id=self.__get_job_id)
             self.__tasks.add("agent_conn", procstar.agent_conn(self))
             self.__tasks.add("agent_server", run_agent_server)
 
+        # Index finished outputs for search, if enabled.
+        if (indexer := self.outputs.indexer) is not None:
+            log.info("starting output index loop")
+            self.__tasks.add("output_index_loop", indexer.loop())
+
         # Start a task to retire old runs.
         self.__tasks.add("retire_loop", _retire_loop(self))
 
+        # Watch the jobs dir for changes, if enabled.
+        watch_cfg = self.cfg.get("job_dir_watch", {})
+        if watch_cfg.get("enable", False):
+            log.info("starting jobs dir watch loop")
+            delay = watch_cfg.get("delay", 1)
+            self.__tasks.add("watch_jobs_loop", _watch_jobs_loop(self, delay))
+
         # We're running now.
         self.running_flag.set()
 
@@ -385,6 +418,31 @@ class Apsis:
                 self.output_update_publisher.publish(run_id, output)
 
 
+    def _append_output_data(self, run, output_deltas):
+        """
+        Appends output data to a running run's outputs, without transitioning.
+
+        Subscribers to output updates receive only the appended data.
+
+        :param output_deltas:
+          Mapping from output ID to `OutputDelta`.
+        """
+        run_id = run.run_id
+
+        for output_id, delta in output_deltas.items():
+            self.outputs.write_delta(run_id, output_id, delta)
+
+        # Publish to run update subscribers.
+        if run_id in self.run_update_publisher:
+            msg = { i: d.metadata.to_jso() for i, d in output_deltas.items() }
+            self.run_update_publisher.publish(run_id, {"outputs": msg})
+
+        # Publish to output update subscribers.
+        if run_id in self.output_update_publisher:
+            for output_id, delta in output_deltas.items():
+                self.output_update_publisher.publish(run_id, delta)
+
+
     def _transition(self, run, state, *, meta={}, **kw_args):
         """
         Transitions `run` to `state`, updating it with `kw_args`.
@@ -414,9 +472,11 @@ class Apsis:
             self.run_update_publisher.publish(run_id, msg)
         # Publish to summary subscribers.
         self.summary_publisher.publish(messages.make_run_transition(run))
-        # If the run is finished, close the output update publisher.
+        # If the run is finished, close the output update publisher, and drop
+        # any running outputs that weren't written through.
         if state.finished:
             self.output_update_publisher.close(run_id)
+            self.outputs.discard(run_id)
 
         self.__start_actions(run)
 
@@ -572,6 +632,14 @@ class Apsis:
             self.run_log.info(run, f"marked as {state.name}")
 
 
+    def __get_job_id(self, run_id):
+        """
+        Returns the job ID of run `run_id`.
+        """
+        _, run = self.run_store.get(run_id)
+        return run.inst.job_id
+
+
     def get_run_log(self, run_id):
         """
         Returns the run log for a run.
@@ -703,7 +771,14 @@ class Apsis:
             "scheduled"             : self.scheduled.get_stats(),
             "run_store"             : self.run_store.get_stats(),
             "outputs"               : self.outputs.get_stats(),
+            "compression"           : cmpr.get_service().get_stats(),
+            "agent_connections"     : agent_client.get_stats(),
+            "hosts"                 : host_group.get_stats(),
+            "procstar_poller"       : procstar.get_poller().get_stats(),
+            "launcher"              : get_launcher().get_stats(),
             "summary_publisher"     : self.summary_publisher.get_stats(),
+            "templates"             : get_template_stats(),
+            "bind_cache"            : get_bind_stats(),
             "gc"                    : [
                 s0 | s1
                 for s0, s1 in zip(gc_stats, more_gc_stats)
@@ -858,6 +933,43 @@ async def reschedule_runs(apsis, job_id):
         await apsis.schedule(time, inst, expected=True, stop_time=stop_time)
 
 
+async def _apply_job_changes(apsis, jobs_dir, rem_ids, add_ids, chg_ids):
+    """
+    Switches `apsis` to `jobs_dir`, and unschedules and reschedules runs of
+    removed, added, and changed jobs.
+    """
+    job_db = apsis.jobs._Jobs__job_db
+
+    # Unschedule all affected jobs first, before touching the scheduler.
+    for job_id in rem_ids:
+        log.info(f"unscheduling removed job: {job_id}")
+        _unschedule_runs(apsis, job_id)
+    for job_id in chg_ids:
+        log.info(f"unscheduling changed job: {job_id}")
+        _unschedule_runs(apsis, job_id)
+
+    # Use the new jobs, including for scheduling.
+    apsis.jobs = Jobs(jobs_dir, job_db)
+    apsis.scheduler.set_jobs(apsis.jobs)
+
+    # Reschedule runs.
+    for job_id in add_ids:
+        log.info(f"scheduling added job: {job_id}")
+        await reschedule_runs(apsis, job_id)
+    for job_id in sorted(chg_ids):
+        log.info(f"scheduling changed: {job_id}")
+        await reschedule_runs(apsis, job_id)
+
+    # Publish job changes.
+    publish = apsis.summary_publisher.publish
+    for job_id in rem_ids:
+        publish(messages.make_job_delete(job_id))
+    for job_id in add_ids:
+        publish(messages.make_job_add(apsis.jobs.get_job(job_id)))
+    for job_id in chg_ids:
+        publish(messages.make_job(apsis.jobs.get_job(job_id)))
+
+
 async def reload_jobs(apsis, *, dry_run=False):
     """
     :param dry_run:
@@ -868,7 +980,6 @@ async def reload_jobs(apsis, *, dry_run=False):
     """
     # FIXME: Refactor to avoid using private attributes and methods.
     jobs0       = apsis.jobs._Jobs__jobs_dir
-    job_db      = apsis.jobs._Jobs__job_db
 
     # Reload the contents of the jobs dir.
     log.info(f"reloading jobs from {jobs0.path}")
@@ -878,37 +989,86 @@ async def reload_jobs(apsis, *, dry_run=False):
     rem_ids, add_ids, chg_ids = diff_jobs_dirs(jobs0, jobs1)
 
     if not dry_run:
-        for job_id in rem_ids:
-            log.info(f"unscheduling removed job: {job_id}")
-            _unschedule_runs(apsis, job_id)
-        for job_id in chg_ids:
-            log.info(f"unscheduling changed job: {job_id}")
-            _unschedule_runs(apsis, job_id)
-
-        # Use the new jobs, including for scheduling.
-        apsis.jobs = Jobs(jobs1, job_db)
-        apsis.scheduler.set_jobs(apsis.jobs)
-
-        # Reschedule runs.
-        for job_id in add_ids:
-            log.info(f"scheduling added job: {job_id}")
-            await reschedule_runs(apsis, job_id)
-        for job_id in sorted(chg_ids):
-            log.info(f"scheduling changed: {job_id}")
-            await reschedule_runs(apsis, job_id)
-
-        # Publish job changes.
-        publish = apsis.summary_publisher.publish
-        for job_id in rem_ids:
-            publish(messages.make_job_delete(job_id))
-        for job_id in add_ids:
-            publish(messages.make_job_add(apsis.jobs.get_job(job_id)))
-        for job_id in chg_ids:
-            publish(messages.make_job(apsis.jobs.get_job(job_id)))
+        await _apply_job_changes(apsis, jobs1, rem_ids, add_ids, chg_ids)
 
     return rem_ids, add_ids, chg_ids
 
 
+async def reload_job_paths(apsis, paths, *, dry_run=False):
+    """
+    Incrementally reloads jobs from changed `paths` in the jobs dir.
+
+    Like `reload_jobs()`, but reads and checks only job files at or under
+    `paths`.
+
+    :return:
+      Job IDs that have been removed, job IDs that have been added, and job IDs
+      that have changed.
+    """
+    jobs0 = apsis.jobs._Jobs__jobs_dir
+    log.info(f"reloading {len(paths)} changed paths in {jobs0.path}")
+    jobs1, rem_ids, add_ids, chg_ids = update_jobs_dir(jobs0, paths)
+
+    if not dry_run:
+        await _apply_job_changes(apsis, jobs1, rem_ids, add_ids, chg_ids)
+
+    return rem_ids, add_ids, chg_ids
+
+
+async def _watch_jobs_loop(apsis, delay):
+    """
+    Watches the jobs dir for changes, and reloads changed jobs.
+
+    :param delay:
+      Time to wait after a change for further changes, before reloading.
+    """
+    path = apsis.jobs._Jobs__jobs_dir.path
+    watcher = TreeWatcher(path)
+    try:
+        watcher.start()
+    except OSError as exc:
+        log.error(f"can't watch jobs dir {path}: {exc}")
+        return
+
+    # Changed paths not yet reloaded successfully.  If a reload fails, we retry
+    # its paths along with the next changes, so that no change is lost.
+    pending = set()
+    # True if we must reload everything.
+    reload_all = False
+
+    try:
+        while True:
+            paths = await watcher.wait(delay)
+            if paths is None:
+                # Lost track of changes.
+                reload_all = True
+            else:
+                pending.update(paths)
+
+            try:
+                if reload_all:
+                    rem_ids, add_ids, chg_ids = await reload_jobs(apsis)
+                else:
+                    rem_ids, add_ids, chg_ids = await reload_job_paths(
+                        apsis, pending)
+            except JobsDirErrors as exc:
+                for err in exc.errors:
+                    log.error(f"job {err.job_id}: {err}")
+                log.error("not reloading jobs due to errors")
+            except Exception:
+                log.error("reloading jobs failed", exc_info=True)
+            else:
+                pending.clear()
+                reload_all = False
+                log.info(
+                    f"reloaded jobs: {len(rem_ids)} removed, "
+                    f"{len(add_ids)} added, {len(chg_ids)} changed"
+                )
+
+    finally:
+        watcher.stop()
+
+
 async def _retire_loop(apsis):
     """
     Periodically retires runs older than `runs.lookback`.
@@ -22,6 +22,17 @@ log = logging.getLogger(__name__)
 
 #-------------------------------------------------------------------------------
 
+def parse_line_range(string):
+    """
+    Parses a line range "START:STOP"; either may be omitted.
+    """
+    start, stop = string.split(":", 1)
+    return (
+        int(start) if start else None,
+        int(stop) if stop else None,
+    )
+
+
 def main():
     apsis.lib.logging.rich_configure()
 
@@ -159,6 +170,17 @@ def main():
 
             asyncio.run(follow())
 
+        elif args.tail is not None:
+            output = client.get_output_lines(
+                args.run_id, "output", tail=args.tail)
+            sys.stdout.buffer.write(output)
+
+        elif args.lines is not None:
+            start, stop = args.lines
+            output = client.get_output_lines(
+                args.run_id, "output", start=start, stop=stop)
+            sys.stdout.buffer.write(output)
+
         else:
             output = client.get_output(args.run_id, "output")
             sys.stdout.buffer.write(output)
@@ -176,6 +198,12 @@ def main():
     grp.add_argument(
         "--follow-new", "-F", default=False, action="store_true",
         help="don't dump current output but follow further output")
+    grp.add_argument(
+        "--tail", "-n", metavar="NUM", type=int, default=None,
+        help="dump only the last NUM lines")
+    grp.add_argument(
+        "--lines", metavar="START:STOP", type=parse_line_range, default=None,
+        help="dump only lines START (inclusive) to STOP (exclusive)")
 
     #--- command: rerun ----------------------------------------------
 
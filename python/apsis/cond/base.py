@@ -21,6 +21,10 @@ class Condition(TypedJso):
 
     TYPE_NAMES = TypedJso.TypeNames()
 
+    # True if `bind()` depends only on the run's job ID and args, and the bound
+    # condition holds no per-run state, so it may be shared among runs.
+    shared_bind = False
+
     def bind(self, run, jobs):
         """
         Binds the condition to `inst`.
@@ -190,6 +194,8 @@ class ConstantCondition(PolledCondition):
     Condition with a constant value, either true or false.
     """
 
+    shared_bind = True
+
     def __init__(self, value):
         self.__value = bool(value)
 
@@ -17,6 +17,8 @@ class MaxRunning(Condition):
     the starting or running states is less than `count`.
     """
 
+    shared_bind = True
+
     def __init__(self, count, job_id=None, args=None):
         """
         :param job_id:
@@ -4,7 +4,7 @@ import warnings
 import yaml
 
 from   .lib.json import to_array
-from   .lib.parse import nparse_duration
+from   .lib.parse import nparse_duration, nparse_size, parse_size
 from   .lib.py import get_cfg, set_cfg
 
 log = logging.getLogger(__name__)
@@ -48,6 +48,42 @@ def check(cfg, base_path: Path):
     if max_time is not None and max_time <= 0:
         log.error("negative waiting.max_time: {max_time}")
 
+    _check_duration("job_dir_watch.delay")
+
+    for path in ("output.memory.run_max", "output.memory.total_max"):
+        set_cfg(cfg, path, nparse_size(get_cfg(cfg, path, None)))
+    # By default, spill output files next to the database.
+    spill_dir = get_cfg(cfg, "output.spill_dir", None)
+    set_cfg(
+        cfg, "output.spill_dir",
+        db_path.parent if spill_dir is None
+        else normalize_path(spill_dir, base_path)
+    )
+    # By default, store output blobs in a directory next to the database.
+    blob_path = get_cfg(cfg, "output.blob.path", None)
+    set_cfg(
+        cfg, "output.blob.path",
+        db_path.with_name(db_path.name + ".blobs") if blob_path is None
+        else normalize_path(blob_path, base_path)
+    )
+    set_cfg(
+        cfg, "output.blob.min_size",
+        parse_size(get_cfg(cfg, "output.blob.min_size", "1 MiB"))
+    )
+    set_cfg(
+        cfg, "output.compression.process_min_size",
+        parse_size(get_cfg(
+            cfg, "output.compression.process_min_size", "64 MiB"))
+    )
+
+    # By default, write process output to the system temporary directory.
+    output_dir = get_cfg(cfg, "process.output_dir", None)
+    if output_dir is not None:
+        set_cfg(
+            cfg, "process.output_dir", normalize_path(output_dir, base_path))
+
+    _check_duration("agent.run.output_interval")
+    _check_duration("process.run.output_interval")
     _check_duration("procstar.agent.connection.start_timeout")
     _check_duration("procstar.agent.connection.reconnect_timeout")
     _check_duration("procstar.agent.run.update_interval")
@@ -19,6 +19,7 @@ import apsis.cmdline
 import apsis.config
 from   apsis.exc import JobsDirErrors
 import apsis.lib.argparse
+from   apsis.lib.blob import BlobStore
 import apsis.lib.json
 import apsis.lib.logging
 from   apsis.service import DEFAULT_PORT
@@ -101,6 +102,49 @@ def main():
         "--check-dependencies-scheduled", default=False, action="store_true",
         help="check that dependencies are scheduled in the future")
 
+    #-------------------------------------------------------------
+    # command: collect-blobs
+
+    def cmd_collect_blobs(args):
+        blob_path = (
+            Path(str(args.db) + ".blobs") if args.blob_path is None
+            else args.blob_path
+        )
+        if not blob_path.is_dir():
+            parser.error(f"no blob dir: {blob_path}")
+        # Blobs referenced by the database or any archive.
+        digests = set()
+        for path in (args.db, *args.archive):
+            digests |= apsis.sqlite.OutputDB.get_blob_digests(path)
+
+        blobs = BlobStore(blob_path)
+        num, size = blobs.collect(
+            digests, min_age=args.min_age, dry_run=args.dry_run)
+        con.print(
+            f"{'would remove' if args.dry_run else 'removed'} {num} files, "
+            f"{size} bytes"
+        )
+
+
+    cmd = parser.add_command(
+        "collect-blobs", cmd_collect_blobs,
+        description="Removes output blobs no longer referenced.")
+    cmd.add_argument(
+        "db", metavar="DBPATH", type=Path,
+        help="path to Apsis database")
+    cmd.add_argument(
+        "--archive", metavar="PATH", type=Path, action="append", default=[],
+        help="also keep blobs referenced by archive file PATH")
+    cmd.add_argument(
+        "--blob-path", metavar="DIR", type=Path, default=None,
+        help="blob directory [def: DBPATH.blobs]")
+    cmd.add_argument(
+        "--min-age", metavar="SECS", type=float, default=86400,
+        help="keep files modified within SECS [def: 86400]")
+    cmd.add_argument(
+        "--dry-run", action="store_true", default=False,
+        help="show what would be removed, but don't remove it")
+
     #-------------------------------------------------------------
     # command: create
 
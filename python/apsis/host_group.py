@@ -2,11 +2,110 @@
 Designation of host(s) to run on.
 """
 
+import asyncio
+from   collections import Counter
+import heapq
+import itertools
+import logging
 import random
+import socket
+import weakref
 
+from   .agent.client import get_agent
 from   .lib.json import TypedJso
 from   .runs import template_expand
 
+log = logging.getLogger(__name__)
+
+#-------------------------------------------------------------------------------
+
+class HostLoad:
+    """
+    Tracks the load on hosts: the number of runs Apsis has in flight on each,
+    and the load reported by each host's agent, if any.
+
+    Notifies watching host groups whenever a host's load changes.
+    """
+
+    def __init__(self):
+        self.__runs = Counter()
+        # Load average per CPU, as reported by the agent.
+        self.__reported = {}
+        # Weak refs to watching groups, by ID.  Host groups aren't hashable.
+        self.__groups = {}
+
+
+    def watch(self, group):
+        """
+        Calls `group._update(host)` when the load on a host changes.
+        """
+        key = id(group)
+        self.__groups[key] = weakref.ref(
+            group, lambda _: self.__groups.pop(key, None))
+
+
+    def __changed(self, host):
+        for ref in tuple(self.__groups.values()):
+            group = ref()
+            if group is not None:
+                group._update(host)
+
+
+    def get_runs(self, host) -> int:
+        """
+        Returns the number of runs in flight on `host`.
+        """
+        return self.__runs[host]
+
+
+    def get_reported(self, host) -> float:
+        """
+        Returns the agent-reported load average per CPU on `host`, or zero.
+        """
+        return self.__reported.get(host, 0)
+
+
+    def add_run(self, host):
+        if host is not None:
+            self.__runs[host] += 1
+            self.__changed(host)
+
+
+    def remove_run(self, host):
+        if host is not None:
+            self.__runs[host] -= 1
+            if self.__runs[host] <= 0:
+                del self.__runs[host]
+            self.__changed(host)
+
+
+    def set_reported(self, host, load):
+        self.__reported[host] = load
+        self.__changed(host)
+
+
+    def get_stats(self):
+        hosts = set(self.__runs) | set(self.__reported)
+        return {
+            h: {
+                "num_runs"  : self.__runs[h],
+                "load"      : self.__reported.get(h, None),
+            }
+            for h in sorted(hosts)
+        }
+
+
+
+# Load on all hosts.  This outlives host groups, if config is reloaded.
+HOST_LOAD = HostLoad()
+
+def get_stats():
+    """
+    Returns per-host utilization stats.
+    """
+    return HOST_LOAD.get_stats()
+
+
 #-------------------------------------------------------------------------------
 
 class HostGroup(TypedJso):
@@ -120,10 +219,141 @@ class RandomHostGroup(HostGroup):
 
 
 
+async def _refresh_loads(hosts, interval):
+    """
+    Refreshes the agent-reported loads of `hosts` every `interval` seconds.
+    """
+    agents = { h: get_agent(socket.getfqdn(h)) for h in hosts }
+
+    async def refresh(host):
+        try:
+            load = await agents[host].get_load()
+        except Exception as exc:
+            log.warning(f"load from {host} failed: {exc}")
+        else:
+            HOST_LOAD.set_reported(
+                host, load["loadavg"][0] / max(load["num_cpus"], 1))
+
+    while True:
+        await asyncio.gather(*( refresh(h) for h in agents ))
+        await asyncio.sleep(interval)
+
+
+class LeastLoadedHostGroup(HostGroup):
+    """
+    A list of hosts, of which the least loaded is chosen.
+
+    A host's load is the number of runs Apsis has in flight on it, plus
+    `load_weight` times the load average per CPU reported by its agent.  If
+    `load_weight` is nonzero, the load average is refreshed from each host's
+    agent every `load_interval` seconds.  Ties go to the host whose load
+    changed least recently.
+    """
+
+    def __init__(self, hosts, *, load_weight=0, load_interval=60):
+        super().__init__(hosts)
+        self.load_weight    = float(load_weight)
+        self.load_interval  = float(load_interval)
+
+        # Current load of each host, and seq of its heap entry.
+        self.__loads = {}
+        # Heap of (load, seq, host).  An entry is stale if it is not the host's
+        # current entry; stale entries are discarded lazily.
+        self.__heap = []
+        self.__seq = itertools.count()
+        for host in self.hosts:
+            self.__loads[host] = None, None
+            self._update(host)
+        HOST_LOAD.watch(self)
+
+        self.__refresh_task = None
+
+
+    @classmethod
+    def from_jso(cls, jso):
+        return cls(
+            jso.pop("hosts"),
+            load_weight     =jso.pop("load_weight", 0),
+            load_interval   =jso.pop("load_interval", 60),
+        )
+
+
+    def to_jso(self):
+        return {
+            **super().to_jso(),
+            "hosts"         : self.hosts,
+            "load_weight"   : self.load_weight,
+            "load_interval" : self.load_interval,
+        }
+
+
+    def bind(self, args):
+        hosts = tuple( template_expand(a, args) for a in self.hosts )
+        return type(self)(
+            hosts,
+            load_weight     =self.load_weight,
+            load_interval   =self.load_interval,
+        )
+
+
+    def _update(self, host):
+        """
+        Updates the load of `host`, if it's in this group.
+        """
+        if host not in self.__loads:
+            return
+        load = (
+            HOST_LOAD.get_runs(host)
+            + self.load_weight * HOST_LOAD.get_reported(host)
+        )
+        if load != self.__loads[host][0]:
+            entry = load, next(self.__seq), host
+            self.__loads[host] = entry[: 2]
+            heapq.heappush(self.__heap, entry)
+            if len(self.__heap) > 4 * len(self.__loads):
+                # Too many stale entries; rebuild.
+                self.__heap = [
+                    e for e in self.__heap if e[: 2] == self.__loads[e[2]] ]
+                heapq.heapify(self.__heap)
+
+
+    def choose(self):
+        if self.load_weight != 0 and self.__refresh_task is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Not in the event loop, so we can't refresh loads.
+                pass
+            else:
+                # Start refreshing agent-reported loads, until this group is
+                # closed or discarded.  The task doesn't refer to the group.
+                task = self.__refresh_task = loop.create_task(
+                    _refresh_loads(self.hosts, self.load_interval))
+                weakref.finalize(self, task.cancel)
+
+        while True:
+            load, seq, host = self.__heap[0]
+            if (load, seq) == self.__loads[host]:
+                return host
+            # Stale.
+            heapq.heappop(self.__heap)
+
+
+    def close(self):
+        """
+        Stops refreshing agent-reported loads.
+        """
+        if self.__refresh_task is not None:
+            self.__refresh_task.cancel()
+            self.__refresh_task = None
+
+
+
 # Aliases.
 HostGroup.TYPE_NAMES.set(SingleHost, "single")
 HostGroup.TYPE_NAMES.set(RoundRobinHostGroup, "round-robin")
 HostGroup.TYPE_NAMES.set(RandomHostGroup, "random")
+HostGroup.TYPE_NAMES.set(LeastLoadedHostGroup, "least-loaded")
 
 #-------------------------------------------------------------------------------
 
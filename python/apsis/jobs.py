@@ -9,7 +9,8 @@ from   .actions import Action
 from   .actions.schedule import successor_from_jso
 from   .cond import Condition
 from   .exc import JobError, JobsDirErrors, SchemaError
-from   .lib.json import to_array, to_narray, check_schema
+from   .lib import memo
+from   .lib.json import to_array, to_narray, check_schema, fingerprint_jso
 from   .lib.py import tupleize, format_ctor
 from   .program import Program, NoOpProgram
 from   .schedule import schedule_to_jso, schedule_from_jso
@@ -55,16 +56,31 @@ class Job:
         )
 
 
+    @memo.property
+    def fingerprint(self) -> str:
+        """
+        Stable content fingerprint of the job's definition.
+
+        Two jobs with the same params, schedules, program, conditions, actions,
+        and metadata have the same fingerprint, regardless of job ID.  The
+        fingerprint is computed on first use and cached; the job and its
+        components must not be modified afterward.
+        """
+        return fingerprint_jso({
+            "params"        : sorted(self.params),
+            "schedule"      : [ schedule_to_jso(s) for s in self.schedules ],
+            "program"       : self.program.fingerprint,
+            "condition"     : [ c.fingerprint for c in self.conds ],
+            "action"        : [ a.fingerprint for a in self.actions ],
+            "metadata"      : self.meta,
+        })
+
+
     def __eq__(self, other):
         return (
                 not self.ad_hoc
             and not other.ad_hoc
-            and other.params    == self.params
-            and other.schedules == self.schedules
-            and other.program   == self.program
-            and other.conds     == self.conds
-            and other.actions   == self.actions
-            and other.meta      == self.meta
+            and other.fingerprint == self.fingerprint
         )
 
 
@@ -166,6 +182,20 @@ def list_yaml_files(dir_path):
             yield path, job_id
 
 
+def get_path_job_id(dir_path, path):
+    """
+    Returns the job ID for the job file at `path` in jobs dir `dir_path`, or
+    none if `path` is not a job file.
+    """
+    path = Path(path)
+    if path.suffix != ".yaml" or path.name.startswith("."):
+        return None
+    try:
+        return str(path.with_suffix("").relative_to(dir_path))
+    except ValueError:
+        return None
+
+
 #-------------------------------------------------------------------------------
 
 # FIXME: Use mapping API for jobs.
@@ -271,6 +301,116 @@ def load_jobs_dir(path):
     return jobs_dir
 
 
+def _refers_to(job, job_ids):
+    """
+    Returns true if `job` may refer to any of `job_ids` in an action or
+    condition.
+
+    A templated job ID may refer to any job.
+    """
+    for obj in (*job.actions, *job.conds):
+        job_id = getattr(obj, "job_id", None)
+        if job_id is not None and (job_id in job_ids or "{" in job_id):
+            return True
+    return False
+
+
+def update_jobs_dir(jobs_dir, paths):
+    """
+    Incrementally reloads jobs in `jobs_dir` from changed `paths`.
+
+    Only the job files at or under `paths` are read and checked, so the cost is
+    proportional to the number of changed paths, not the size of the jobs dir.
+    A path may be a job file, or a directory that was created, removed, or
+    renamed.
+
+    :return:
+      The updated `JobsDir`, and job IDs that have been removed, job IDs that
+      have been added, and job IDs that have changed.
+    :raise JobsDirErrors:
+      One or more errors while loading jobs.
+    """
+    from .check import check_job
+
+    dir_path = Path(jobs_dir.path)
+
+    # Determine the job IDs that may be affected.
+    job_ids = set()
+    prefixes = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            job_ids.update(
+                get_path_job_id(dir_path, p)
+                for p, _ in list_yaml_files(path)
+            )
+        elif (job_id := get_path_job_id(dir_path, path)) is not None:
+            job_ids.add(job_id)
+            continue
+        # A directory, or something that was one; consider all jobs we already
+        # have under it.
+        try:
+            prefix = str(path.relative_to(dir_path))
+        except ValueError:
+            continue
+        prefixes.append("" if prefix == "." else prefix + "/")
+    job_ids.discard(None)
+
+    jobs = { j.job_id: j for j in jobs_dir.get_jobs() }
+    if len(prefixes) > 0:
+        job_ids.update(
+            i for i in jobs
+            if any( i.startswith(p) for p in prefixes )
+        )
+
+    rem_ids, add_ids, chg_ids = set(), set(), set()
+    errors = []
+    for job_id in job_ids:
+        path = dir_path / (job_id + ".yaml")
+        try:
+            log.debug(f"loading: {path}")
+            job = load_yaml_file(path, job_id)
+        except FileNotFoundError:
+            if jobs.pop(job_id, None) is not None:
+                rem_ids.add(job_id)
+            continue
+        except SchemaError as exc:
+            log.debug(f"error: {path}: {exc}", exc_info=True)
+            exc.job_id = job_id
+            errors.append(exc)
+            continue
+
+        try:
+            old = jobs[job_id]
+        except KeyError:
+            add_ids.add(job_id)
+        else:
+            if old.fingerprint == job.fingerprint:
+                continue
+            chg_ids.add(job_id)
+        jobs[job_id] = job
+
+    jobs_dir = JobsDir(dir_path, jobs)
+
+    # Check the jobs that are new or have changed, and those that refer to any
+    # job that was removed, added, or changed.
+    delta_ids = rem_ids | add_ids | chg_ids
+    check_ids = add_ids | chg_ids | {
+        i for i, j in jobs.items()
+        if len(delta_ids) > 0 and _refers_to(j, delta_ids)
+    }
+    for job_id in sorted(check_ids):
+        job = jobs[job_id]
+        log.info(f"checking: {job_id}")
+        for err in check_job(jobs_dir, job):
+            errors.append(JobError(job_id, f"{job_id}: {err}"))
+
+    if len(errors) > 0:
+        raise JobsDirErrors(f"errors loading jobs in {dir_path}", errors)
+
+    return jobs_dir, frozenset(rem_ids), frozenset(add_ids), frozenset(chg_ids)
+
+
 def dump_job(jobs_dir_path, job):
     path = (jobs_dir_path / job.job_id).with_suffix(".yaml")
     with path.open("w") as file:
@@ -311,9 +451,10 @@ class Jobs:
           if none, return all jobs.
         """
         if ad_hoc is None or not ad_hoc:
-            yield from self.__jobs_dir.get_jobs()
-        # FIXME: Yield only job ids we haven't seen.
-        yield from self.__job_db.query(ad_hoc=ad_hoc)
+            yield from self.__jobs_dir.get_jobs(ad_hoc=ad_hoc)
+        if ad_hoc is None or ad_hoc:
+            # FIXME: Yield only job ids we haven't seen.
+            yield from self.__job_db.query(ad_hoc=ad_hoc)
 
 
     def __get_job_id(self):
@@ -348,7 +489,9 @@ def diff_jobs_dirs(jobs_dir0, jobs_dir1):
     return (
         job_ids0 - job_ids1,
         job_ids1 - job_ids0,
-        frozenset( i for i in ids if jobs1[i] != jobs0[i] ),
+        frozenset(
+            i for i in ids if jobs1[i].fingerprint != jobs0[i].fingerprint
+        ),
     )
 
 
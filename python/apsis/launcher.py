@@ -0,0 +1,459 @@
+"""
+Small launcher process that spawns local programs on behalf of Apsis.
+
+Forking the Apsis process itself to start each program is expensive, as it may
+be very large.  Instead, Apsis starts this launcher once, as a subprocess, and
+asks it over a pipe to spawn each program, forkserver-style.
+
+The launcher spawns each program with stdin from `/dev/null` and stdout and
+stderr appended to an output file.  When the program terminates, the launcher
+writes its wait status to a status file, and notifies Apsis.  The launcher runs
+in its own session, and outlives Apsis until its programs terminate, so that
+a restarted Apsis can reconnect to them using the output and status files.
+
+Messages in both directions are JSON objects, one per line.
+
+This module imports only the standard library, to keep the launcher small.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import selectors
+import signal
+import sys
+
+log = logging.getLogger(__name__)
+
+# Interval at which to poll the status of a program started by another
+# launcher, in sec.
+POLL_INTERVAL = 1
+
+#-------------------------------------------------------------------------------
+
+class LauncherTerminatedError(RuntimeError):
+
+    def __init__(self):
+        super().__init__("launcher terminated")
+
+
+
+class ProcessLostError(RuntimeError):
+
+    def __init__(self, pid):
+        super().__init__(f"process lost: {pid}")
+        self.pid = pid
+
+
+
+def read_status(status_path):
+    """
+    Returns the wait status in `status_path`, or none if it doesn't exist.
+    """
+    try:
+        with open(status_path) as file:
+            return json.load(file)["status"]
+    except FileNotFoundError:
+        return None
+
+
+def _write_status(status_path, status):
+    """
+    Writes `status` to `status_path` atomically.
+    """
+    tmp_path = f"{status_path}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump({"status": status}, file)
+    os.replace(tmp_path, status_path)
+
+
+def get_start_time(pid):
+    """
+    Returns the start time of process `pid`, in clock ticks since boot.
+
+    Together with the pid, this identifies a process, even if the pid is
+    later reused.
+
+    :raise ProcessLookupError:
+      No process `pid`.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            stat = file.read()
+    except FileNotFoundError:
+        raise ProcessLookupError(pid) from None
+    # The command may contain spaces and parentheses; fields follow the last
+    # close paren.  The start time is field 22.
+    return int(stat[stat.rindex(")") + 2 :].split()[19])
+
+
+def _spawn(argv, output_path):
+    """
+    Spawns a program, and returns its pid.
+    """
+    # Searches the path if `argv[0]` is a bare name.
+    return os.posix_spawnp(
+        argv[0], argv, os.environ,
+        file_actions=[
+            (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+            (
+                os.POSIX_SPAWN_OPEN, 1, output_path,
+                os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600
+            ),
+            # Merge stderr into stdout.
+            (os.POSIX_SPAWN_DUP2, 1, 2),
+        ],
+    )
+
+
+def _handle(req, procs):
+    """
+    Handles request `req`, and returns the response.
+    """
+    match req.get("op", "start"):
+        case "start":
+            try:
+                pid = _spawn(req["argv"], req["output_path"])
+            except OSError as exc:
+                return {"error": str(exc)}
+            procs[pid] = req["status_path"]
+            return {"pid": pid, "start_time": get_start_time(pid)}
+
+        case "signal":
+            pid = req["pid"]
+            # Only signal our own programs, which we haven't reaped yet, so
+            # the pid can't have been reused.
+            if pid not in procs:
+                return {"error": f"no such process: {pid}"}
+            os.kill(pid, req["signum"])
+            return {}
+
+        case op:
+            return {"error": f"unknown op: {op}"}
+
+
+def main():
+    """
+    Runs the launcher, until Apsis closes its stdin and all programs terminate.
+    """
+    sel = selectors.DefaultSelector()
+    # Use pidfds to wake up when programs terminate, if available.  Otherwise,
+    # poll.
+    use_pidfd = hasattr(os, "pidfd_open")
+    timeout = None if use_pidfd else 0.1
+
+    stdin = sys.stdin.buffer.raw
+    sel.register(stdin, selectors.EVENT_READ)
+    stdout = sys.stdout.buffer
+    connected = True
+
+    def send(msg):
+        nonlocal connected
+        if connected:
+            try:
+                stdout.write(json.dumps(msg).encode() + b"\n")
+                stdout.flush()
+            except BrokenPipeError:
+                connected = False
+
+    # Mapping from pid to status path of running programs.
+    procs = {}
+    buf = b""
+
+    while connected or len(procs) > 0:
+        for key, _ in sel.select(timeout):
+            if key.fileobj is stdin:
+                data = stdin.read(65536)
+                if len(data) == 0:
+                    # Apsis is gone; keep going until our programs terminate.
+                    sel.unregister(stdin)
+                    connected = False
+                    continue
+                *lines, buf = (buf + data).split(b"\n")
+                for line in lines:
+                    req = json.loads(line)
+                    res = _handle(req, procs)
+                    if use_pidfd and "pid" in res:
+                        sel.register(
+                            os.pidfd_open(res["pid"]), selectors.EVENT_READ)
+                    send({"id": req["id"], **res})
+
+            else:
+                # A pidfd is readable; its program terminated.
+                sel.unregister(key.fileobj)
+                os.close(key.fileobj)
+
+        # Reap terminated programs.
+        while len(procs) > 0:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            status_path = procs.pop(pid, None)
+            if status_path is not None:
+                _write_status(status_path, status)
+                send({"pid": pid, "status": status})
+
+
+
+#-------------------------------------------------------------------------------
+
+class _LauncherProc:
+    """
+    A launcher subprocess, with its pending requests and running programs.
+    """
+
+    def __init__(self, proc):
+        self.proc = proc
+        # Futures for pending requests, by request ID.
+        self.requests = {}
+        # Futures for the wait status of programs, by pid.  The result is none
+        # if the launcher terminated first.
+        self.waits = {}
+
+
+
+class Launcher:
+    """
+    Client for a launcher subprocess.
+
+    Starts the launcher on first use, and again if it terminates or the event
+    loop changes.
+    """
+
+    def __init__(self):
+        self.__loop = None
+        self.__lock = None
+        self.__launcher = None
+        self.__next_id = 0
+
+        self.__num_launched = 0
+
+
+    async def __get_launcher(self):
+        loop = asyncio.get_running_loop()
+        if self.__loop is not loop:
+            # Nothing from another event loop is usable in this one.
+            self.__loop = loop
+            self.__lock = asyncio.Lock()
+            self.__launcher = None
+
+        # Only one caller starts a launcher; the rest wait for it.
+        async with self.__lock:
+            launcher = self.__launcher
+            if launcher is None or launcher.proc.returncode is not None:
+                log.info("starting launcher")
+                proc = await asyncio.create_subprocess_exec(
+                    sys.executable, "-m", "apsis.launcher",
+                    stdin               =asyncio.subprocess.PIPE,
+                    stdout              =asyncio.subprocess.PIPE,
+                    start_new_session   =True,
+                )
+                launcher = self.__launcher = _LauncherProc(proc)
+                loop.create_task(self.__read(launcher))
+        return launcher
+
+
+    async def __read(self, launcher):
+        """
+        Handles messages from `launcher`.
+        """
+        async for line in launcher.proc.stdout:
+            msg = json.loads(line)
+            if "id" in msg:
+                fut = launcher.requests.pop(msg["id"], None)
+                if fut is not None and not fut.done():
+                    fut.set_result(msg)
+            else:
+                fut = launcher.waits.setdefault(
+                    msg["pid"], asyncio.get_running_loop().create_future())
+                if not fut.done():
+                    fut.set_result(msg["status"])
+
+        if launcher is self.__launcher:
+            log.error("launcher terminated")
+        # Fail outstanding requests.
+        for fut in launcher.requests.values():
+            if not fut.done():
+                fut.set_exception(LauncherTerminatedError())
+        # Programs run in their own sessions, and keep running.  Waiters fall
+        # back to polling, as for programs from another launcher.
+        for fut in launcher.waits.values():
+            if not fut.done():
+                fut.set_result(None)
+
+
+    async def __request(self, launcher, req):
+        """
+        Sends `req` to `launcher` and returns its response.
+        """
+        req_id = req["id"] = self.__next_id
+        self.__next_id += 1
+        fut = launcher.requests[req_id] = self.__loop.create_future()
+        try:
+            launcher.proc.stdin.write(json.dumps(req).encode() + b"\n")
+            await launcher.proc.stdin.drain()
+        except ConnectionError:
+            launcher.requests.pop(req_id, None)
+            raise LauncherTerminatedError() from None
+        return await fut
+
+
+    async def start(self, argv, output_path, status_path):
+        """
+        Starts a program.
+
+        :param output_path:
+          Path to the file to which to append stdout and stderr.
+        :param status_path:
+          Path to the file to which to write the wait status on termination.
+        :return:
+          The program's pid and start time.
+        :raise OSError:
+          The program could not be started.
+        """
+        launcher = await self.__get_launcher()
+        res = await self.__request(launcher, {
+            "op"            : "start",
+            "argv"          : list(argv),
+            "output_path"   : str(output_path),
+            "status_path"   : str(status_path),
+        })
+        try:
+            pid = res["pid"]
+        except KeyError:
+            raise OSError(res["error"]) from None
+        launcher.waits.setdefault(pid, self.__loop.create_future())
+        self.__num_launched += 1
+        return pid, res["start_time"]
+
+
+    def __get_waits(self):
+        """
+        Returns futures for the status of programs the current launcher
+        started, by pid.
+        """
+        launcher = self.__launcher
+        if launcher is None or self.__loop is not asyncio.get_running_loop():
+            return {}
+        return launcher.waits
+
+
+    def __is_running(self, pid, start_time):
+        """
+        Returns true if the process started as `pid` at `start_time` is
+        running, and not some other process that reused the pid.
+        """
+        try:
+            return get_start_time(pid) == start_time
+        except ProcessLookupError:
+            return False
+
+
+    async def wait(self, pid, status_path, start_time) -> int:
+        """
+        Waits for a program to terminate.
+
+        The program may have been started by a previous launcher.  If the
+        launcher that started it terminates, keeps waiting for the program.
+
+        :return:
+          The program's wait status.
+        :raise ProcessLostError:
+          The program terminated without a status.
+        """
+        waits = self.__get_waits()
+        if (fut := waits.get(pid)) is not None:
+            try:
+                status = await fut
+            finally:
+                if fut.done():
+                    waits.pop(pid, None)
+            if status is not None:
+                return status
+
+        # Started by another launcher, or our launcher terminated; poll for
+        # the status file.
+        while (status := read_status(status_path)) is None:
+            if not self.__is_running(pid, start_time):
+                # Give the launcher a chance to write the status.
+                await asyncio.sleep(POLL_INTERVAL)
+                if (status := read_status(status_path)) is None:
+                    raise ProcessLostError(pid)
+                break
+            await asyncio.sleep(POLL_INTERVAL)
+        return status
+
+
+    async def signal(self, pid, signum, status_path, start_time):
+        """
+        Sends `signum` to a program, if it is still running.
+
+        :raise ProcessLookupError:
+          The program is no longer running.
+        """
+        fut = self.__get_waits().get(pid)
+        if fut is not None and not fut.done():
+            # Our launcher started it; it knows whether it's still running.
+            try:
+                res = await self.__request(self.__launcher, {
+                    "op": "signal", "pid": pid, "signum": signum})
+            except LauncherTerminatedError:
+                pass
+            else:
+                if "error" in res:
+                    raise ProcessLookupError(res["error"])
+                return
+
+        if read_status(status_path) is not None:
+            raise ProcessLookupError(f"process terminated: {pid}")
+
+        else:
+            # Started by another launcher, or ours terminated.  Hold a pidfd
+            # while checking that the pid is still the program, so that it
+            # can't be reused before we signal it.
+            pidfd = os.pidfd_open(pid)
+            try:
+                if not self.__is_running(pid, start_time):
+                    raise ProcessLookupError(f"process terminated: {pid}")
+                signal.pidfd_send_signal(pidfd, signum)
+            finally:
+                os.close(pidfd)
+
+
+    async def close(self):
+        """
+        Closes the launcher, and waits for it to terminate, which it does once
+        all of its programs have terminated.
+        """
+        if self.__launcher is not None:
+            proc = self.__launcher.proc
+            self.__launcher = None
+            proc.stdin.close()
+            await proc.wait()
+
+
+    def get_stats(self) -> dict:
+        launcher = self.__launcher
+        return {
+            "num_launched"  : self.__num_launched,
+            "num_running"   : 0 if launcher is None else len(launcher.waits),
+        }
+
+
+
+_LAUNCHER = Launcher()
+
+def get_launcher():
+    """
+    Returns the global launcher.
+    """
+    return _LAUNCHER
+
+
+#-------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    main()
+
+
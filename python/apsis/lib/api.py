@@ -5,6 +5,7 @@ import sanic
 import zlib
 
 from   apsis.cond.dependency import Dependency
+from   apsis.lib.cmpr import decompress_frames, zstandard
 from   apsis.schedule import schedule_to_jso
 
 log = logging.getLogger(__name__)
@@ -42,10 +43,14 @@ def decompress(data, compression) -> bytes:
     match compression:
         case "br":
             data = brotli.decompress(data)
+        case "br-chunked":
+            data = decompress_frames(data)
         case "deflate":
             data = zlib.decompress(data)
         case "gzip":
             data = gzip.decompress(data)
+        case "zstd" if zstandard is not None:
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
         case None:
             pass
         case _:
@@ -53,6 +58,24 @@ def decompress(data, compression) -> bytes:
     return data
 
 
+# Compressions that are also HTTP content encodings.
+HTTP_ENCODINGS = {"br", "deflate", "gzip", "zstd"}
+
+def accepts_encoding(headers, compression) -> bool:
+    """
+    Returns true if request `headers` accept a response with `compression`.
+    """
+    if compression is None:
+        # Identity is always implicitly acceptable.
+        return True
+    if compression not in HTTP_ENCODINGS:
+        return False
+    accept = headers.get("Accept-Encoding", "*")
+    # Split fields, and drop quality values.
+    accept = { p.strip().split(";")[0] for p in accept.split(",") }
+    return "*" in accept or compression in accept
+
+
 def encode_response(headers, data, compression):
     """
     Encodes data for a response.
@@ -66,11 +89,7 @@ def encode_response(headers, data, compression):
     :return:
       Header dict for the response, and the payload data.
     """
-    accept = headers.get("Accept-Encoding", "*")
-    # Split fields, and drop quality values.
-    accept = { p.strip().split(";")[0] for p in accept.split(",") }
-
-    if "*" in accept or compression in accept:
+    if accepts_encoding(headers, compression):
         # The current compression is accepted.
         encoding = compression
 
@@ -192,11 +211,24 @@ def output_metadata_to_jso(app, run_id, outputs):
         {
             "output_id": output_id,
             "output_len": output.length,
-        }
+        } | (
+            {} if output.total_length is None
+            else {"output_total_len": output.total_length}
+        )
         for output_id, output in outputs.items()
     ]
 
 
+def _to_http_message(metadata, start, stop, data) -> bytes:
+    return "\r\n".join([
+        f"Content-Type: {metadata.content_type}",
+        # f"Content-Encoding: {output.compression}",
+        f"Content-Range: bytes={start}-{stop - 1}/{metadata.length}",
+        f"Content-Length: {str(stop - start)}",
+        "", ""
+    ]).encode("ascii") + data
+
+
 def output_to_http_message(output, *, interval=(0, None)) -> bytes:
     length = output.metadata.length
     start, stop = interval
@@ -207,12 +239,20 @@ def output_to_http_message(output, *, interval=(0, None)) -> bytes:
     if output.compression is not None:
         raise ValueError("output is compressed")
 
-    return "\r\n".join([
-        f"Content-Type: {output.metadata.content_type}",
-        # f"Content-Encoding: {output.compression}",
-        f"Content-Range: bytes={start}-{stop - 1}/{length}",
-        f"Content-Length: {str(stop - start)}",
-        "", ""
-    ]).encode("ascii") + output.data[start : stop]
+    return _to_http_message(
+        output.metadata, start, stop, output.data[start : stop])
+
+
+def output_delta_to_http_message(delta, *, start=None) -> bytes:
+    """
+    Constructs an HTTP message with the data in `delta` from `start`.
+    """
+    if start is None:
+        start = delta.start
+    if not (delta.start <= start <= delta.stop):
+        raise ValueError("start outside of delta")
+
+    return _to_http_message(
+        delta.metadata, start, delta.stop, delta.data[start - delta.start :])
 
 
@@ -0,0 +1,285 @@
+"""
+Content-addressed storage of immutable blobs in a directory tree.
+"""
+
+import hashlib
+import logging
+import os
+from   pathlib import Path
+import tempfile
+import time
+
+from   .cmpr import BR_CHUNKED
+
+log = logging.getLogger(__name__)
+
+#-------------------------------------------------------------------------------
+
+# Encodings with which blobs may be stored: output compression formats.
+ENCODINGS = ("br", BR_CHUNKED, "gzip", "deflate", "zstd")
+
+
+def new_hash():
+    """
+    Returns a new hash object for computing blob digests.
+    """
+    return hashlib.blake2b(digest_size=20)
+
+
+class BlobStore:
+    """
+    Stores blobs as files, named by the digest of their contents.
+
+    A blob may be stored encoded, for example compressed.  Its digest is then
+    that of the decoded contents, so that identical contents are stored once,
+    however they were encoded.  The encoding is kept as the blob file's
+    extension.
+
+    Files are written to a temporary file and renamed into place, so a blob
+    file is never observed partially written.
+
+    Blobs are never removed as they are stored, as they may be shared, also by
+    archives.  Use `collect()` to remove blobs that are no longer referenced.
+    """
+
+    # Size of chunks for copying data.
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, path, *, encodings=ENCODINGS):
+        """
+        :param path:
+          Path to the directory containing the blob tree.  Created if
+          necessary.
+        :param encodings:
+          Encodings with which blobs may be stored.
+        """
+        self.__path = Path(path)
+        self.__path.mkdir(parents=True, exist_ok=True)
+        self.__encodings = (None, *encodings)
+        self.__num_put = 0
+        self.__num_dup = 0
+        self.__bytes_written = 0
+
+
+    @property
+    def path(self):
+        return self.__path
+
+
+    def get_path(self, digest, encoding=None) -> Path:
+        """
+        Returns the path to the file for blob `digest` stored with `encoding`.
+        """
+        name = digest if encoding is None else f"{digest}.{encoding}"
+        return self.__path / digest[: 2] / name
+
+
+    def __find(self, digest):
+        """
+        Returns the path and encoding of blob `digest`, or none if not stored.
+        """
+        for encoding in self.__encodings:
+            path = self.get_path(digest, encoding)
+            if path.exists():
+                return path, encoding
+        return None
+
+
+    def find(self, digest):
+        """
+        Returns the path and encoding of blob `digest`.
+
+        :raise LookupError:
+          No blob `digest`.
+        """
+        if (found := self.__find(digest)) is None:
+            raise LookupError(f"no blob: {digest}")
+        return found
+
+
+    def __check_encoding(self, encoding):
+        if encoding not in self.__encodings:
+            raise ValueError(f"unknown encoding: {encoding}")
+
+
+    def __find_dup(self, digest):
+        """
+        Counts a put of blob `digest`, and returns its path and encoding if it
+        is already stored.
+        """
+        self.__num_put += 1
+        if (found := self.__find(digest)) is not None:
+            self.__num_dup += 1
+            # Mark it as recently used, so `collect()` doesn't remove it before
+            # the caller records its reference.
+            os.utime(found[0])
+        return found
+
+
+    def __store(self, digest, encoding, temp_path, length):
+        """
+        Moves the temporary file at `temp_path` into place for `digest`, unless
+        the blob is already stored.
+
+        :return:
+          The encoding of the stored blob.
+        """
+        if (found := self.__find(digest)) is not None:
+            # Stored concurrently.
+            os.unlink(temp_path)
+            self.__num_dup += 1
+            return found[1]
+        path = self.get_path(digest, encoding)
+        path.parent.mkdir(exist_ok=True)
+        os.replace(temp_path, path)
+        self.__bytes_written += length
+        log.debug(f"stored blob {digest}: {length} bytes {encoding}")
+        return encoding
+
+
+    def put(self, data, *, digest=None, encoding=None):
+        """
+        Stores `data`.
+
+        :param digest:
+          The digest of the decoded data, or none to compute it from `data`.
+          Required if `encoding` is given.
+        :param encoding:
+          The encoding of `data`, or none if not encoded.
+        :return:
+          The blob digest, and the encoding with which the blob is stored,
+          which differs from `encoding` if the blob was already stored with
+          another.
+        """
+        self.__check_encoding(encoding)
+        if digest is None:
+            if encoding is not None:
+                raise ValueError("digest required for encoded data")
+            digest = new_hash()
+            digest.update(data)
+            digest = digest.hexdigest()
+
+        if (found := self.__find_dup(digest)) is not None:
+            return digest, found[1]
+
+        with tempfile.NamedTemporaryFile(dir=self.__path, delete=False) as file:
+            file.write(data)
+        return digest, self.__store(digest, encoding, file.name, len(data))
+
+
+    def put_file(self, file, length=None, *, digest=None, encoding=None):
+        """
+        Stores data read from `file`, starting at its current position.
+
+        :param length:
+          Number of bytes to read, or none to read to end of file.
+        :param digest:
+          The digest of the decoded data, or none to compute it from the data
+          read.  Required if `encoding` is given.  If the blob is already
+          stored, `file` isn't read.
+        :param encoding:
+          The encoding of the data, or none if not encoded.
+        :return:
+          The blob digest, and the encoding with which the blob is stored.
+        """
+        self.__check_encoding(encoding)
+        if digest is None:
+            if encoding is not None:
+                raise ValueError("digest required for encoded data")
+            hash = new_hash()
+        else:
+            if (found := self.__find_dup(digest)) is not None:
+                return digest, found[1]
+            hash = None
+
+        total = 0
+        with tempfile.NamedTemporaryFile(dir=self.__path, delete=False) as out:
+            while length is None or total < length:
+                size = (
+                    self.CHUNK_SIZE if length is None
+                    else min(self.CHUNK_SIZE, length - total)
+                )
+                chunk = file.read(size)
+                if len(chunk) == 0:
+                    break
+                if hash is not None:
+                    hash.update(chunk)
+                out.write(chunk)
+                total += len(chunk)
+
+        if hash is not None:
+            digest = hash.hexdigest()
+            self.__num_put += 1
+        return digest, self.__store(digest, encoding, out.name, total)
+
+
+    def open(self, digest):
+        """
+        Opens blob `digest` for binary reading of its stored, possibly encoded,
+        data.
+
+        :raise LookupError:
+          No blob `digest`.
+        """
+        path, _ = self.find(digest)
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            raise LookupError(f"no blob: {digest}") from None
+
+
+    def read(self, digest) -> bytes:
+        """
+        Returns the stored, possibly encoded, contents of blob `digest`.
+
+        :raise LookupError:
+          No blob `digest`.
+        """
+        with self.open(digest) as file:
+            return file.read()
+
+
+    def collect(self, digests, *, min_age=86400, dry_run=False):
+        """
+        Removes blobs other than `digests`, and leftover temporary files.
+
+        Files modified in the last `min_age` seconds are kept, as they may be
+        in the process of being stored or referenced.
+
+        :param digests:
+          Digests of blobs to keep.
+        :param dry_run:
+          If true, doesn't actually remove anything.
+        :return:
+          The number and total size of files removed.
+        """
+        cutoff = time.time() - min_age
+        num = size = 0
+        for path in self.__path.rglob("*"):
+            if path.is_dir():
+                continue
+            # The digest is the name, without the encoding.  A temporary file,
+            # at the top level, is never kept.
+            digest = path.name.split(".", 1)[0]
+            if path.parent != self.__path and digest in digests:
+                continue
+            st = path.stat()
+            if st.st_mtime > cutoff:
+                continue
+            log.info(f"removing blob {path.name}: {st.st_size} bytes")
+            if not dry_run:
+                path.unlink()
+            num += 1
+            size += st.st_size
+        return num, size
+
+
+    def get_stats(self) -> dict:
+        return {
+            "num_put"       : self.__num_put,
+            "num_dup"       : self.__num_dup,
+            "bytes_written" : self.__bytes_written,
+        }
+
+
+
@@ -1,37 +1,468 @@
 import asyncio
 import brotli
-from   concurrent.futures import ThreadPoolExecutor
+from   concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import gzip
 import logging
+import math
+import multiprocessing
+import os
+import struct
+import time
+import zlib
 
-from   .timing import Timer
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 log = logging.getLogger(__name__)
 
 #-------------------------------------------------------------------------------
 
-async def compress_async(data, compression) -> bytes:
+# Seekable chunked brotli format.  The data is split into frames of fixed
+# uncompressed size, each compressed as an independent brotli stream.  The
+# compressed frames are followed by an index of frame offsets, and a trailer:
+#
+#     frame 0 | frame 1 | ... | frame n-1 | offset 0 | ... | offset n | trailer
+#
+# where offset i is the position of compressed frame i, and offset n that of
+# the index itself.  The trailer contains the uncompressed frame size, the
+# number of frames, and a magic number.  Because the index is at the end, the
+# data can be written in a single pass, and a reader needs only the trailer,
+# the index, and the frames that contain the range it wants.
+
+BR_CHUNKED = "br-chunked"
+
+# Uncompressed size of each frame.
+FRAME_SIZE = 1024 * 1024
+
+_MAGIC = b"apsisbrc"
+_TRAILER = struct.Struct("<QQ8s")
+
+# Shared pool for decompressing frames in parallel.
+_executor = None
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            min(4, os.cpu_count() or 1), thread_name_prefix="decompress")
+    return _executor
+
+
+def choose_compression(compression, length):
+    """
+    Returns the compression to use for storing data of `length` bytes.
+
+    Data larger than one frame is compressed in seekable frames, if these are
+    supported for `compression`.
+    """
+    if compression == "br" and length > FRAME_SIZE:
+        return BR_CHUNKED
+    else:
+        return compression
+
+
+def compress_frames(chunks, *, frame_size=FRAME_SIZE, quality=3):
+    """
+    Compresses data given as an iterable of `chunks` to the chunked format.
+
+    :return:
+      An iterable of compressed chunks.
+    """
+    offsets = []
+    pos = 0
+
+    def frame(data):
+        nonlocal pos
+        offsets.append(pos)
+        data = brotli.compress(data, quality=quality)
+        pos += len(data)
+        return data
+
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        if len(buf) >= frame_size:
+            # Compress all complete frames.
+            end = len(buf) - len(buf) % frame_size
+            with memoryview(buf) as view:
+                for i in range(0, end, frame_size):
+                    yield frame(view[i : i + frame_size])
+            del buf[: end]
+    if len(buf) > 0:
+        yield frame(bytes(buf))
+
+    offsets.append(pos)
+    yield struct.pack(f"<{len(offsets)}Q", *offsets)
+    yield _TRAILER.pack(frame_size, len(offsets) - 1, _MAGIC)
+
+
+def _decompress_all(frames):
+    """
+    Decompresses brotli `frames`, in parallel if there are several.
+    """
+    if len(frames) == 1:
+        return brotli.decompress(frames[0])
+    else:
+        return b"".join(_get_executor().map(brotli.decompress, frames))
+
+
+def read_frames(read, size, start=0, stop=None) -> bytes:
+    """
+    Decompresses part of data in the chunked format.
+
+    Reads and decompresses only the frames that contain the range.
+
+    :param read:
+      Function `read(offset, length)` that returns bytes of compressed data.
+    :param size:
+      The total size of compressed data.
+    :return:
+      Uncompressed data in `[start, stop)`.
+    """
+    frame_size, num_frames, magic = _TRAILER.unpack(
+        read(size - _TRAILER.size, _TRAILER.size))
+    if magic != _MAGIC:
+        raise RuntimeError(f"invalid {BR_CHUNKED} data")
+    index_size = 8 * (num_frames + 1)
+    offsets = struct.unpack(
+        f"<{num_frames + 1}Q",
+        read(size - _TRAILER.size - index_size, index_size)
+    )
+
+    length = num_frames * frame_size  # upper bound
+    stop = length if stop is None else min(stop, length)
+    if stop <= start:
+        return b""
+
+    # Read the frames containing the range all at once.
+    i0 = start // frame_size
+    i1 = min(-(-stop // frame_size), num_frames)
+    base = offsets[i0]
+    with memoryview(read(base, offsets[i1] - base)) as data:
+        data = _decompress_all([
+            data[offsets[i] - base : offsets[i + 1] - base]
+            for i in range(i0, i1)
+        ])
+    start -= i0 * frame_size
+    return data[start : stop - i0 * frame_size]
+
+
+def decompress_frames(data, start=0, stop=None) -> bytes:
+    """
+    Decompresses `data` in the chunked format.
+
+    :return:
+      Uncompressed data in `[start, stop)`.
+    """
+    with memoryview(data) as view:
+        return read_frames(
+            lambda o, n: view[o : o + n], len(data), start, stop)
+
+
+#-------------------------------------------------------------------------------
+
+# Compressions we can produce.
+COMPRESSIONS = {"br", BR_CHUNKED, "deflate", "gzip"} | (
+    set() if zstandard is None else {"zstd"})
+
+# Qualities for each compression, from best to fastest.  We pick a faster one
+# for larger data and when the compression service is backlogged.
+_QUALITIES = {
+    "br"        : (5, 4, 3, 1),
+    BR_CHUNKED  : (5, 4, 3, 1),
+    "deflate"   : (6, 4, 3, 1),
+    "gzip"      : (6, 4, 3, 1),
+    "zstd"      : (6, 3, 2, 1),
+}
+
+# Data sizes at which we step down to the next faster quality.
+_QUALITY_SIZES = (1024 * 1024, 16 * 1024 * 1024, 256 * 1024 * 1024)
+
+def choose_quality(compression, length, backlog=0) -> int:
+    """
+    Chooses the quality for compressing `length` bytes with `compression`.
+
+    :param backlog:
+      Number of steps faster to choose, because of pending work.
+    """
+    qualities = _QUALITIES[compression]
+    step = sum( length >= s for s in _QUALITY_SIZES ) + backlog
+    return qualities[min(step, len(qualities) - 1)]
+
+
+def compress(data, compression, *, quality=None) -> bytes:
     """
     Compresses `data` with `compression`.
+
+    :param quality:
+      Compression quality, or none to choose based on size of `data`.
+    :raise NotImplementedError:
+      `compression` is not available.
     """
     if compression is None:
         return data
+    if compression not in COMPRESSIONS:
+        raise NotImplementedError(f"compression: {compression}")
+    if quality is None:
+        quality = choose_quality(compression, len(data))
+
+    match compression:
+        case "br":
+            return brotli.compress(data, quality=quality)
+        case "br-chunked":
+            return b"".join(compress_frames((data, ), quality=quality))
+        case "deflate":
+            return zlib.compress(data, quality)
+        case "gzip":
+            return gzip.compress(data, compresslevel=quality, mtime=0)
+        case "zstd":
+            return zstandard.ZstdCompressor(level=quality).compress(data)
+
+
+def compress_chunks(chunks, compression, *, quality=3):
+    """
+    Compresses data given as an iterable of `chunks` with `compression`.
+
+    :return:
+      An iterable of compressed chunks.
+    """
+    if compression is None:
+        yield from chunks
 
     elif compression == "br":
+        compressor = brotli.Compressor(quality=quality)
+        for chunk in chunks:
+            if len(res := compressor.process(chunk)) > 0:
+                yield res
+        yield compressor.finish()
+
+    elif compression == BR_CHUNKED:
+        yield from compress_frames(chunks, quality=quality)
+
+    elif compression in ("deflate", "gzip", "zstd"):
+        compressor = (
+            zlib.compressobj(quality) if compression == "deflate"
+            # wbits for gzip header and trailer.
+            else zlib.compressobj(quality, wbits=16 + zlib.MAX_WBITS)
+            if compression == "gzip"
+            else zstandard.ZstdCompressor(level=quality).compressobj()
+            if zstandard is not None
+            else None
+        )
+        if compressor is None:
+            raise NotImplementedError(f"compression: {compression}")
+        for chunk in chunks:
+            if len(res := compressor.compress(chunk)) > 0:
+                yield res
+        yield compressor.flush()
+
+    else:
+        raise NotImplementedError(f"compression: {compression}")
+
+
+def _timed_call(fn, args, kw_args):
+    """
+    Calls `fn`, and returns its result and elapsed time.
+
+    Module-level, so that it can be pickled to a worker process.
+    """
+    start = time.perf_counter()
+    result = fn(*args, **kw_args)
+    return result, time.perf_counter() - start
+
+
+class CompressionService:
+    """
+    Compresses data in a bounded pool of worker threads.
+
+    Brotli and zlib release the GIL while compressing, so threads compress in
+    parallel.  Very large data may instead be compressed in a pool of worker
+    processes, if configured.  Quality is chosen adaptively from the size of
+    data and the number of pending compressions.
+    """
+
+    def __init__(
+            self, *, max_threads=None, max_processes=0,
+            process_min_size=64 * 1024 * 1024
+    ):
+        """
+        :param max_threads:
+          Number of compression threads, or none for one per CPU, up to 4.
+        :param max_processes:
+          Number of compression processes, or 0 to compress only in threads.
+        :param process_min_size:
+          Minimum size of data to compress in a process.
+        """
+        if max_threads is None:
+            max_threads = min(4, os.cpu_count() or 1)
+        self.__max_threads = max_threads
+        self.__max_processes = max_processes
+        self.__process_min_size = process_min_size
+        self.__threads = None
+        self.__processes = None
+
+        # Number of compressions submitted and not complete.
+        self.__pending = 0
+        self.__num = 0
+        self.__num_process = 0
+        self.__num_errors = 0
+        self.__bytes_in = 0
+        self.__bytes_out = 0
+        self.__elapsed = 0
+        self.__latency = 0
+        self.__max_latency = 0
+
+
+    def __get_threads(self):
+        if self.__threads is None:
+            self.__threads = ThreadPoolExecutor(
+                self.__max_threads, thread_name_prefix="compress")
+        return self.__threads
+
+
+    def __get_processes(self):
+        if self.__processes is None:
+            # Don't fork a process with running threads.
+            self.__processes = ProcessPoolExecutor(
+                self.__max_processes,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        return self.__processes
+
+
+    def get_quality(self, compression, length) -> int:
+        """
+        Chooses the quality for compressing `length` bytes now.
+
+        Steps down quality once for each round of compressions queued behind
+        busy workers.
+        """
+        backlog = math.ceil(
+            max(0, self.__pending - self.__max_threads) / self.__max_threads)
+        return choose_quality(compression, length, backlog)
+
+
+    async def __submit(self, executor, fn, *args, length=None, **kw_args):
         loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self.__pending += 1
+        try:
+            result, elapsed = await loop.run_in_executor(
+                executor, _timed_call, fn, args, kw_args)
+        except Exception:
+            self.__num_errors += 1
+            raise
+        finally:
+            self.__pending -= 1
+        latency = time.perf_counter() - start
 
-        with (
-                Timer() as timer,
-                ThreadPoolExecutor(1) as executor
-        ):
-            result = await loop.run_in_executor(
-                executor, lambda: brotli.compress(data, quality=3))
+        self.__num += 1
+        self.__elapsed += elapsed
+        self.__latency += latency
+        self.__max_latency = max(self.__max_latency, latency)
+        if length is not None:
+            self.__bytes_in += length
+        return result, elapsed
+
+
+    async def compress(self, data, compression, *, quality=None) -> bytes:
+        """
+        Compresses `data` with `compression`.
+
+        :param quality:
+          Compression quality, or none to choose adaptively.
+        :raise NotImplementedError:
+          `compression` is not available.
+        """
+        if compression is None:
+            return data
+        if compression not in COMPRESSIONS:
+            raise NotImplementedError(f"compression: {compression}")
+
+        length = len(data)
+        if quality is None:
+            quality = self.get_quality(compression, length)
+        in_process = (
+            self.__max_processes > 0 and length >= self.__process_min_size)
+        executor = (
+            self.__get_processes() if in_process else self.__get_threads())
+        if in_process:
+            self.__num_process += 1
+
+        result, elapsed = await self.__submit(
+            executor, compress, data, compression, quality=quality,
+            length=length
+        )
+        self.__bytes_out += len(result)
         log.debug(
-            f"compressed: {len(data)} → {len(result)} "
-            f"in {timer.elapsed:.3f} s"
+            f"compressed {compression} q{quality}: {length} → {len(result)} "
+            f"in {elapsed:.3f} s"
         )
         return result
 
-    else:
-        raise NotImplementedError(f"compression: {compression}")
+
+    async def run(self, fn, *args, length=None, **kw_args):
+        """
+        Runs `fn`, which compresses data some other way, in a worker thread.
+
+        :param length:
+          The uncompressed length, if known, for stats.
+        :return:
+          The result of `fn`.
+        """
+        result, _ = await self.__submit(
+            self.__get_threads(), fn, *args, length=length, **kw_args)
+        return result
+
+
+    def get_stats(self) -> dict:
+        return {
+            "max_threads"       : self.__max_threads,
+            "max_processes"     : self.__max_processes,
+            "num_pending"       : self.__pending,
+            "num_compressed"    : self.__num,
+            "num_process"       : self.__num_process,
+            "num_errors"        : self.__num_errors,
+            "bytes_in"          : self.__bytes_in,
+            "bytes_out"         : self.__bytes_out,
+            # Total time compressing, and total time including waiting.
+            "elapsed"           : self.__elapsed,
+            "latency"           : self.__latency,
+            "max_latency"       : self.__max_latency,
+            "bytes_per_sec"     : (
+                self.__bytes_in / self.__elapsed if self.__elapsed > 0
+                else None
+            ),
+        }
+
+
+
+_service = None
+
+def get_service() -> CompressionService:
+    """
+    Returns the process-wide compression service.
+    """
+    global _service
+    if _service is None:
+        _service = CompressionService()
+    return _service
+
+
+def set_service(service: CompressionService):
+    """
+    Replaces the process-wide compression service.
+    """
+    global _service
+    _service = service
+
+
+async def compress_async(data, compression) -> bytes:
+    """
+    Compresses `data` with `compression`, using the compression service.
+    """
+    return await get_service().compress(data, compression)
 
 
@@ -0,0 +1,261 @@
+"""
+Minimal Linux inotify bindings, and a recursive directory tree watcher.
+
+Uses ctypes to call the libc inotify functions directly, so there is no
+dependency on an external package or service.
+"""
+
+import asyncio
+import ctypes
+import ctypes.util
+from   collections import namedtuple
+import errno
+import logging
+import os
+from   pathlib import Path
+import struct
+
+log = logging.getLogger(__name__)
+
+#-------------------------------------------------------------------------------
+
+# Event masks, from <sys/inotify.h>.
+IN_ACCESS           = 0x00000001
+IN_MODIFY           = 0x00000002
+IN_ATTRIB           = 0x00000004
+IN_CLOSE_WRITE      = 0x00000008
+IN_CLOSE_NOWRITE    = 0x00000010
+IN_OPEN             = 0x00000020
+IN_MOVED_FROM       = 0x00000040
+IN_MOVED_TO         = 0x00000080
+IN_CREATE           = 0x00000100
+IN_DELETE           = 0x00000200
+IN_DELETE_SELF      = 0x00000400
+IN_MOVE_SELF        = 0x00000800
+IN_UNMOUNT          = 0x00002000
+IN_Q_OVERFLOW       = 0x00004000
+IN_IGNORED          = 0x00008000
+IN_ONLYDIR          = 0x01000000
+IN_DONT_FOLLOW      = 0x02000000
+IN_EXCL_UNLINK      = 0x04000000
+IN_ISDIR            = 0x40000000
+
+IN_CLOEXEC          = 0o2000000
+IN_NONBLOCK         = 0o0004000
+
+_EVENT_HEADER       = struct.Struct("iIII")
+
+Event = namedtuple("Event", ("wd", "mask", "cookie", "name"))
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library("c") or "libc.so.6"
+        libc = ctypes.CDLL(name, use_errno=True)
+        try:
+            libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, "inotify not available") from None
+        _libc = libc
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify:
+    """
+    An inotify instance.
+
+    The file descriptor is nonblocking; use `fileno()` with a selector or event
+    loop reader, and call `read()` when it is readable.
+    """
+
+    def __init__(self):
+        self.__libc = _get_libc()
+        self.__fd = _check(self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+
+    def fileno(self):
+        return self.__fd
+
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+
+    def add_watch(self, path, mask) -> int:
+        """
+        Adds or modifies a watch on `path`.
+
+        :return:
+          The watch descriptor.
+        """
+        return _check(self.__libc.inotify_add_watch(
+            self.__fd, os.fsencode(path), ctypes.c_uint32(mask)))
+
+
+    def rm_watch(self, wd):
+        _check(self.__libc.inotify_rm_watch(self.__fd, wd))
+
+
+    def read(self, size=65536):
+        """
+        Reads available events, without blocking.
+
+        :return:
+          A list of `Event`, possibly empty.
+        """
+        try:
+            buf = os.read(self.__fd, size)
+        except BlockingIOError:
+            return []
+
+        events = []
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, pos)
+            pos += _EVENT_HEADER.size
+            name = buf[pos : pos + length].rstrip(b"\0")
+            pos += length
+            events.append(Event(wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+
+
+#-------------------------------------------------------------------------------
+
+class TreeWatcher:
+    """
+    Watches a directory tree recursively, and accumulates the paths of files
+    and directories that have changed.
+
+    Directories created in the tree are watched as they appear.  A directory
+    that is created or moved into the tree is reported as a dirty path itself;
+    the consumer is responsible for scanning it.
+    """
+
+    FILE_MASK = (
+          IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+        | IN_MOVE_SELF
+        | IN_ONLYDIR
+        | IN_EXCL_UNLINK
+    )
+
+    def __init__(self, path):
+        self.__path     = Path(path)
+        self.__inotify  = None
+        self.__dirs     = {}
+        self.__dirty    = set()
+        # True if we dropped events, and the consumer must rescan everything.
+        self.__overflow = False
+        self.__ready    = asyncio.Event()
+
+
+    @property
+    def path(self):
+        return self.__path
+
+
+    def __add_tree(self, path):
+        for dir, _, _ in os.walk(path):
+            try:
+                wd = self.__inotify.add_watch(dir, self.FILE_MASK)
+            except FileNotFoundError:
+                # Gone already.
+                continue
+            self.__dirs[wd] = Path(dir)
+
+
+    def start(self):
+        """
+        Starts watching the tree.
+
+        :raise OSError:
+          inotify is not available.
+        """
+        assert self.__inotify is None
+        self.__inotify = Inotify()
+        self.__add_tree(self.__path)
+        asyncio.get_running_loop().add_reader(
+            self.__inotify.fileno(), self.__on_readable)
+        log.info(f"watching {len(self.__dirs)} dirs under {self.__path}")
+
+
+    def stop(self):
+        if self.__inotify is not None:
+            asyncio.get_running_loop().remove_reader(self.__inotify.fileno())
+            self.__inotify.close()
+            self.__inotify = None
+            self.__dirs.clear()
+
+
+    def __on_readable(self):
+        for event in self.__inotify.read():
+            if event.mask & IN_Q_OVERFLOW:
+                log.warning(f"inotify queue overflow: {self.__path}")
+                self.__overflow = True
+                continue
+
+            if event.mask & IN_IGNORED:
+                # The watch was removed, explicitly or because the dir is gone.
+                self.__dirs.pop(event.wd, None)
+                continue
+
+            try:
+                dir = self.__dirs[event.wd]
+            except KeyError:
+                continue
+
+            if event.mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                self.__dirty.add(dir)
+                continue
+
+            path = dir / event.name
+            if event.mask & IN_ISDIR and event.mask & (IN_CREATE | IN_MOVED_TO):
+                # Watch the new subtree.
+                self.__add_tree(path)
+            elif event.mask & IN_CREATE:
+                # A new file; wait for it to be written and closed.
+                continue
+            self.__dirty.add(path)
+
+        if self.__overflow or len(self.__dirty) > 0:
+            self.__ready.set()
+
+
+    async def wait(self, delay=0):
+        """
+        Waits for changes.
+
+        After the first change, waits an additional `delay` to allow related
+        changes to accumulate.
+
+        :return:
+          The set of dirty paths, or none if events were lost and the entire
+          tree must be rescanned.
+        """
+        await self.__ready.wait()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        self.__ready.clear()
+        dirty, self.__dirty = self.__dirty, set()
+        overflow, self.__overflow = self.__overflow, False
+        return None if overflow else dirty
+
+
+
@@ -1,7 +1,10 @@
 import contextlib
+import hashlib
+import json
 from   typing import Mapping
 
 from   apsis.exc import SchemaError
+from   . import memo
 from   .imp import import_fqname, get_type_fqname
 
 #------------------------------------------------------------------------------
@@ -126,6 +129,20 @@ def ifkey(name, value, default):
     return {} if value == default else {name: value}
 
 
+def fingerprint_jso(jso) -> str:
+    """
+    Computes a stable content fingerprint of a JSO.
+
+    The fingerprint is a hash of the canonical JSON encoding of `jso`, with
+    sorted keys, so two JSOs that compare equal have the same fingerprint.
+    """
+    data = json.dumps(
+        jso, sort_keys=True, separators=(",", ":"), ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
 #-------------------------------------------------------------------------------
 
 class TypedJso:
@@ -217,8 +234,22 @@ class TypedJso:
         }
 
 
+    @memo.property
+    def fingerprint(self) -> str:
+        """
+        Stable content fingerprint of the JSO representation.
+
+        Computed on first use and cached; instances must not be modified
+        after the fingerprint has been computed.
+        """
+        return fingerprint_jso(self.to_jso())
+
+
     def __eq__(self, other):
-        return type(other) == type(self) and other.to_jso() == self.to_jso()
+        return (
+                type(other) == type(self)
+            and other.fingerprint == self.fingerprint
+        )
 
 
 
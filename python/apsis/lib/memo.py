@@ -1,3 +1,4 @@
+from   collections import OrderedDict
 import functools
 
 #-------------------------------------------------------------------------------
@@ -29,6 +30,65 @@ def memoize(fn):
 
 
 
+class LRUMemo:
+    """
+    Memo mapping that retains at most `maxsize` most recently used items.
+
+    For use with `memoize_with`.  Tracks hit and miss counts.
+    """
+
+    def __init__(self, maxsize):
+        assert maxsize > 0
+        self.maxsize    = maxsize
+        self.hits       = 0
+        self.misses     = 0
+        self.__items    = OrderedDict()
+
+
+    def __len__(self):
+        return len(self.__items)
+
+
+    def __getitem__(self, key):
+        try:
+            value = self.__items[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.__items.move_to_end(key)
+        self.hits += 1
+        return value
+
+
+    def __setitem__(self, key, value):
+        self.__items[key] = value
+        self.__items.move_to_end(key)
+        while len(self.__items) > self.maxsize:
+            self.__items.popitem(last=False)
+
+
+    def clear(self):
+        self.__items.clear()
+
+
+    def get_stats(self) -> dict:
+        return {
+            "size"      : len(self.__items),
+            "maxsize"   : self.maxsize,
+            "hits"      : self.hits,
+            "misses"    : self.misses,
+        }
+
+
+
+def memoize_lru(maxsize):
+    """
+    Memoizes with a new `LRUMemo` bounded to `maxsize` items.
+    """
+    return memoize_with(LRUMemo(maxsize))
+
+
+
 class property:
     """
     Simplified version of Python 3.8 `functools.cached_property`.
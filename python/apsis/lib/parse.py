@@ -62,3 +62,87 @@ def parse_duration(string) -> float:
 nparse_duration = or_none(parse_duration)
 
 
+_SIZE_UNITS = {
+    unit: mult
+    for units, mult in [
+            (("B", "b", "byte", "bytes"),                       1),
+            (("k", "K", "kB", "KB", "KiB"),                  1024),
+            (("M", "MB", "MiB"),                          1024 ** 2),
+            (("G", "GB", "GiB"),                          1024 ** 3),
+    ]
+    for unit in units
+}
+
+def parse_size(string) -> int:
+    """
+    Parses a size to bytes.
+
+    Accepts a number of bytes, or a number with a unit, such as "16 MB".  Units
+    are binary: 1 KB is 1024 bytes.
+
+    :raise ValueError:
+      Can't parse `string` as a size.
+    """
+    string = str(string)
+
+    try:
+        return int(string)
+    except (TypeError, ValueError):
+        pass
+
+    match = _DURATION_RE.match(string)
+    if match is None:
+        raise ValueError(f"can't parse as size: {string}")
+    res = float(match.group(1))
+    unit = match.group(2)
+    try:
+        res *= _SIZE_UNITS[unit]
+    except KeyError:
+        raise ValueError(
+            f"can't parse as size: {string}: unknown unit {unit}"
+        ) from None
+    return int(res)
+
+
+nparse_size = or_none(parse_size)
+
+
+def parse_range(header, length):
+    """
+    Parses an HTTP `Range` header for a single byte range.
+
+    :param header:
+      The header value, or none.
+    :param length:
+      The length of the full content.
+    :return:
+      The `start, stop` of the range, or none if the header is absent or not a
+      single byte range, in which case the full content should be sent.
+    :raise ValueError:
+      The range is not satisfiable.
+    """
+    if header is None:
+        return None
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header)
+    if match is None:
+        return None
+    first, last = match.groups()
+
+    if first == "":
+        if last == "":
+            return None
+        # A suffix range.
+        start = max(length - int(last), 0)
+        stop = length if int(last) > 0 else start
+    else:
+        start = int(first)
+        stop = length if last == "" else min(int(last) + 1, length)
+        if last != "" and stop <= start and start < length:
+            # Last before first is invalid; ignore the range.
+            return None
+
+    if start >= stop:
+        raise ValueError(f"range not satisfiable: {header}")
+    return start, stop
+
+
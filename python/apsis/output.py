@@ -1,43 +1,587 @@
+import asyncio
+from   concurrent.futures import ThreadPoolExecutor
+import functools
 import logging
+import mmap
+import os
+import struct
+import tempfile
 
-from   .program import Output
+from   .lib.api import decompress
+from   .lib.blob import new_hash
+from   .lib.cmpr import (
+    BR_CHUNKED, choose_compression, compress_chunks, decompress_frames,
+    get_service)
+from   .lib.timing import Timer
+from   .program import Output, OutputBuffer, OutputDelta
 
 log = logging.getLogger(__name__)
 
 #-------------------------------------------------------------------------------
 
-# Implementation notes: We call `write()` only on _running_ runs, as many times
-# as necessary; this caches the output to memory only.  We assume the running
-# program can retrieve the entire output if necessaary.  Once the run
-# terminates, a single call to `write_through()` commits the output to the
-# database.
+# Implementation notes: We call `write()` or `write_delta()` only on _running_
+# runs, as many times as necessary; this caches the output to memory only.  We
+# assume the running program can retrieve the entire output if necessaary.  Once
+# the run terminates, a single call to `write_through()` or `commit()` commits
+# the output to the database.
+#
+# A running output is held in memory until it exceeds the per-run memory
+# budget, or the total of running outputs exceeds the global budget.  At that
+# point, it is spilled to an unlinked temporary file, to which further data is
+# appended.  Spilled outputs are read with `mmap`.
+
+# Size of chunks for streaming output data.
+CHUNK_SIZE = 1024 * 1024
+
+def _skip_lines(data, count, pos=0):
+    """
+    Returns the offset in `data` after `count` more newlines from `pos`, or the
+    end of `data` if there are fewer.
+    """
+    for _ in range(count):
+        pos = data.find(b"\n", pos) + 1
+        if pos == 0:
+            return len(data)
+    return pos
+
+
+class LineIndex:
+    """
+    Sparse index of line offsets in output data.
+
+    Records the offset of the start of every `interval`th line, so that a range
+    of lines can be found by reading at most about `interval` extra lines.
+    """
+
+    # Default number of lines between index entries.
+    INTERVAL = 1024
+
+    _HEADER = struct.Struct("<QQQQ")
+
+    def __init__(self, interval=INTERVAL):
+        self.interval       = interval
+        # Offsets of the starts of lines 0, interval, 2 * interval, ...
+        self.offsets        = [0]
+        # Number of bytes indexed.
+        self.length         = 0
+        self.num_newlines   = 0
+        # Offset after the last newline.
+        self.last_end       = 0
+
+
+    @property
+    def num_lines(self):
+        """
+        The number of lines, including a final line without a newline.
+        """
+        return self.num_newlines + (self.last_end < self.length)
+
+
+    def append(self, data):
+        """
+        Indexes `data`, appended to the end of the output.
+        """
+        count = data.count(b"\n")
+        if count > 0:
+            # Record the start of each line at a multiple of the interval.
+            pos = 0
+            newlines = self.num_newlines
+            while (
+                    (target := len(self.offsets) * self.interval)
+                    <= self.num_newlines + count
+            ):
+                pos = _skip_lines(data, target - newlines, pos)
+                newlines = target
+                self.offsets.append(self.length + pos)
+            self.num_newlines += count
+            self.last_end = self.length + data.rindex(b"\n") + 1
+        self.length += len(data)
+
+
+    def get_byte_range(self, start, stop):
+        """
+        Returns a byte range that contains lines `[start, stop)`.
+
+        :return:
+          The line number at which the range starts, which may be before
+          `start`, and the byte range.
+        """
+        i = start // self.interval
+        if i >= len(self.offsets):
+            # Past the last indexed line, so past the end; empty at EOF.
+            return start, self.length, self.length
+        j = -(-stop // self.interval)
+        return (
+            i * self.interval,
+            self.offsets[i],
+            self.offsets[j] if j < len(self.offsets) else self.length,
+        )
+
+
+    def to_bytes(self) -> bytes:
+        return self._HEADER.pack(
+            self.interval, self.length, self.num_newlines, self.last_end
+        ) + struct.pack(f"<{len(self.offsets)}Q", *self.offsets)
+
+
+    @classmethod
+    def from_bytes(cls, data):
+        interval, length, num_newlines, last_end = cls._HEADER.unpack_from(data)
+        index = cls(interval)
+        index.length = length
+        index.num_newlines = num_newlines
+        index.last_end = last_end
+        index.offsets = list(struct.unpack_from(
+            f"<{(len(data) - cls._HEADER.size) // 8}Q", data, cls._HEADER.size))
+        return index
+
+
+
+class OutputLines:
+    """
+    A range of lines of output.
+    """
+
+    def __init__(self, metadata, start, stop, num_lines, data):
+        """
+        :param metadata:
+          Information about the entire output.
+        :param start:
+          Number of the first line.
+        :param stop:
+          Number past the last line.
+        :param num_lines:
+          Total number of lines in the output.
+        :param data:
+          The lines, including newlines.
+        """
+        self.metadata   = metadata
+        self.start      = start
+        self.stop       = stop
+        self.num_lines  = num_lines
+        self.data       = data
+
+
+
+class _LiveOutput:
+    """
+    A running output, held in memory or spilled to a temporary file.
+    """
+
+    def __init__(self, metadata, data=b"", *, line_index=None):
+        self.metadata   = metadata
+        self.length     = len(data)
+        # In-memory data, or none if spilled.
+        self.buffer     = OutputBuffer(data)
+        # Spill file, or none if in memory.
+        self.file       = None
+
+        if line_index is None:
+            line_index = LineIndex()
+        # Index the part of the data not already indexed.
+        line_index.append(data[line_index.length :])
+        self.line_index = line_index
+
+
+    @property
+    def resident(self):
+        return self.length if self.file is None else 0
+
+
+    def append(self, start, data):
+        """
+        Appends `data`, which starts at offset `start` in the output.
+
+        :raise RuntimeError:
+          `start` is past the end of the output.
+        """
+        if self.file is None:
+            data = self.buffer.append(start, data)
+            self.length = len(self.buffer)
+        else:
+            if start > self.length:
+                raise RuntimeError(
+                    f"output data gap: {start} after {self.length}")
+            elif start < self.length:
+                data = data[self.length - start :]
+            self.file.write(data)
+            self.length += len(data)
+        self.line_index.append(data)
+
+
+    def spill(self, dir):
+        """
+        Moves the data from memory to a temporary file in `dir`.
+        """
+        assert self.file is None
+        self.file = tempfile.TemporaryFile(dir=dir, prefix="apsis-output-")
+        self.buffer.write_to(self.file)
+        self.buffer = None
+
+
+    def get(self, start=0, stop=None) -> bytes:
+        """
+        Returns the data in `[start, stop)`.
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        if self.file is None:
+            return self.buffer.get(start, stop)
+        elif stop <= start:
+            return b""
+        else:
+            self.file.flush()
+            with mmap.mmap(
+                    self.file.fileno(), self.length, access=mmap.ACCESS_READ
+            ) as data:
+                return data[start : stop]
+
+
+    def map(self):
+        """
+        Maps the data of a spilled output.
+
+        :return:
+          A read-only `mmap` of the data, which the caller must close.  It
+          remains valid after the output is closed.
+        """
+        assert self.file is not None and self.length > 0
+        self.file.flush()
+        return mmap.mmap(
+            self.file.fileno(), self.length, access=mmap.ACCESS_READ)
+
+
+    def iter_chunks(self):
+        """
+        Generates the data in chunks.
+        """
+        for start in range(0, self.length, CHUNK_SIZE):
+            yield self.get(start, start + CHUNK_SIZE)
+
+
+    def to_output(self) -> Output:
+        return Output(self.metadata, self.get())
+
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+
+def _compress_to_file(live, compression, quality, dir):
+    """
+    Compresses the data of `live` into a new temporary file.
+
+    :return:
+      The file, positioned at the start, the compressed length, and the blob
+      digest of the uncompressed data.
+    """
+    digest = new_hash()
+
+    def chunks():
+        for chunk in live.iter_chunks():
+            digest.update(chunk)
+            yield chunk
+
+    file = tempfile.TemporaryFile(dir=dir, prefix="apsis-output-")
+    for chunk in compress_chunks(chunks(), compression, quality=quality):
+        file.write(chunk)
+    length = file.tell()
+    file.seek(0)
+    return file, length, digest.hexdigest()
+
+
+class OutputIndexer:
+    """
+    Indexes finished outputs for full-text search, in the background.
+
+    Outputs are indexed one at a time in a single worker thread with its own
+    database connection, so indexing uses at most one CPU and doesn't block
+    the event loop.
+    """
+
+    def __init__(self, search_db):
+        self.__search_db = search_db
+        self.__queue = asyncio.Queue()
+        self.__executor = ThreadPoolExecutor(
+            1, thread_name_prefix="output-index")
+        # Connection, used only in the worker thread.
+        self.__connection = None
+
+        self.__num_indexed = 0
+        self.__num_errors = 0
+        self.__bytes_indexed = 0
+        self.__elapsed = 0
+
+
+    def submit(self, run_id, output_id):
+        """
+        Schedules an output for indexing.
+        """
+        self.__queue.put_nowait((run_id, output_id))
+
+
+    def __index(self, run_id, output_id):
+        # Runs in the worker thread.
+        if self.__connection is None:
+            self.__connection = self.__search_db.connect()
+        return self.__search_db.index_output(
+            self.__connection, run_id, output_id)
+
+
+    async def loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            run_id, output_id = await self.__queue.get()
+            try:
+                with Timer() as timer:
+                    length = await loop.run_in_executor(
+                        self.__executor, self.__index, run_id, output_id)
+            except Exception:
+                log.error(
+                    f"failed to index output {run_id} {output_id}",
+                    exc_info=True
+                )
+                self.__num_errors += 1
+            else:
+                log.debug(
+                    f"indexed output {run_id} {output_id}: "
+                    f"{length} bytes in {timer.elapsed:.3f} s"
+                )
+                self.__num_indexed += 1
+                self.__bytes_indexed += length
+                self.__elapsed += timer.elapsed
+
+
+    def search(self, query, *, job_id=None, since=None, limit=100):
+        return self.__search_db.search(
+            query, job_id=job_id, since=since, limit=limit)
+
+
+    def get_stats(self) -> dict:
+        return {
+            "num_queued"        : self.__queue.qsize(),
+            "num_indexed"       : self.__num_indexed,
+            "num_errors"        : self.__num_errors,
+            "bytes_indexed"     : self.__bytes_indexed,
+            "elapsed"           : self.__elapsed,
+        }
+
+
 
 class OutputStore:
     """
     In-memory cache of outputs, backed by persistent output database.
     """
 
-    def __init__(self, output_db):
+    def __init__(
+            self, output_db, *, run_max=None, total_max=None, spill_dir=None,
+            indexer=None
+    ):
+        """
+        :param run_max:
+          Maximum bytes of a single running output to hold in memory, or none
+          for no limit.
+        :param total_max:
+          Maximum bytes of all running outputs to hold in memory, or none for
+          no limit.
+        :param spill_dir:
+          Directory in which to create temporary files for spilled outputs.  If
+          none, uses the system temporary directory.
+        :param indexer:
+          An `OutputIndexer` to which to submit outputs when they are written
+          through, or none.
+        """
         self.__outputs = {}
         self.__output_db = output_db
+        self.__run_max = run_max
+        self.__total_max = total_max
+        self.__spill_dir = None if spill_dir is None else os.fspath(spill_dir)
+        self.__indexer = indexer
+        # Total bytes of cached outputs held in memory.
+        self.__resident = 0
+        # Outputs are written from files in a worker thread, with its own
+        # database connection, used only in the worker thread.
+        self.__executor = ThreadPoolExecutor(
+            1, thread_name_prefix="output-commit")
+        self.__connection = None
 
 
-    def write(self, run_id: str, output_id: str, output: Output):
-        self.__outputs.setdefault(run_id, {})[output_id] = output
+    def __upsert_file(self, *args, **kw_args):
+        # Runs in the worker thread.
+        if self.__connection is None:
+            self.__connection = self.__output_db.connect()
+        self.__output_db.upsert_file(*args, con=self.__connection, **kw_args)
 
 
-    def write_through(self, run_id: str, output_id: str, output: Output):
-        # Remove from the cache.
+    def __remove(self, run_id, output_id):
         try:
-            del (outputs := self.__outputs[run_id])[output_id]
+            output = (outputs := self.__outputs[run_id]).pop(output_id)
         except KeyError:
-            pass
+            return
+        if len(outputs) == 0:
+            del self.__outputs[run_id]
+        if isinstance(output, _LiveOutput):
+            self.__resident -= output.resident
+            output.close()
+        else:
+            self.__resident -= len(output.data)
+
+
+    def __spill(self, live):
+        self.__resident -= live.resident
+        live.spill(self.__spill_dir)
+        log.debug(f"spilled output: {live.length} bytes")
+
+
+    def __enforce_budget(self, live):
+        """
+        Spills `live`, and then other outputs, as needed for the memory budget.
+        """
+        if (
+                live.file is None
+                and self.__run_max is not None
+                and live.length > self.__run_max
+        ):
+            self.__spill(live)
+
+        if self.__total_max is not None and self.__resident > self.__total_max:
+            # Spill the largest in-memory outputs first.
+            lives = sorted(
+                (
+                    o
+                    for outputs in self.__outputs.values()
+                    for o in outputs.values()
+                    if isinstance(o, _LiveOutput) and o.file is None
+                ),
+                key=lambda o: o.length,
+                reverse=True,
+            )
+            for live in lives:
+                if self.__resident <= self.__total_max:
+                    break
+                self.__spill(live)
+
+
+    def write(self, run_id: str, output_id: str, output: Output):
+        # Output only grows, so continue the line index of the previous data.
+        prev = self.__outputs.get(run_id, {}).get(output_id)
+        line_index = (
+            prev.line_index
+            if isinstance(prev, _LiveOutput)
+            and prev.line_index.length <= len(output.data)
+            and output.metadata.total_length is None
+            else None
+        )
+
+        self.__remove(run_id, output_id)
+        if output.compression is None:
+            live = _LiveOutput(
+                output.metadata, output.data, line_index=line_index)
+            self.__outputs.setdefault(run_id, {})[output_id] = live
+            self.__resident += live.resident
+            self.__enforce_budget(live)
         else:
-            if len(outputs) == 0:
-                del self.__outputs[run_id]
+            self.__outputs.setdefault(run_id, {})[output_id] = output
+            self.__resident += len(output.data)
+
+
+    def write_delta(self, run_id: str, output_id: str, delta: OutputDelta):
+        """
+        Appends data in `delta` to a running output.
+        """
+        outputs = self.__outputs.setdefault(run_id, {})
+        live = outputs.get(output_id)
+        if not isinstance(live, _LiveOutput):
+            # A compressed output can't be appended to; start over.
+            self.__remove(run_id, output_id)
+            outputs = self.__outputs.setdefault(run_id, {})
+            live = outputs[output_id] = _LiveOutput(delta.metadata)
+
+        resident = live.resident
+        live.append(delta.start, delta.data)
+        live.metadata = delta.metadata
+        self.__resident += live.resident - resident
+        self.__enforce_budget(live)
+
+
+    def write_through(self, run_id: str, output_id: str, output: Output):
+        # Keep the line index, if it covers the output.
+        prev = self.__outputs.get(run_id, {}).get(output_id)
+        line_index = (
+            prev.line_index.to_bytes()
+            if isinstance(prev, _LiveOutput)
+            and prev.line_index.length == output.metadata.length
+            # A truncated output isn't the running output.
+            and output.metadata.total_length is None
+            else None
+        )
+
+        # Remove from the cache.
+        self.__remove(run_id, output_id)
 
         # Write to the DB.
-        self.__output_db.upsert(run_id, output_id, output)
+        self.__output_db.upsert(
+            run_id, output_id, output, line_index=line_index)
+        if self.__indexer is not None:
+            self.__indexer.submit(run_id, output_id)
+
+
+    async def commit(self, run_id, *, compression="br", min_size=16384):
+        """
+        Writes through all running outputs for `run_id` remaining in the cache.
+
+        Streams each output, compressed with `compression` if at least
+        `min_size` bytes, into the database.  Outputs larger than one
+        compression frame are compressed in seekable chunks.  Compressing and
+        writing these run in worker threads; until written, the output is
+        served from the cache.
+        """
+        for output_id, output in list(self.__outputs.get(run_id, {}).items()):
+            if not isinstance(output, _LiveOutput):
+                self.write_through(run_id, output_id, output)
+
+            elif compression is None or output.length < min_size:
+                self.write_through(run_id, output_id, output.to_output())
+
+            else:
+                cmpr = choose_compression(compression, output.length)
+                service = get_service()
+                quality = service.get_quality(cmpr, output.length)
+                with Timer() as timer:
+                    file, length, digest = await service.run(
+                        _compress_to_file, output, cmpr, quality,
+                        self.__spill_dir, length=output.length
+                    )
+                log.debug(
+                    f"compressed {cmpr} q{quality}: {output.length} → {length} "
+                    f"in {timer.elapsed:.3f} s"
+                )
+                with file, Timer() as timer:
+                    await asyncio.get_running_loop().run_in_executor(
+                        self.__executor, functools.partial(
+                            self.__upsert_file,
+                            run_id, output_id, output.metadata, file, length,
+                            compression=cmpr, digest=digest,
+                            line_index=output.line_index.to_bytes(),
+                        )
+                    )
+                log.debug(
+                    f"wrote {run_id} {output_id}: {length} bytes "
+                    f"in {timer.elapsed:.3f} s"
+                )
+                self.__remove(run_id, output_id)
+                if self.__indexer is not None:
+                    self.__indexer.submit(run_id, output_id)
+
+
+    def discard(self, run_id):
+        """
+        Drops any cached outputs for `run_id`, without writing them.
+        """
+        for output_id in list(self.__outputs.get(run_id, {})):
+            self.__remove(run_id, output_id)
 
 
     def get_metadata(self, run_id):
@@ -53,16 +597,183 @@ class OutputStore:
 
     def get_output(self, run_id, output_id) -> Output:
         try:
-            return self.__outputs[run_id][output_id]
+            output = self.__outputs[run_id][output_id]
         except KeyError:
             return self.__output_db.get_output(run_id, output_id)
+        else:
+            return (
+                output.to_output() if isinstance(output, _LiveOutput)
+                else output
+            )
+
+
+    def map_output(self, run_id, output_id):
+        """
+        Maps the data of a running output that is spilled to a file, so that it
+        can be read without loading it into memory.
+
+        :return:
+          The output metadata, and a read-only `mmap` of its uncompressed data,
+          which the caller must close; or none if the output isn't a spilled
+          running output.
+        """
+        output = self.__outputs.get(run_id, {}).get(output_id)
+        if (
+                isinstance(output, _LiveOutput)
+                and output.file is not None
+                and output.length > 0
+        ):
+            return output.metadata, output.map()
+        else:
+            return None
+
+
+    def get_output_blob(self, run_id, output_id):
+        """
+        Returns the blob file for an output, if it is committed to the blob
+        store.
+
+        :return:
+          The output metadata, compression, and path to the file containing
+          its stored data; or none if the output is not in the blob store.
+        :raise LookupError:
+          No output for `run_id, output_id`.
+        """
+        if output_id in self.__outputs.get(run_id, {}):
+            return None
+        else:
+            return self.__output_db.get_output_blob(run_id, output_id)
+
+
+    def get_output_range(self, run_id, output_id, start=0, stop=None):
+        """
+        Returns uncompressed output data in `[start, stop)`.
+
+        :return:
+          An `OutputDelta` with the data.
+        :raise LookupError:
+          No output for `run_id, output_id`.
+        """
+        try:
+            output = self.__outputs[run_id][output_id]
+        except KeyError:
+            # Not in cache; read only the range from the database.
+            return self.__output_db.get_output_range(
+                run_id, output_id, start, stop)
+
+        length = output.metadata.length
+        start = min(start, length)
+        stop = length if stop is None else max(start, min(stop, length))
+        if isinstance(output, _LiveOutput):
+            data = output.get(start, stop)
+        elif output.compression == BR_CHUNKED:
+            data = decompress_frames(output.data, start, stop)
+        else:
+            data = decompress(output.data, output.compression)[start : stop]
+        return OutputDelta(output.metadata, start, data)
+
+
+    def __get_line_index(self, run_id, output_id):
+        try:
+            output = self.__outputs[run_id][output_id]
+        except KeyError:
+            pass
+        else:
+            if isinstance(output, _LiveOutput):
+                return output.line_index
+            else:
+                line_index = LineIndex()
+                line_index.append(output.get_uncompressed_data())
+                return line_index
+
+        data = self.__output_db.get_line_index(run_id, output_id)
+        if data is None:
+            # Stored without a line index; build it, and store it for later.
+            line_index = LineIndex()
+            with Timer() as timer:
+                for chunk in self.__output_db.iter_output_data(
+                        run_id, output_id):
+                    line_index.append(chunk)
+            log.debug(
+                f"built line index for {run_id} {output_id}: "
+                f"{line_index.length} bytes in {timer.elapsed:.3f} s"
+            )
+            self.__output_db.upsert_line_index(
+                run_id, output_id, line_index.to_bytes())
+            return line_index
+        else:
+            return LineIndex.from_bytes(data)
+
+
+    def get_output_lines(
+            self, run_id, output_id, start=0, stop=None, *, tail=None
+    ) -> OutputLines:
+        """
+        Returns lines `[start, stop)` of uncompressed output data.
+
+        Reads only the part of the output containing these lines.
+
+        :param tail:
+          If not none, returns the last `tail` lines instead.
+        :raise LookupError:
+          No output for `run_id, output_id`.
+        """
+        line_index = self.__get_line_index(run_id, output_id)
+        num_lines = line_index.num_lines
+        if tail is None:
+            stop = num_lines if stop is None else min(stop, num_lines)
+            start = min(start, stop)
+        else:
+            start, stop = max(num_lines - tail, 0), num_lines
+
+        first, byte_start, byte_stop = line_index.get_byte_range(start, stop)
+        delta = self.get_output_range(run_id, output_id, byte_start, byte_stop)
+        i = _skip_lines(delta.data, start - first)
+        j = _skip_lines(delta.data, stop - start, i)
+        return OutputLines(
+            delta.metadata, start, stop, num_lines, delta.data[i : j])
+
+
+    @property
+    def indexer(self):
+        return self.__indexer
+
+
+    def search(self, query, *, job_id=None, since=None, limit=100):
+        """
+        Searches the full text of finished outputs.
+
+        :raise RuntimeError:
+          Output search is not enabled.
+        :raise ValueError:
+          The query is invalid.
+        """
+        if self.__indexer is None:
+            raise RuntimeError("output search not enabled")
+        return self.__indexer.search(
+            query, job_id=job_id, since=since, limit=limit)
 
 
     def get_stats(self) -> dict:
         assert all( len(o) > 0 for o in self.__outputs.values() )
-        num = sum( len(o) for o in self.__outputs.values() )
+        outputs = [ o for r in self.__outputs.values() for o in r.values() ]
+        spilled = [
+            o for o in outputs
+            if isinstance(o, _LiveOutput) and o.file is not None
+        ]
         return {
-            "num_cached": num,
+            "num_cached"        : len(outputs),
+            "num_spilled"       : len(spilled),
+            "resident_bytes"    : self.__resident,
+            "spilled_bytes"     : sum( o.length for o in spilled ),
+            "blobs"             : (
+                None if (blobs := self.__output_db.blobs) is None
+                else blobs.get_stats()
+            ),
+            "index"             : (
+                None if self.__indexer is None
+                else self.__indexer.get_stats()
+            ),
         }
 
 
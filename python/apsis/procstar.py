@@ -2,8 +2,15 @@
 The global WebSocket server that accepts incoming Procstar agent connections.
 """
 
+import asyncio
+from   collections import Counter
 import logging
 import procstar.agent.server
+from   procstar.agent.conn import (
+    NotConnectedError, ShutdownState, WebSocketNotOpen, choose_connection)
+from   procstar.proto import ProcStartRequest
+import random
+import time
 
 from   apsis.lib.parse import nparse_duration
 from   apsis.service import messages
@@ -34,16 +41,26 @@ def get_agent_server():
     return _SERVER
 
 
-def start_agent_server(cfg):
+def start_agent_server(cfg, *, get_job_id=None):
     """
     Creates and configures the global agent server.
 
+    :param get_job_id:
+      Function that returns the job ID of a run ID, for run placement.
     :return:
       Awaitable that runs the server.
     """
-    global _SERVER
+    global _SERVER, _PLACEMENT, _POLLER
     assert _SERVER is None, "server already created"
 
+    placement_cfg = cfg.get("placement", {})
+    _PLACEMENT = Placement(
+        placement_cfg.get("policy", None),
+        capacities  =placement_cfg.get("capacities", {}),
+        get_job_id  =get_job_id,
+    )
+    _POLLER = Poller(jitter=cfg.get("run", {}).get("poll_jitter", 0.1))
+
     # Network/auth stuff.
     FROM_ENV    = procstar.agent.server.FROM_ENV
     server_cfg  = cfg.get("server", {})
@@ -73,6 +90,344 @@ def start_agent_server(cfg):
     return run_forever()
 
 
+#-------------------------------------------------------------------------------
+
+def _get_open_conns(server, group_id):
+    """
+    Returns open, active connections in `group_id`.
+    """
+    conn_ids = server.connections.groups.get(group_id, ())
+    conns = ( server.connections[i] for i in conn_ids )
+    return [
+        c for c in conns
+        if c.open and c.shutdown_state == ShutdownState.active
+    ]
+
+
+class Placement:
+    """
+    Apsis-side placement of runs on Procstar connections.
+
+    Indexes running runs by the connection they run on, and chooses a
+    connection in a group for each new run, by policy:
+
+    - `least-runs`: the connection with the fewest runs.
+    - `weighted`: the connection with the fewest runs relative to its capacity.
+      Capacities are configured by conn ID or hostname, and default to 1.
+    - `spread-by-job`: the connection with the fewest runs of the same job,
+      then with the fewest runs.
+
+    Ties are broken randomly.  With no policy, Procstar chooses a connection at
+    random.
+    """
+
+    POLICIES = {"least-runs", "weighted", "spread-by-job"}
+
+    def __init__(self, policy=None, *, capacities={}, get_job_id=None):
+        if policy is not None and policy not in self.POLICIES:
+            raise ValueError(f"unknown placement policy: {policy}")
+        self.policy = policy
+        self.capacities = { k: float(c) for k, c in capacities.items() }
+        self.__get_job_id = get_job_id
+        # Run IDs of running runs on each connection.
+        self.__runs = {}
+        # Number of running runs of each job on each connection.
+        self.__jobs = {}
+
+
+    def __job_id(self, run_id):
+        try:
+            return self.__get_job_id(run_id)
+        except (TypeError, LookupError):
+            return None
+
+
+    def add(self, conn_id, run_id):
+        """
+        Adds `run_id` as running on `conn_id`.
+        """
+        runs = self.__runs.setdefault(conn_id, {})
+        if run_id not in runs:
+            runs[run_id] = job_id = self.__job_id(run_id)
+            self.__jobs.setdefault(conn_id, Counter())[job_id] += 1
+
+
+    def remove(self, conn_id, run_id):
+        """
+        Removes `run_id` as running on `conn_id`, if it is.
+        """
+        runs = self.__runs.get(conn_id, {})
+        try:
+            job_id = runs.pop(run_id)
+        except KeyError:
+            return
+        jobs = self.__jobs[conn_id]
+        jobs[job_id] -= 1
+        if jobs[job_id] <= 0:
+            del jobs[job_id]
+        if len(runs) == 0:
+            del self.__runs[conn_id]
+            del self.__jobs[conn_id]
+
+
+    def get_num_runs(self, conn_id) -> int:
+        """
+        Returns the number of running runs on `conn_id`.
+        """
+        return len(self.__runs.get(conn_id, ()))
+
+
+    def __get_capacity(self, conn):
+        for key in (conn.conn_id, getattr(conn.info.proc, "hostname", None)):
+            try:
+                return self.capacities[key]
+            except KeyError:
+                pass
+        return 1.0
+
+
+    def choose(self, conns, run_id):
+        """
+        Chooses a connection from `conns` for `run_id`, by policy.
+        """
+        match self.policy:
+            case "least-runs":
+                def key(conn):
+                    return self.get_num_runs(conn.conn_id)
+
+            case "weighted":
+                def key(conn):
+                    # Utilization, including the new run.
+                    runs = self.get_num_runs(conn.conn_id)
+                    return (runs + 1) / self.__get_capacity(conn)
+
+            case "spread-by-job":
+                job_id = self.__job_id(run_id)
+
+                def key(conn):
+                    jobs = self.__jobs.get(conn.conn_id, {})
+                    return jobs.get(job_id, 0), self.get_num_runs(conn.conn_id)
+
+            case _:
+                return random.choice(conns)
+
+        return min(random.sample(conns, len(conns)), key=key)
+
+
+    async def start(
+            self, server, run_id, *, proc_id, group_id, spec, conn_timeout=0):
+        """
+        Starts a proc for `run_id` on a connection in `group_id`, and adds it.
+
+        If sending to the chosen connection fails, because it just dropped,
+        tries the next choice.  If no chosen connection works, lets Procstar
+        choose one, waiting up to `conn_timeout` for one to open.
+
+        :return:
+          The process, and its initial result.
+        :raise NoOpenConnectionInGroup:
+          Timeout waiting for an open connection.
+        """
+        if self.policy is not None:
+            # Wait for at least one open connection.
+            await choose_connection(
+                server.connections, group_id, timeout=conn_timeout)
+
+            failed = set()
+            while len(conns := [
+                    c for c in _get_open_conns(server, group_id)
+                    if c.conn_id not in failed
+            ]) > 0:
+                conn = self.choose(conns, run_id)
+                # Add the run now, so concurrent starts take it into account.
+                self.add(conn.conn_id, run_id)
+                try:
+                    await conn.send(
+                        ProcStartRequest(specs={proc_id: spec.to_jso()}))
+                except (NotConnectedError, WebSocketNotOpen) as exc:
+                    log.warning(f"start on conn {conn.conn_id} failed: {exc}")
+                    self.remove(conn.conn_id, run_id)
+                    failed.add(conn.conn_id)
+                    continue
+
+                try:
+                    proc = server.processes.create(conn, proc_id)
+                    res = await anext(proc.updates)
+                except BaseException:
+                    self.remove(conn.conn_id, run_id)
+                    raise
+                return proc, res
+
+            log.warning(f"no placement in group {group_id}; falling back")
+
+        proc, res = await server.start(
+            proc_id     =proc_id,
+            group_id    =group_id,
+            spec        =spec,
+            conn_timeout=conn_timeout,
+        )
+        self.add(proc.conn_id, run_id)
+        return proc, res
+
+
+
+_PLACEMENT = Placement()
+
+def get_placement():
+    """
+    Returns the global run placement.
+    """
+    return _PLACEMENT
+
+
+#-------------------------------------------------------------------------------
+
+class _PollEntry:
+
+    def __init__(self, proc, update_interval, output_interval, get_output):
+        self.proc = proc
+        self.update_interval = update_interval
+        self.output_interval = output_interval
+        self.get_output = get_output
+        self.last_update = self.last_output = time.monotonic()
+
+
+
+class Poller:
+    """
+    Polls running procs for results and output, batched by connection.
+
+    A single task per connection wakes each tick and sends requests for all of
+    the connection's procs that are due, rather than one timer task per proc
+    and request type.  Each tick is the shortest poll interval of the
+    connection's procs, randomly jittered by up to a fraction `jitter`, so that
+    connections don't poll in lockstep.
+    """
+
+    def __init__(self, *, jitter=0.1):
+        self.jitter = float(jitter)
+        # Mapping from conn ID to mapping from proc ID to poll entry.
+        self.__conns = {}
+        # Poll task for each connection.
+        self.__tasks = {}
+
+        self.__num_ticks = 0
+        self.__num_requests = 0
+        self.__num_skipped = 0
+        self.__num_errors = 0
+
+
+    def add(
+            self, proc, *,
+            update_interval=None, output_interval=None, get_output=None
+    ):
+        """
+        Adds `proc` for polling.
+
+        :param update_interval:
+          Interval at which to request the proc's result, or none.
+        :param output_interval:
+          Interval at which to request the proc's output, or none.
+        :param get_output:
+          Function that returns the interval of stdout to request, or none to
+          skip the request, for example if the output hasn't grown.
+        """
+        if update_interval is None and output_interval is None:
+            return
+        entry = _PollEntry(proc, update_interval, output_interval, get_output)
+        conn_id = proc.conn_id
+        self.__conns.setdefault(conn_id, {})[proc.proc_id] = entry
+        if conn_id not in self.__tasks:
+            self.__tasks[conn_id] = asyncio.get_running_loop().create_task(
+                self.__poll(conn_id, self.__conns[conn_id]))
+
+
+    def remove(self, conn_id, proc_id):
+        """
+        Removes `proc_id` on `conn_id` from polling, if it is polled.
+        """
+        procs = self.__conns.get(conn_id, {})
+        procs.pop(proc_id, None)
+        if len(procs) == 0 and conn_id in self.__conns:
+            del self.__conns[conn_id]
+            self.__tasks.pop(conn_id).cancel()
+
+
+    def __get_tick(self, procs):
+        return min(
+            i
+            for e in procs.values()
+            for i in (e.update_interval, e.output_interval)
+            if i is not None
+        )
+
+
+    def _get_requests(self, procs, now, tick):
+        """
+        Returns coros for requests due at `now` for `procs`.
+        """
+        def due(interval, last):
+            # Treat requests due within half a tick as due now.
+            return interval is not None and now - last >= interval - tick / 2
+
+        coros = []
+        for entry in procs.values():
+            if due(entry.update_interval, entry.last_update):
+                entry.last_update = now
+                coros.append(entry.proc.request_result())
+
+            if due(entry.output_interval, entry.last_output):
+                entry.last_output = now
+                fd_interval = entry.get_output()
+                if fd_interval is None:
+                    self.__num_skipped += 1
+                else:
+                    coros.append(entry.proc.request_fd_data(
+                        "stdout", interval=fd_interval))
+
+        return coros
+
+
+    async def __poll(self, conn_id, procs):
+        # Start at a random offset, to spread out connections.
+        await asyncio.sleep(random.uniform(0, self.__get_tick(procs)))
+
+        while len(procs) > 0:
+            tick = self.__get_tick(procs)
+            coros = self._get_requests(procs, time.monotonic(), tick)
+            self.__num_ticks += 1
+            self.__num_requests += len(coros)
+            for res in await asyncio.gather(*coros, return_exceptions=True):
+                if isinstance(res, Exception):
+                    # The proc's run handles a dropped connection.
+                    self.__num_errors += 1
+                    log.debug(f"poll on conn {conn_id} failed: {res}")
+
+            jitter = random.uniform(-self.jitter, self.jitter)
+            await asyncio.sleep(tick * (1 + jitter))
+
+
+    def get_stats(self) -> dict:
+        return {
+            "num_conns"     : len(self.__conns),
+            "num_procs"     : sum( len(p) for p in self.__conns.values() ),
+            "num_ticks"     : self.__num_ticks,
+            "num_requests"  : self.__num_requests,
+            "num_skipped"   : self.__num_skipped,
+            "num_errors"    : self.__num_errors,
+        }
+
+
+
+_POLLER = Poller()
+
+def get_poller():
+    """
+    Returns the global proc poller.
+    """
+    return _POLLER
+
+
 #-------------------------------------------------------------------------------
 
 async def agent_conn(apsis):
@@ -1,5 +1,6 @@
 from   .base import (
-    Program, Output, OutputMetadata,
+    Program, Output, OutputMetadata, OutputDelta, OutputBuffer,
+    OutputRetention, RetainedOutput,
     ProgramRunning, ProgramError, ProgramSuccess, ProgramFailure,
 )
 
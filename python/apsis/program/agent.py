@@ -1,6 +1,4 @@
 import asyncio
-import functools
-import httpx
 import logging
 import ora
 import os
@@ -9,15 +7,16 @@ import socket
 
 from   .base import (
     Program, ProgramRunning, ProgramSuccess, ProgramFailure, ProgramError,
-    program_outputs, Timeout, RunningProgram,
+    ProgramUpdate, program_outputs, program_output_deltas, Timeout,
+    RunningProgram, OutputRetention, RetainedOutput, retention_to_jso,
 )
 from   .process import Stop, BoundStop
-from   apsis.agent.client import Agent, NoSuchProcessError
-from   apsis.host_group import expand_host
+from   apsis.agent.client import get_agent, NoSuchProcessError
+from   apsis.host_group import HOST_LOAD, expand_host
 from   apsis.lib import memo
-from   apsis.lib.cmpr import compress_async
 from   apsis.lib.json import check_schema, ifkey
-from   apsis.lib.py import or_none, nstr
+from   apsis.lib.parse import nparse_duration
+from   apsis.lib.py import or_none, nstr, get_cfg
 from   apsis.lib.sys import get_username
 from   apsis.runs import template_expand, join_args
 
@@ -25,11 +24,6 @@ log = logging.getLogger(__name__)
 
 #-------------------------------------------------------------------------------
 
-@functools.cache
-def _get_agent(host, user):
-    return Agent(host=host, user=user)
-
-
 class AgentProgram(Program):
 
     def __init__(
@@ -39,12 +33,14 @@ class AgentProgram(Program):
             user    =None,
             timeout =None,
             stop    =Stop(),
+            retention=None,
     ):
         self.argv       = tuple( str(a) for a in argv )
         self.host       = nstr(host)
         self.user       = nstr(user)
         self.timeout    = timeout
         self.stop       = stop
+        self.retention  = retention
 
 
     def __str__(self):
@@ -60,6 +56,7 @@ class AgentProgram(Program):
             | ifkey("host", self.host, None)
             | ifkey("user", self.user, None)
             | ifkey("stop", self.stop.to_jso(), {})
+            | retention_to_jso(self.retention)
         )
         if self.timeout is not None:
             jso["timeout"] = self.timeout.to_jso()
@@ -74,7 +71,11 @@ class AgentProgram(Program):
             user    = pop("user", nstr, None)
             timeout = pop("timeout", Timeout.from_jso, None)
             stop    = pop("stop", Stop.from_jso, default=Stop())
-        return cls(argv, host=host, user=user, timeout=timeout, stop=stop)
+            retention = pop("output", OutputRetention.from_jso, None)
+        return cls(
+            argv, host=host, user=user, timeout=timeout, stop=stop,
+            retention=retention,
+        )
 
 
     def bind(self, args):
@@ -89,6 +90,7 @@ class AgentProgram(Program):
             user    =user,
             timeout =timeout,
             stop    =stop,
+            retention=self.retention,
         )
 
 
@@ -102,12 +104,14 @@ class AgentShellProgram(Program):
             user    =None,
             timeout =None,
             stop    =Stop(),
+            retention=None,
     ):
         self.command    = str(command)
         self.host       = nstr(host)
         self.user       = nstr(user)
         self.timeout    = timeout
         self.stop       = stop
+        self.retention  = retention
 
 
     def __str__(self):
@@ -123,6 +127,7 @@ class AgentShellProgram(Program):
             | ifkey("host", self.host, None)
             | ifkey("user", self.user, None)
             | ifkey("stop", self.stop.to_jso(), {})
+            | retention_to_jso(self.retention)
         )
         if self.timeout is not None:
             jso["timeout"] = self.timeout.to_jso()
@@ -137,7 +142,11 @@ class AgentShellProgram(Program):
             user    = pop("user", nstr, None)
             timeout = pop("timeout", Timeout.from_jso, None)
             stop    = pop("stop", Stop.from_jso, Stop())
-        return cls(command, host=host, user=user, timeout=timeout, stop=stop)
+            retention = pop("output", OutputRetention.from_jso, None)
+        return cls(
+            command, host=host, user=user, timeout=timeout, stop=stop,
+            retention=retention,
+        )
 
 
     def bind(self, args):
@@ -153,6 +162,7 @@ class AgentShellProgram(Program):
             user    =user,
             timeout =timeout,
             stop    =stop,
+            retention=self.retention,
         )
 
 
@@ -168,12 +178,14 @@ class BoundAgentProgram(Program):
             user    =None,
             timeout =None,
             stop    =BoundStop(),
+            retention=None,
     ):
         self.argv       = tuple( str(a) for a in argv )
         self.host       = nstr(host)
         self.user       = nstr(user)
         self.timeout    = timeout
         self.stop       = stop
+        self.retention  = retention
 
 
     def __str__(self):
@@ -181,12 +193,16 @@ class BoundAgentProgram(Program):
 
 
     def to_jso(self):
-        jso = {
-            **super().to_jso(),
-            "argv"  : list(self.argv),
-            "host"  : self.host,
-            "user"  : self.user,
-        } | ifkey("stop", self.stop.to_jso(), {})
+        jso = (
+            {
+                **super().to_jso(),
+                "argv"  : list(self.argv),
+                "host"  : self.host,
+                "user"  : self.user,
+            }
+            | ifkey("stop", self.stop.to_jso(), {})
+            | retention_to_jso(self.retention)
+        )
         if self.timeout is not None:
             jso["timeout"] = self.timeout.to_jso()
         return jso
@@ -200,7 +216,11 @@ class BoundAgentProgram(Program):
             user    = pop("user", nstr, None)
             timeout = pop("timeout", Timeout.from_jso, None)
             stop    = pop("stop", BoundStop.from_jso, BoundStop())
-        return cls(argv, host=host, user=user, timeout=timeout, stop=stop)
+            retention = pop("output", OutputRetention.from_jso, None)
+        return cls(
+            argv, host=host, user=user, timeout=timeout, stop=stop,
+            retention=retention,
+        )
 
 
     def run(self, run_id, cfg):
@@ -227,14 +247,29 @@ class RunningAgentProgram(RunningProgram):
 
     def __get_agent(self, host):
         host = None if host is None else socket.getfqdn(host)
-        return _get_agent(host, self.program.user)
+        return get_agent(host, self.program.user)
 
 
     @memo.property
     async def updates(self):
+        host = (
+            expand_host(self.program.host, self.cfg) if self.run_state is None
+            else self.run_state["host"]
+        )
+        # Count the run as in flight on the host, for load-aware host groups.
+        # Do this before yielding to the event loop, so that concurrent starts
+        # see it.
+        HOST_LOAD.add_run(host)
+        try:
+            async for update in self.__run(host):
+                yield update
+        finally:
+            HOST_LOAD.remove_run(host)
+
+
+    async def __run(self, host):
         if self.run_state is None:
             # Start the proc.
-            host = expand_host(self.program.host, self.cfg)
             argv = self.program.argv
 
             loc = "" if host is None else " on " + host
@@ -286,7 +321,6 @@ class RunningAgentProgram(RunningProgram):
         else:
             # Poll an existing proc.
             proc_id = self.run_state["proc_id"]
-            host    = self.run_state["host"]
             start   = ora.Time(self.run_state["start"])
             agent   = self.__get_agent(host)
 
@@ -294,76 +328,129 @@ class RunningAgentProgram(RunningProgram):
 
         explanation = ""
 
-        # FIXME: This is so embarrassing.
-        POLL_INTERVAL = 1
-
-        TIMEOUT = 60
-        client_ctx = httpx.AsyncClient(
-            verify=False,
-            timeout=httpx.Timeout(TIMEOUT),
-            limits=httpx.Limits(
-                max_keepalive_connections=1,
-                keepalive_expiry=TIMEOUT,
-            ),
-        )
-
-        async with client_ctx as client:
+        # Length of output received so far, as deltas.  We don't keep the
+        # output data; it's accumulated by the output store.
+        received = 0
+        retention = self.program.retention
+        # With a retention policy, publish only the head while running.  The
+        # retained output always keeps the head, but may drop later output, so
+        # we don't publish it until we know the total length.
+        max_received = None if retention is None else retention.head_size
+
+        # How often to retrieve new output while the program runs.
+        output_interval = get_cfg(self.cfg, "agent.run.output_interval", None)
+        output_interval = nparse_duration(output_interval)
+
+        log.debug(f"waiting for proc: {self.run_id}: {proc_id} @ {host}")
+        wait = asyncio.ensure_future(agent.wait_process(proc_id))
+        timed_out = False
+        try:
             while True:
-                if self.program.timeout is not None:
-                    elapsed = ora.now() - start
-                    if self.program.timeout.duration < elapsed:
-                        msg = f"timeout after {elapsed:.0f} s"
-                        log.info(f"{self.run_id}: {msg}")
-                        explanation = f" ({msg})"
-                        # FIXME: Note timeout in run log.
-                        await self.signal(self.program.timeout.signal)
-                        await asyncio.sleep(POLL_INTERVAL)
-
-                log.debug(f"polling proc: {self.run_id}: {proc_id} @ {host}")
-                try:
-                    proc = await agent.get_process(proc_id, restart=True, client=client)
-                except NoSuchProcessError:
-                    # Agent doesn't know about this process anymore.
-                    raise ProgramError(f"program lost: {self.run_id}")
-                if proc["state"] == "run":
-                    await asyncio.sleep(POLL_INTERVAL)
-                else:
+                timeout = output_interval
+                if self.program.timeout is not None and not timed_out:
+                    # Wake up when the timeout expires.
+                    remaining = max(
+                        self.program.timeout.duration - (ora.now() - start), 0)
+                    timeout = (
+                        remaining if timeout is None
+                        else min(timeout, remaining)
+                    )
+
+                await asyncio.wait({wait}, timeout=timeout)
+                if wait.done():
                     break
 
-            status = proc["status"]
-            output, length, compression = await agent.get_process_output(proc_id, client=client)
-
-            if compression is None and len(output) > 16384:
-                # Compress the output.
-                try:
-                    output, compression = await compress_async(output, "br"), "br"
-                except RuntimeError as exc:
-                    log.error(f"{exc}; not compressing")
-
-            outputs = program_outputs(
-                output, length=length, compression=compression)
-            log.debug(f"got output: {length} bytes, {compression or 'uncompressed'}")
+                elapsed = ora.now() - start
+                if (
+                        self.program.timeout is not None
+                        and not timed_out
+                        and elapsed >= self.program.timeout.duration
+                ):
+                    msg = f"timeout after {elapsed:.0f} s"
+                    log.info(f"{self.run_id}: {msg}")
+                    explanation = f" ({msg})"
+                    # FIXME: Note timeout in run log.
+                    await self.signal(self.program.timeout.signal)
+                    timed_out = True
+
+                if (
+                        output_interval is not None
+                        and (max_received is None or received < max_received)
+                ):
+                    # Publish output produced since the last time.
+                    try:
+                        async for data in agent.iter_process_output(
+                                proc_id, start=received, stop=max_received):
+                            yield ProgramUpdate(
+                                output_deltas=program_output_deltas(
+                                    received, data))
+                            received += len(data)
+                    except NoSuchProcessError:
+                        # Let the wait report this.
+                        pass
+                    except Exception as exc:
+                        log.warning(
+                            f"output update failed: {self.run_id}: {exc}")
 
             try:
-                if status == 0:
-                    yield ProgramSuccess(meta=proc, outputs=outputs)
+                proc = wait.result()
+            except NoSuchProcessError:
+                # Agent doesn't know about this process anymore.
+                raise ProgramError(f"program lost: {self.run_id}")
+
+        finally:
+            wait.cancel()
+
+        status = proc["status"]
+        if retention is None:
+            # Stream the remaining output into the output store, as deltas.
+            async for data in agent.iter_process_output(
+                    proc_id, start=received):
+                yield ProgramUpdate(
+                    output_deltas=program_output_deltas(received, data))
+                received += len(data)
+            # The output store has the data; but make sure there is an
+            # output, even if empty.
+            outputs = {} if received > 0 else program_outputs(b"")
+            log.debug(f"got output: {received} bytes")
 
-                elif (
-                            self.stopping
-                        and os.WIFSIGNALED(status)
-                        and Signals(os.WTERMSIG(status)) == self.program.stop.signal
-                ):
-                    # Program stopped as expected.
-                    log.info("EXPECTED SIGTERM WHEN STOPPING")
-                    yield ProgramSuccess(meta=proc, outputs=outputs)
+        else:
+            # Download only the head and tail we retain.
+            head, tail = retention.head_size, retention.tail_size
+            output, length, _ = await agent.get_process_output(
+                proc_id, head=head, tail=tail)
+            retained = RetainedOutput(retention)
+            if len(output) == length:
+                # Complete output.
+                retained.append(output)
+            else:
+                retained.append(output[: head])
+                retained.append(output[head :], start=length - tail)
+            output = retained.get()
+            outputs = program_outputs(
+                output, total_length=retained.total_length)
+            log.debug(f"got output: {len(output)} of {length} bytes")
+
+        try:
+            if status == 0:
+                yield ProgramSuccess(meta=proc, outputs=outputs)
+
+            elif (
+                        self.stopping
+                    and os.WIFSIGNALED(status)
+                    and Signals(os.WTERMSIG(status)) == self.program.stop.signal
+            ):
+                # Program stopped as expected.
+                log.info("EXPECTED SIGTERM WHEN STOPPING")
+                yield ProgramSuccess(meta=proc, outputs=outputs)
 
-                else:
-                    message = f"program failed: status {status}{explanation}"
-                    yield ProgramFailure(message, meta=proc, outputs=outputs)
+            else:
+                message = f"program failed: status {status}{explanation}"
+                yield ProgramFailure(message, meta=proc, outputs=outputs)
 
-            finally:
-                # Clean up the process from the agent.
-                await agent.del_process(proc_id, client=client)
+        finally:
+            # Clean up the process from the agent.
+            await agent.del_process(proc_id)
 
 
     async def signal(self, signal):
@@ -2,8 +2,8 @@ from   dataclasses import dataclass
 
 from   apsis.lib import memo
 from   apsis.lib.api import decompress
-from   apsis.lib.json import TypedJso, check_schema
-from   apsis.lib.parse import parse_duration
+from   apsis.lib.json import TypedJso, check_schema, ifkey
+from   apsis.lib.parse import parse_duration, parse_size
 from   apsis.lib.py import format_repr, format_ctor
 from   apsis.lib.sys import to_signal
 from   apsis.runs import template_expand
@@ -13,7 +13,7 @@ from   apsis.runs import template_expand
 class OutputMetadata:
 
     def __init__(self, name: str, length: int, *, 
-                 content_type="application/octet-stream"):
+                 content_type="application/octet-stream", total_length=None):
         """
         :param name:
           User-visible output name.
@@ -21,10 +21,14 @@ class OutputMetadata:
           Length in bytes.
         :param content_type:
           MIME type of output.
+        :param total_length:
+          If the output was truncated by a retention policy, the exact number
+          of bytes the program produced; else none.
         """
         self.name           = str(name)
         self.length         = int(length)
         self.content_type   = str(content_type)
+        self.total_length   = None if total_length is None else int(total_length)
 
 
     def to_jso(self):
@@ -32,7 +36,7 @@ class OutputMetadata:
             "name"          : self.name,
             "length"        : self.length,
             "content_type"  : self.content_type,
-        }
+        } | ifkey("total_length", self.total_length, None)
 
 
 
@@ -68,18 +72,261 @@ class Output:
 
 
 
-def program_outputs(output: bytes, *, length=None, compression=None):
+class OutputDelta:
+    """
+    Data appended to a running output.
+    """
+
+    def __init__(self, metadata: OutputMetadata, start: int, data: bytes):
+        """
+        :param metadata:
+          Information about the entire output so far.
+        :param start:
+          Offset in the output of the first byte of `data`.
+        :param data:
+          The new, uncompressed data.
+        """
+        if not isinstance(data, bytes):
+            raise TypeError("data must be bytes")
+
+        self.metadata   = metadata
+        self.start      = int(start)
+        self.data       = data
+
+
+    def __repr__(self):
+        data = repr(self.data[: 64]) + ("" if len(self.data) < 64 else "…")
+        return format_ctor(self, self.metadata, self.start, data)
+
+
+    @property
+    def stop(self):
+        return self.start + len(self.data)
+
+
+
+class OutputBuffer:
+    """
+    Append-only buffer of uncompressed output data.
+
+    The cost of appending is amortized linear in the length of the appended
+    data, independent of the length already buffered.
+    """
+
+    def __init__(self, data=b""):
+        self.__data = bytearray(data)
+
+
+    def __len__(self):
+        return len(self.__data)
+
+
+    def append(self, start, data) -> bytes:
+        """
+        Appends `data`, which starts at offset `start` in the output.
+
+        Any part of `data` that overlaps data already in the buffer is ignored.
+
+        :return:
+          The data actually appended, which may be empty.
+        :raise RuntimeError:
+          `start` is past the end of the buffer.
+        """
+        length = len(self.__data)
+        if start > length:
+            raise RuntimeError(f"output data gap: {start} after {length}")
+        elif start < length:
+            data = data[length - start :]
+        self.__data += data
+        return bytes(data)
+
+
+    def get(self, start=0, stop=None) -> bytes:
+        """
+        Returns the data in `[start, stop)`.
+        """
+        with memoryview(self.__data) as view, view[start : stop] as part:
+            return bytes(part)
+
+
+    def write_to(self, file):
+        """
+        Writes all the data to `file`.
+        """
+        with memoryview(self.__data) as view:
+            file.write(view)
+
+
+
+@dataclass
+class OutputRetention:
+    """
+    Policy for retaining program output that exceeds a maximum size.
+
+    Retains at most `max_bytes` of output: the beginning of the output, the
+    end, or both, evenly divided.
+    """
+
+    max_bytes: int
+    keep: str = "head+tail"
+
+    KEEPS = ("head", "tail", "head+tail")
+
+    def __post_init__(self):
+        if self.max_bytes <= 0:
+            raise ValueError(f"nonpositive max_bytes: {self.max_bytes}")
+        if self.keep not in self.KEEPS:
+            raise ValueError(f"invalid keep: {self.keep}")
+
+
+    @property
+    def head_size(self):
+        match self.keep:
+            case "head":
+                return self.max_bytes
+            case "tail":
+                return 0
+            case "head+tail":
+                return self.max_bytes // 2
+
+
+    @property
+    def tail_size(self):
+        return self.max_bytes - self.head_size
+
+
+    @classmethod
+    def from_jso(cls, jso):
+        with check_schema(jso) as pop:
+            max_bytes   = pop("max_bytes", parse_size)
+            keep        = pop("keep", str, default="head+tail")
+        return cls(max_bytes=max_bytes, keep=keep)
+
+
+    def to_jso(self):
+        return {
+            "max_bytes" : self.max_bytes,
+            "keep"      : self.keep,
+        }
+
+
+
+def retention_to_jso(retention):
+    """
+    Returns program JSO for an optional output retention policy.
+    """
+    return {} if retention is None else {"output": retention.to_jso()}
+
+
+def _truncation_marker(omitted) -> bytes:
+    return f"\n[apsis: {omitted} bytes of output omitted]\n".encode()
+
+
+class RetainedOutput:
+    """
+    Accumulates output data, retaining only the parts an `OutputRetention`
+    policy keeps.
+
+    Memory use is bounded by twice the policy's `max_bytes`, regardless of the
+    amount of data appended.
+    """
+
+    def __init__(self, retention: OutputRetention):
+        self.__head_size    = retention.head_size
+        self.__tail_size    = retention.tail_size
+        self.__head         = bytearray()
+        # Data following the head, of which we retain the end.
+        self.__tail         = bytearray()
+        # Total length of output.
+        self.length         = 0
+
+
+    def append(self, data, start=None):
+        """
+        Appends `data`.
+
+        :param start:
+          The offset of `data` in the output, or none if it immediately follows
+          the data already appended.  If past the end of the output so far, the
+          bytes in between are omitted.
+        :raise RuntimeError:
+          `start` leaves a gap in the head.
+        """
+        if start is not None:
+            if start < self.length:
+                # Skip data we already have.
+                data = data[self.length - start :]
+            elif start > self.length:
+                if len(self.__head) < self.__head_size:
+                    raise RuntimeError(
+                        f"output data gap: {start} after {self.length}")
+                # We can't keep tail data before the gap.
+                self.__tail.clear()
+                self.length = start
+
+        self.length += len(data)
+
+        if len(self.__head) < self.__head_size:
+            size = self.__head_size - len(self.__head)
+            self.__head += data[: size]
+            data = data[size :]
+
+        if self.__tail_size > 0 and len(data) > 0:
+            self.__tail += data
+            # Trim occasionally, so trimming is amortized.
+            if len(self.__tail) > 2 * self.__tail_size:
+                del self.__tail[: -self.__tail_size]
+
+
+    @property
+    def total_length(self):
+        """
+        The total length, if the output is truncated; else none.
+        """
+        retained = len(self.__head) + min(len(self.__tail), self.__tail_size)
+        return None if retained == self.length else self.length
+
+
+    def get(self) -> bytes:
+        """
+        Returns the retained data, with a marker for any omitted data.
+        """
+        tail = self.__tail[-self.__tail_size :] if self.__tail_size > 0 else b""
+        omitted = self.length - len(self.__head) - len(tail)
+        return bytes(
+            self.__head
+            + (b"" if omitted == 0 else _truncation_marker(omitted))
+            + tail
+        )
+
+
+
+def program_outputs(
+        output: bytes, *, length=None, compression=None, total_length=None
+):
     if length is None:
         length = len(output)
     return {
         "output": Output(
-            OutputMetadata("combined stdout & stderr", length=length),
+            OutputMetadata(
+                "combined stdout & stderr",
+                length=length,
+                total_length=total_length,
+            ),
             output,
             compression=compression,
         ),
     }
 
 
+def program_output_deltas(start: int, data: bytes):
+    """
+    Constructs program output deltas for `data` following `start` bytes.
+    """
+    metadata = OutputMetadata("combined stdout & stderr", start + len(data))
+    return {"output": OutputDelta(metadata, start, data)}
+
+
 #-------------------------------------------------------------------------------
 
 class ProgramRunning:
@@ -97,9 +344,16 @@ class ProgramRunning:
 
 class ProgramUpdate:
 
-    def __init__(self, *, meta=None, outputs=None):
-        self.meta       = meta
-        self.outputs    = outputs
+    def __init__(self, *, meta=None, outputs=None, output_deltas=None):
+        """
+        :param outputs:
+          Mapping from output ID to `Output` that replaces the entire output.
+        :param output_deltas:
+          Mapping from output ID to `OutputDelta` with data to append.
+        """
+        self.meta           = meta
+        self.outputs        = outputs
+        self.output_deltas  = output_deltas
 
 
     def __repr__(self):
@@ -6,16 +6,19 @@ from   pathlib import Path
 import pwd
 from   signal import Signals
 import socket
+import tempfile
 
 from   .base import (
     Program, RunningProgram,
-    ProgramRunning, ProgramSuccess, ProgramFailure, ProgramError,
-    program_outputs
+    ProgramRunning, ProgramSuccess, ProgramFailure, ProgramError, ProgramUpdate,
+    OutputRetention, RetainedOutput, program_outputs, program_output_deltas,
+    retention_to_jso
 )
+from   apsis.launcher import ProcessLostError, get_launcher
 from   apsis.lib import memo
 from   apsis.lib.json import check_schema, ifkey
 from   apsis.lib.parse import nparse_duration
-from   apsis.lib.py import or_none
+from   apsis.lib.py import or_none, get_cfg
 from   apsis.lib.sys import get_username, to_signal
 from   apsis.runs import template_expand, join_args
 
@@ -25,6 +28,10 @@ TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%kZ"
 
 ntemplate_expand = or_none(template_expand)
 
+# Size of chunks in which to read output.
+OUTPUT_CHUNK_SIZE = 65536
+
+
 #-------------------------------------------------------------------------------
 
 @dataclass
@@ -91,9 +98,10 @@ class BoundStop:
 
 class ProcessProgram(Program):
 
-    def __init__(self, argv, *, stop=Stop()):
+    def __init__(self, argv, *, stop=Stop(), retention=None):
         self.argv = tuple( str(a) for a in argv )
         self.stop = stop
+        self.retention = retention
 
 
     def __str__(self):
@@ -103,14 +111,18 @@ class ProcessProgram(Program):
     def bind(self, args):
         argv = tuple( template_expand(a, args) for a in self.argv )
         stop = self.stop.bind(args)
-        return BoundProcessProgram(argv, stop=stop)
+        return BoundProcessProgram(argv, stop=stop, retention=self.retention)
 
 
     def to_jso(self):
-        return {
-            **super().to_jso(),
-            "argv"      : list(self.argv),
-        } | ifkey("stop", self.stop.to_jso(), {})
+        return (
+            {
+                **super().to_jso(),
+                "argv"      : list(self.argv),
+            }
+            | ifkey("stop", self.stop.to_jso(), {})
+            | retention_to_jso(self.retention)
+        )
 
 
     @classmethod
@@ -118,7 +130,8 @@ class ProcessProgram(Program):
         with check_schema(jso) as pop:
             argv = pop("argv")
             stop = pop("stop", Stop.from_jso, Stop())
-        return cls(argv, stop=stop)
+            retention = pop("output", OutputRetention.from_jso, None)
+        return cls(argv, stop=stop, retention=retention)
 
 
 
@@ -126,16 +139,17 @@ class ProcessProgram(Program):
 
 class ShellCommandProgram(Program):
 
-    def __init__(self, command, *, stop=Stop()):
+    def __init__(self, command, *, stop=Stop(), retention=None):
         self.command    = str(command)
         self.stop       = stop
+        self.retention  = retention
 
 
     def bind(self, args):
         command = template_expand(self.command, args)
         argv    = ["/bin/bash", "-c", command]
         stop    = self.stop.bind(args)
-        return BoundProcessProgram(argv, stop=stop)
+        return BoundProcessProgram(argv, stop=stop, retention=self.retention)
 
 
     def __str__(self):
@@ -143,10 +157,14 @@ class ShellCommandProgram(Program):
 
 
     def to_jso(self):
-        return {
-            **super().to_jso(),
-            "command": self.command,
-        } | ifkey("stop", self.stop.to_jso(), {})
+        return (
+            {
+                **super().to_jso(),
+                "command": self.command,
+            }
+            | ifkey("stop", self.stop.to_jso(), {})
+            | retention_to_jso(self.retention)
+        )
 
 
     @classmethod
@@ -154,7 +172,8 @@ class ShellCommandProgram(Program):
         with check_schema(jso) as pop:
             command = pop("command", str)
             stop    = pop("stop", Stop.from_jso, default=Stop())
-        return cls(command, stop=stop)
+            retention = pop("output", OutputRetention.from_jso, None)
+        return cls(command, stop=stop, retention=retention)
 
 
 
@@ -162,9 +181,10 @@ class ShellCommandProgram(Program):
 
 class BoundProcessProgram(Program):
 
-    def __init__(self, argv, *, stop=BoundStop()):
+    def __init__(self, argv, *, stop=BoundStop(), retention=None):
         self.argv = tuple( str(a) for a in argv )
         self.stop = stop
+        self.retention = retention
 
 
     def __str__(self):
@@ -172,10 +192,14 @@ class BoundProcessProgram(Program):
 
 
     def to_jso(self):
-        return {
-            **super().to_jso(),
-            "argv": self.argv,
-        } | ifkey("stop", self.stop.to_jso(), {})
+        return (
+            {
+                **super().to_jso(),
+                "argv": self.argv,
+            }
+            | ifkey("stop", self.stop.to_jso(), {})
+            | retention_to_jso(self.retention)
+        )
 
 
     @classmethod
@@ -183,101 +207,200 @@ class BoundProcessProgram(Program):
         with check_schema(jso) as pop:
             argv = pop("argv")
             stop = pop("stop", BoundStop.from_jso, BoundStop())
-        return cls(argv, stop=stop)
+            retention = pop("output", OutputRetention.from_jso, None)
+        return cls(argv, stop=stop, retention=retention)
 
 
     def run(self, run_id, cfg) -> RunningProgram:
-        return RunningProcessProgram(self, run_id)
+        return RunningProcessProgram(self, run_id, cfg)
 
 
+    def connect(self, run_id, run_state, cfg) -> RunningProgram:
+        return RunningProcessProgram(self, run_id, cfg, run_state)
+
 
 
 #-------------------------------------------------------------------------------
 
 class RunningProcessProgram(RunningProgram):
+    """
+    A process running locally, started by the launcher.
 
-    # FIXME: Configure?
-    grace_period = 60
+    The process's output goes to a temporary file, which we read incrementally.
+    The run state carries the paths to the output and status files, so that we
+    can reconnect to the process after Apsis restarts.
+    """
 
-    def __init__(self, program, run_id):
+    def __init__(self, program, run_id, cfg={}, run_state=None):
         super().__init__(run_id)
         self.program    = program
-        self.process    = None
+        self.cfg        = cfg
+        self.run_state  = run_state
         self.stopping   = False
 
 
     @memo.property
     async def updates(self):
-        argv = self.program.argv
-        log.info(f"starting program: {join_args(argv)}")
+        launcher = get_launcher()
 
-        meta = {
-            "hostname"  : socket.gethostname(),
-            "username"  : get_username(),
-            "euid"      : pwd.getpwuid(os.geteuid()).pw_name,
-        }
+        if self.run_state is None:
+            argv = self.program.argv
+            log.info(f"starting program: {join_args(argv)}")
+
+            meta = {
+                "hostname"  : socket.gethostname(),
+                "username"  : get_username(),
+                "euid"      : pwd.getpwuid(os.geteuid()).pw_name,
+            }
 
+            output_dir = get_cfg(self.cfg, "process.output_dir", None)
+            fd, output_path = tempfile.mkstemp(
+                prefix=f"apsis-{self.run_id}-", suffix=".out", dir=output_dir)
+            os.close(fd)
+            status_path = str(Path(output_path).with_suffix(".status"))
+
+            try:
+                pid, start_time = await launcher.start(
+                    argv, output_path, status_path)
+            except OSError as exc:
+                # Error starting.
+                os.unlink(output_path)
+                raise ProgramError(str(exc), meta=meta)
+
+            # Started successfully.
+            self.run_state = {
+                "pid"           : pid,
+                "start_time"    : start_time,
+                "output_path"   : output_path,
+                "status_path"   : status_path,
+            }
+            yield ProgramRunning(self.run_state, meta=meta)
+
+        else:
+            try:
+                pid         = self.run_state["pid"]
+                start_time  = self.run_state["start_time"]
+                output_path = self.run_state["output_path"]
+                status_path = self.run_state["status_path"]
+            except KeyError:
+                pid = self.run_state.get("pid")
+                raise ProgramError(f"can't reconnect to running proc {pid}")
+            log.info(f"reconnecting program: pid {pid}")
+
+        # Length of output published so far, as deltas.
+        received = 0
+        retention = self.program.retention
+        # With a retention policy, publish only the head while running.  The
+        # retained output always keeps the head, but may drop later output, so
+        # we don't publish it until we know the total length.
+        max_received = None if retention is None else retention.head_size
+
+        # How often to publish new output while the program runs.
+        output_interval = get_cfg(self.cfg, "process.run.output_interval", None)
+        output_interval = nparse_duration(output_interval)
+
+        wait = asyncio.ensure_future(
+            launcher.wait(pid, status_path, start_time))
         try:
-            with open("/dev/null") as stdin:
-                self.proc = await asyncio.create_subprocess_exec(
-                    *argv,
-                    executable  =Path(argv[0]),
-                    stdin       =stdin,
-                    # Merge stderr with stdin.
-                    stdout      =asyncio.subprocess.PIPE,
-                    stderr      =asyncio.subprocess.STDOUT,
-                )
-
-        except OSError as exc:
-            # Error starting.
-            raise ProgramError(str(exc), meta=meta)
-
-        # Started successfully.
-        yield ProgramRunning({"pid": self.proc.pid}, meta=meta)
-
-        stdout, stderr  = await self.proc.communicate()
-        return_code     = self.proc.returncode
-        self.proc       = None
-        log.info(f"complete with return code {return_code}")
-        assert stderr is None
-        assert return_code is not None
+            with open(output_path, "rb") as file:
+                while not wait.done():
+                    await asyncio.wait({wait}, timeout=output_interval)
+                    if output_interval is None:
+                        continue
+                    # Publish output written since the last time, a chunk at
+                    # a time.
+                    while True:
+                        size = (
+                            OUTPUT_CHUNK_SIZE if max_received is None
+                            else min(OUTPUT_CHUNK_SIZE, max_received - received)
+                        )
+                        if size == 0 or len(data := file.read(size)) == 0:
+                            break
+                        yield ProgramUpdate(
+                            output_deltas=program_output_deltas(received, data))
+                        received += len(data)
 
+                try:
+                    status = wait.result()
+                except ProcessLostError as exc:
+                    raise ProgramError(f"program lost: {exc}")
+
+                if retention is None:
+                    # Publish the rest of the output as deltas, a chunk at a
+                    # time, so we never hold all of it in memory.
+                    while len(data := file.read(OUTPUT_CHUNK_SIZE)) > 0:
+                        yield ProgramUpdate(
+                            output_deltas=program_output_deltas(
+                                received, data))
+                        received += len(data)
+                    # The output store has the data; but make sure there is an
+                    # output, even if empty.
+                    outputs = {} if received > 0 else program_outputs(b"")
+                else:
+                    # Read output incrementally, retaining only what the policy
+                    # keeps, so memory use is bounded however much the program
+                    # writes.
+                    retained = RetainedOutput(retention)
+                    file.seek(0)
+                    while len(data := file.read(OUTPUT_CHUNK_SIZE)) > 0:
+                        retained.append(data)
+                    outputs = program_outputs(
+                        retained.get(), total_length=retained.total_length)
+
+        finally:
+            if wait.done():
+                # The program is gone, so we're done with the output and status
+                # files, whether or not we read them successfully.
+                for path in (output_path, status_path):
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+            else:
+                # Still running; keep the files, to reconnect later.
+                wait.cancel()
+
+        return_code = os.waitstatus_to_exitcode(status)
+        log.info(f"complete with return code {return_code}")
         meta = {
             "return_code": return_code,
         }
-        outputs = program_outputs(stdout)
 
         if return_code == 0:
             yield ProgramSuccess(meta=meta, outputs=outputs)
 
         elif (
                     self.stopping
-                and self.returncode < 0
-                and Signals(self.returncode) == self.program.stop.signal
+                and return_code < 0
+                and Signals(-return_code) == self.program.stop.signal
         ):
             # Program stopped as expected.
-            yield ProgramFailure(meta=meta, outputs=outputs)
+            message = f"program stopped: {Signals(-return_code).name}"
+            yield ProgramFailure(message, meta=meta, outputs=outputs)
 
         else:
             message = f"program failed: return code {return_code}"
             yield ProgramFailure(message, meta=meta, outputs=outputs)
 
 
-    def connect(self, run_id, run_state, cfg) -> RunningProgram:
-        pid = run_state["pid"]
-        raise NotImplementedError(f"can't reconnect to running proc {pid}")
-
-
     async def signal(self, signal):
-        assert self.process is not None
-        self.process.send_signal(signal)
+        if self.run_state is None:
+            raise RuntimeError("can't signal; not running yet")
+        # The launcher reaps the process, so its pid may have been reused;
+        # the launcher checks that it's still our process.
+        await get_launcher().signal(
+            self.run_state["pid"],
+            to_signal(signal),
+            self.run_state["status_path"],
+            self.run_state.get("start_time"),
+        )
 
 
     async def stop(self):
         self.stopping = True
 
         stop = self.program.stop
-        self.process.send_signal(stop.signal)
+        await self.signal(stop.signal)
         if stop.grace_period is not None:
             try:
                 # Wait for the grace period to expire.
@@ -289,7 +412,7 @@ class RunningProcessProgram(RunningProgram):
                 # Send a kill signal.
                 try:
                     await self.signal(Signals.SIGKILL)
-                except ValueError:
+                except ProcessLookupError:
                     # Proc is gone; that's OK.
                     pass
 
@@ -6,14 +6,16 @@ from   procstar.agent.proc import FdData, Interval, Result
 from   signal import Signals
 import uuid
 
-from   apsis.lib import asyn
 from   apsis.lib import memo
 from   apsis.lib.json import check_schema, ifkey
 from   apsis.lib.parse import nparse_duration
 from   apsis.lib.py import or_none, nstr, get_cfg
-from   apsis.procstar import get_agent_server
+from   apsis.procstar import get_agent_server, get_placement, get_poller
 from   apsis.program import base
-from   apsis.program.base import (ProgramSuccess, ProgramFailure, ProgramError)
+from   apsis.program.base import (
+    ProgramSuccess, ProgramFailure, ProgramError,
+    OutputRetention, RetainedOutput, program_outputs, retention_to_jso,
+)
 from   apsis.program.process import Stop, BoundStop
 from   apsis.runs import join_args, template_expand
 
@@ -82,65 +84,41 @@ def _make_metadata(proc_id, res: dict):
     return meta
 
 
-def _combine_fd_data(old, new):
-    if old is None:
-        return new
-
-    assert new.fd == old.fd
-    assert new.encoding == old.encoding
-    assert new.interval.start <= new.interval.stop
-    assert new.interval.stop - new.interval.start == len(new.data)
+def _get_new_fd_data(received, fd_data):
+    """
+    Returns the part of `fd_data` that follows `received` bytes of output.
 
-    # FIXME: Should be Interval.__str__().
-    fi = lambda i: f"[{i.start}, {i.stop})"
+    :return:
+      The data not previously received, which may be empty.
+    :raise RuntimeError:
+      There is a gap between the received data and `fd_data`.
+    """
+    assert fd_data.fd == "stdout"
+    assert fd_data.encoding is None
+    interval = fd_data.interval
+    assert interval.stop - interval.start == len(fd_data.data)
 
-    # Check for a gap in the data.
-    if old.interval.stop < new.interval.start:
+    if interval.start > received:
         raise RuntimeError(
-            f"fd data gap: {fi(old.interval)} + {fi(new.interval)}")
-
-    elif old.interval.stop == new.interval.start:
-        return FdData(
-            fd      =old.fd,
-            encoding=old.encoding,
-            interval=Interval(old.interval.start, new.interval.stop),
-            data    =old.data + new.data,
+            f"fd data gap: [0, {received}) + "
+            f"[{interval.start}, {interval.stop})"
         )
-
+    elif interval.start < received:
+        log.warning(
+            f"fd data overlap: [0, {received}) + "
+            f"[{interval.start}, {interval.stop})"
+        )
+        return fd_data.data[received - interval.start :]
     else:
-        # Partial overlap of data.
-        log.warning(f"fd data overlap: {fi(old.interval)} + {fi(new.interval)}")
-        length = new.interval.stop - old.interval.stop
-        if length > 0:
-            # Partial overlap.  Patch intervals together.
-            interval = Interval(old.interval.start, new.interval.stop)
-            data = old.data + new.data[-length :]
-            assert interval.stop - interval.start == len(data)
-            return FdData(
-                fd      =old.fd,
-                encoding=old.encoding,
-                interval=interval,
-                data    =data,
-            )
-        else:
-            # Complete overlap.
-            return old
+        return fd_data.data
 
 
-async def _make_outputs(fd_data):
+def _make_output_deltas(start, data):
     """
-    Constructs program outputs from combined output fd data.
+    Constructs program output deltas for `data` following `start` bytes.
     """
-    if fd_data is None:
-        return {}
-
-    assert fd_data.fd == "stdout"
-    assert fd_data.interval.start == 0
-    assert fd_data.encoding is None
+    return base.program_output_deltas(start, data)
 
-    output = fd_data.data
-    length = fd_data.interval.stop
-    return base.program_outputs(output, length=length, compression=None)
 
 
 #-------------------------------------------------------------------------------
@@ -155,11 +133,13 @@ class _ProcstarProgram(base.Program):
             group_id    =procstar.proto.DEFAULT_GROUP,
             sudo_user   =None,
             stop        =Stop(),
+            retention   =None,
     ):
         super().__init__()
         self.group_id   = str(group_id)
         self.sudo_user  = None if sudo_user is None else str(sudo_user)
         self.stop       = stop
+        self.retention  = retention
 
 
     def _bind(self, argv, args):
@@ -168,6 +148,7 @@ class _ProcstarProgram(base.Program):
             group_id    =ntemplate_expand(self.group_id, args),
             sudo_user   =ntemplate_expand(self.sudo_user, args),
             stop        =self.stop.bind(args),
+            retention   =self.retention,
         )
 
 
@@ -179,6 +160,7 @@ class _ProcstarProgram(base.Program):
             }
             | if_not_none("sudo_user", self.sudo_user)
             | ifkey("stop", self.stop.to_jso(), {})
+            | retention_to_jso(self.retention)
         )
 
 
@@ -188,6 +170,7 @@ class _ProcstarProgram(base.Program):
             group_id    =pop("group_id", default=procstar.proto.DEFAULT_GROUP),
             sudo_user   =pop("sudo_user", default=None),
             stop        =pop("stop", Stop.from_jso, Stop()),
+            retention   =pop("output", OutputRetention.from_jso, None),
         )
 
 
@@ -264,11 +247,13 @@ class BoundProcstarProgram(base.Program):
             self, argv, *, group_id,
             sudo_user   =None,
             stop        =BoundStop(),
+            retention   =None,
     ):
         self.argv = [ str(a) for a in argv ]
         self.group_id   = str(group_id)
         self.sudo_user  = nstr(sudo_user)
         self.stop       = stop
+        self.retention  = retention
 
 
     def __str__(self):
@@ -284,6 +269,7 @@ class BoundProcstarProgram(base.Program):
             }
             | if_not_none("sudo_user", self.sudo_user)
             | ifkey("stop", self.stop.to_jso(), {})
+            | retention_to_jso(self.retention)
         )
 
 
@@ -294,7 +280,11 @@ class BoundProcstarProgram(base.Program):
             group_id    = pop("group_id", default=procstar.proto.DEFAULT_GROUP)
             sudo_user   = pop("sudo_user", default=None)
             stop        = pop("stop", BoundStop.from_jso, BoundStop())
-        return cls(argv, group_id=group_id, sudo_user=sudo_user, stop=stop)
+            retention   = pop("output", OutputRetention.from_jso, None)
+        return cls(
+            argv, group_id=group_id, sudo_user=sudo_user, stop=stop,
+            retention=retention,
+        )
 
 
     def run(self, run_id, cfg):
@@ -375,7 +365,9 @@ class RunningProcstarProgram(base.RunningProgram):
 
             try:
                 # Start the proc.
-                self.proc, res = await get_agent_server().start(
+                self.proc, res = await get_placement().start(
+                    get_agent_server(),
+                    self.run_id,
                     proc_id     =proc_id,
                     group_id    =self.program.group_id,
                     spec        =self._spec,
@@ -424,47 +416,66 @@ class RunningProcstarProgram(base.RunningProgram):
             await self.proc.request_result()
             res = None
 
+            get_placement().add(conn_id, self.run_id)
             log.info(f"reconnected: {proc_id} on conn {conn_id}")
 
         # We now have a proc running on the agent.
 
         try:
-            tasks = asyn.TaskGroup()
-
-            # Output collected so far.
-            fd_data = None
-
-            # Start tasks to request periodic updates of results and output.
-
-            if update_interval is not None:
-                # Start a task that periodically requests the current result.
-                tasks.add(
-                    "poll update",
-                    asyn.poll(self.proc.request_result, update_interval)
-                )
-
-            if output_interval is not None:
-                # Start a task that periodically requests additional output.
-                def more_output():
-                    # From the current position to the end.
-                    start = 0 if fd_data is None else fd_data.interval.stop
-                    interval = Interval(start, None)
-                    return self.proc.request_fd_data("stdout", interval=interval)
-
-                tasks.add("poll output", asyn.poll(more_output, output_interval))
+            # Length of output received so far.  We don't keep the output
+            # data; it's accumulated by the output store.
+            received = 0
+
+            # With a retention policy, we receive and publish only the head
+            # while running, and keep what we retain ourselves.  The retained
+            # output always keeps the head, but may drop later output, so we
+            # don't publish it until we know the total length.
+            retention = self.program.retention
+            retained = None if retention is None else RetainedOutput(retention)
+            max_received = None if retention is None else retention.head_size
+
+            # Output length in the last polled result, if we poll results.
+            length = None
+
+            def more_output():
+                if max_received is not None and received >= max_received:
+                    # We have all the output we keep while running.
+                    return None
+                if length is not None and received >= length:
+                    # No new output since the last result.
+                    return None
+                # From the current position to the end.
+                return Interval(received, max_received)
+
+            # Request periodic updates of results and output.
+            get_poller().add(
+                self.proc,
+                update_interval =update_interval,
+                output_interval =output_interval,
+                get_output      =more_output,
+            )
 
             # Process further updates, until the process terminates.
             async for update in self.proc.updates:
                 match update:
                     case FdData():
-                        fd_data = _combine_fd_data(fd_data, update)
-                        yield base.ProgramUpdate(outputs=await _make_outputs(fd_data))
+                        data = _get_new_fd_data(received, update)
+                        if max_received is not None:
+                            data = data[: max(max_received - received, 0)]
+                            retained.append(data, start=received)
+                        if len(data) > 0:
+                            # Publish only the new data.
+                            yield base.ProgramUpdate(
+                                output_deltas=_make_output_deltas(received, data))
+                            received += len(data)
 
                     case Result() as res:
                         meta = _make_metadata(proc_id, res)
 
                         if res.state == "running":
                             # Intermediate result.
+                            if update_interval is not None:
+                                length = res.fds.stdout.length
                             yield base.ProgramUpdate(meta=meta)
                         else:
                             # Process terminated.
@@ -474,38 +485,67 @@ class RunningProcstarProgram(base.RunningProgram):
                 # Proc was deleted--but we didn't delete it.
                 assert False, "proc deleted"
 
-            # Stop update tasks.
-            await tasks.cancel_all()
+            # Stop polling.
+            get_poller().remove(conn_id, proc_id)
 
             # Do we have the complete output?
             length = res.fds.stdout.length
-            if length > 0 and (
-                    fd_data is None
-                    or fd_data.interval.stop < length
-            ):
+            if retention is None or length <= retention.max_bytes:
                 # Request any remaining output.
-                await self.proc.request_fd_data(
-                    "stdout",
-                    interval=Interval(
-                        0 if fd_data is None else fd_data.interval.stop,
-                        None
-                    )
-                )
+                intervals = [Interval(received, None)]
+            else:
+                # Request the rest of what we receive while running, then
+                # only the tail.
+                tail_start = max(max_received, length - retention.tail_size)
+                intervals = [
+                    Interval(received, max_received),
+                    Interval(tail_start, length),
+                ]
+            intervals = [
+                i for i in intervals
+                if i.start < (length if i.stop is None else i.stop)
+            ]
+
+            for interval in intervals:
+                await self.proc.request_fd_data("stdout", interval=interval)
                 # Wait for it.
                 async for update in self.proc.updates:
                     match update:
+                        case FdData() if (
+                                max_received is not None
+                                and update.interval.start >= max_received
+                        ):
+                            # Tail data, which we retain but don't publish.
+                            retained.append(
+                                update.data, start=update.interval.start)
+                            break
+
                         case FdData():
-                            fd_data = _combine_fd_data(fd_data, update)
-                            # Confirm that we've accumulated all the output as
-                            # specified in the result.
-                            assert fd_data.interval.start == 0
-                            assert fd_data.interval.stop == res.fds.stdout.length
+                            data = _get_new_fd_data(received, update)
+                            if retained is not None:
+                                retained.append(data, start=received)
+                            received += len(data)
+                            yield base.ProgramUpdate(
+                                output_deltas=_make_output_deltas(
+                                    received - len(data), data))
                             break
 
                         case _:
                             log.debug("expected final FdData")
 
-            outputs = await _make_outputs(fd_data)
+            if retained is None:
+                # Confirm that we've received all the output as specified in
+                # the result.
+                assert received == length
+            if retained is not None and retained.total_length is not None:
+                # Replace the output accumulated from deltas with the
+                # retained output.
+                outputs = program_outputs(
+                    retained.get(), total_length=retained.total_length)
+            else:
+                # The output store holds the complete output, accumulated from
+                # deltas, so the final result carries no outputs.
+                outputs = {}
             meta["stop"] = {"signals": [ s.name for s in self.stop_signals ]}
 
             if res.status.exit_code == 0:
@@ -545,8 +585,8 @@ class RunningProcstarProgram(base.RunningProgram):
             )
 
         finally:
-            # Cancel our helper tasks.
-            await tasks.cancel_all()
+            get_placement().remove(conn_id, self.run_id)
+            get_poller().remove(conn_id, proc_id)
             if self.proc is not None:
                 # Done with this proc; ask the agent to delete it.
                 try:
@@ -7,7 +7,7 @@ import logging
 from   ora import now
 import traceback
 
-from   apsis.lib.cmpr import compress_async
+from   apsis.lib.cmpr import choose_compression, get_service
 from   apsis.program.base import (
     Output, OutputMetadata,
     ProgramRunning, ProgramError, ProgramFailure, ProgramSuccess, ProgramUpdate)
@@ -23,14 +23,15 @@ async def _maybe_compress(outputs, *, compression="br", min_size=16384):
     """
     async def _cmpr(output):
         if output.compression is None and output.metadata.length >= min_size:
-            # Compress the output.
+            # Compress the output; large outputs in seekable chunks.
+            cmpr = choose_compression(compression, len(output.data))
             try:
-                compressed = await compress_async(output.data, compression)
+                compressed = await get_service().compress(output.data, cmpr)
             except RuntimeError as exc:
                 log.error(f"{exc}; not compressiong")
                 return output
             else:
-                return Output(output.metadata, compressed, compression)
+                return Output(output.metadata, compressed, cmpr)
         else:
             return output
 
@@ -38,6 +39,15 @@ async def _maybe_compress(outputs, *, compression="br", min_size=16384):
     return dict(zip(outputs.keys(), o))
 
 
+async def _finish_outputs(apsis, run, outputs):
+    """
+    Persists final `outputs` of `run`, and any remaining running outputs.
+    """
+    apsis._update_output_data(run, await _maybe_compress(outputs), True)
+    # Write through outputs accumulated from deltas.
+    await apsis.outputs.commit(run.run_id)
+
+
 async def _process_updates(apsis, run):
     """
     Processes program `updates` for `run` until the program is finished.
@@ -62,7 +72,7 @@ async def _process_updates(apsis, run):
 
                 case ProgramError() as error:
                     apsis.run_log.info(run, f"error: {error.message}")
-                    apsis._update_output_data(run, error.outputs, persist=True)
+                    await _finish_outputs(apsis, run, error.outputs)
                     apsis._transition(
                         run, State.error,
                         meta        ={"program": error.meta},
@@ -98,16 +108,14 @@ async def _process_updates(apsis, run):
                 case ProgramUpdate() as update:
                     if update.outputs is not None:
                         apsis._update_output_data(run, update.outputs, False)
+                    if update.output_deltas is not None:
+                        apsis._append_output_data(run, update.output_deltas)
                     if update.meta is not None:
                         apsis._update_metadata(run, {"program": update.meta})
 
                 case ProgramSuccess() as success:
                     apsis.run_log.record(run, "success")
-                    apsis._update_output_data(
-                        run,
-                        await _maybe_compress(success.outputs),
-                        True
-                    )
+                    await _finish_outputs(apsis, run, success.outputs)
                     apsis._transition(
                         run, State.success,
                         meta        ={"program": success.meta},
@@ -117,11 +125,7 @@ async def _process_updates(apsis, run):
                 case ProgramFailure() as failure:
                     # Program ran and failed.
                     apsis.run_log.record(run, f"failure: {failure.message}")
-                    apsis._update_output_data(
-                        run,
-                        await _maybe_compress(failure.outputs),
-                        True
-                    )
+                    await _finish_outputs(apsis, run, failure.outputs)
                     apsis._transition(
                         run, State.failure,
                         meta        ={"program": failure.meta},
@@ -130,11 +134,7 @@ async def _process_updates(apsis, run):
 
                 case ProgramError() as error:
                     apsis.run_log.info(run, f"error: {error.message}")
-                    apsis._update_output_data(
-                        run,
-                        await _maybe_compress(error.outputs),
-                        True
-                    )
+                    await _finish_outputs(apsis, run, error.outputs)
                     apsis._transition(
                         run, State.error,
                         meta        ={"program": error.meta},
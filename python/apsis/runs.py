@@ -3,12 +3,13 @@ import jinja2
 import logging
 import ora
 from   ora import now, Time
+import re
 import shlex
 
 from   .states import State, TRANSITIONS, to_state
 from   .lib.asyn import Publisher
 from   .lib.calendar import get_calendar
-from   .lib.memo import memoize
+from   .lib.memo import LRUMemo, memoize_lru
 from   .lib.py import format_ctor, iterize
 
 log = logging.getLogger(__name__)
@@ -117,14 +118,96 @@ _JINJA_ENV = jinja2.Environment(
     undefined   =_Undefined,
 )
 
-@memoize
-def _get_template(template):
+def _get_jinja_template(template):
     try:
         return _JINJA_ENV.from_string(template)
     except jinja2.TemplateSyntaxError as exc:
         raise SyntaxError(str(exc))
 
 
+# Maximum number of compiled templates to retain.
+TEMPLATE_CACHE_SIZE = 16384
+
+# A simple substitution of a single name.
+_SUBST_REGEX = re.compile(r"\{\{\s*([A-Za-z_][A-Za-z0-9_]*)\s*\}\}")
+
+# Names that Jinja2 treats as constants, rather than looking up.
+_JINJA_CONSTANTS = frozenset(("true", "false", "none", "True", "False", "None"))
+
+def _is_jinja_free(literal):
+    return not ("{{" in literal or "{%" in literal or "{#" in literal)
+
+
+def _split_template(template):
+    """
+    Splits `template` into literals and simple `{{ name }}` substitutions.
+
+    :return:
+      The literals and the names between them, or none if the template uses
+      any other Jinja2 syntax.
+    """
+    parts = _SUBST_REGEX.split(template)
+    literals = parts[0 :: 2]
+    names = parts[1 :: 2]
+    if (
+            "\r" in template
+            or not all( _is_jinja_free(l) for l in literals )
+            # A brace preceding a substitution changes how Jinja2 lexes it.
+            or any( l.endswith("{") for l in literals[: -1] )
+            or any( n in _JINJA_CONSTANTS for n in names )
+    ):
+        return None
+    return literals, names
+
+
+@memoize_lru(TEMPLATE_CACHE_SIZE)
+def _get_template(template):
+    """
+    Compiles `template` to a function that renders it with an args dict.
+
+    A template with no Jinja2 syntax renders to itself, and one containing only
+    simple `{{ name }}` substitutions renders by direct lookup.  Anything else
+    is rendered by Jinja2.
+    """
+    if (split := _split_template(template)) is None:
+        return _get_jinja_template(template).render
+    literals, names = split
+
+    # Jinja2 drops a single trailing newline from the template.
+    if literals[-1].endswith("\n"):
+        literals[-1] = literals[-1][: -1]
+
+    if len(names) == 0:
+        literal, = literals
+        return lambda args: literal
+
+    jinja_template = None
+
+    def render(args):
+        nonlocal jinja_template
+        try:
+            values = [ args[n] for n in names ]
+        except KeyError:
+            # Let Jinja2 resolve globals, or raise NameError.
+            if jinja_template is None:
+                jinja_template = _get_jinja_template(template)
+            return jinja_template.render(args)
+        result = [literals[0]]
+        for value, literal in zip(values, literals[1 :]):
+            result.append(str(value))
+            result.append(literal)
+        return "".join(result)
+
+    return render
+
+
+def get_template_stats():
+    """
+    Returns statistics for the compiled template cache.
+    """
+    return _get_template.__memo__.get_stats()
+
+
 def template_expand(template, args):
     """
     Expands Jinja2-style `template` with names from `args`.
@@ -134,8 +217,7 @@ def template_expand(template, args):
     :raise NameError:
       The template references a name not in `args`.
     """
-    template = _get_template(str(template))
-    return template.render(args)
+    return _get_template(str(template))(args)
 
 
 def arg_to_bool(arg):
@@ -317,14 +399,98 @@ def get_bind_args(run):
     }
 
 
+# Maximum number of bindings to retain for sharing among runs.
+BIND_CACHE_SIZE = 4096
+
+# Cache of bound conds and program, keyed by job ID, job fingerprint, and args.
+_BIND_CACHE = LRUMemo(BIND_CACHE_SIZE)
+
+def _is_constant(obj, names):
+    """
+    Returns true if the templates in `obj` expand the same for every run with
+    the same args.
+
+    Conservatively, true only if each string in its JSO is free of Jinja2
+    syntax, or contains only simple substitutions of `names`.  Any other
+    template may call functions, such as `Time.now()`, or refer to the run.
+    """
+    def check(jso):
+        match jso:
+            case str():
+                split = _split_template(jso)
+                return split is not None and all( n in names for n in split[1] )
+            case dict():
+                return all( check(v) for v in jso.values() )
+            case list() | tuple():
+                return all( check(v) for v in jso )
+            case _:
+                return True
+
+    return check(obj.to_jso())
+
+
+def _bind_shared(run, job, jobs):
+    """
+    Binds the parts of `job` that may be shared among runs with the same args.
+
+    :return:
+      The bound conds, with none for each cond that must be bound per run, and
+      the bound program, or none if it must be bound per run.
+    """
+    # Names whose values are the same for all runs sharing the binding.
+    names = {"job_id", *run.inst.args}
+    conds = tuple(
+        c.bind(run, jobs)
+        if c.shared_bind and _is_constant(c, names)
+        else None
+        for c in job.conds
+    )
+    program = (
+        job.program.bind(get_bind_args(run))
+        if _is_constant(job.program, names)
+        else None
+    )
+    return conds, program
+
+
 def bind(run, job, jobs):
+    """
+    Binds the actions, conds, and program of `job` to `run`, where not already
+    bound.
+
+    Bound conds and programs whose templates are constant, given the job ID
+    and args, are cached and shared among runs of the same job with the same
+    args.  They must not be modified.
+    """
     if run.actions is None:
         # FIXME: Actions aren't bound, but may be in the future.
         run.actions = list(job.actions)
+    if run.conds is not None and run.program is not None:
+        return
+
+    key = (run.inst.job_id, job.fingerprint, tuple(run.inst.args.items()))
+    try:
+        conds, program = _BIND_CACHE[key]
+    except KeyError:
+        conds, program = _BIND_CACHE[key] = _bind_shared(run, job, jobs)
+
     if run.conds is None:
-        run.conds = [ c.bind(run, jobs) for c in job.conds ]
+        run.conds = [
+            c.bind(run, jobs) if b is None else b
+            for c, b in zip(job.conds, conds)
+        ]
     if run.program is None:
-        run.program = job.program.bind(get_bind_args(run))
+        run.program = (
+            job.program.bind(get_bind_args(run)) if program is None
+            else program
+        )
+
+
+def get_bind_stats():
+    """
+    Returns statistics for the shared binding cache.
+    """
+    return _BIND_CACHE.get_stats()
 
 
 #-------------------------------------------------------------------------------
@@ -97,7 +97,10 @@ class Scheduler:
             return
 
         log.debug(f"scheduling runs until {stop}")
-        for job in self.__jobs.get_jobs():
+        # Ad hoc jobs are never scheduled.
+        for job in self.__jobs.get_jobs(ad_hoc=False):
+            if not any( s.enabled for s in job.schedules ):
+                continue
             items = get_insts_to_schedule(job, self.__stop, stop)
             for sched_time, stop_time, inst in items:
                 await self.__schedule(sched_time, inst, stop_time=stop_time)
@@ -1,7 +1,9 @@
 import asyncio
 import itertools
 import logging
+import mmap
 import ora
+import os
 import re
 import sanic
 import ujson
@@ -13,12 +15,15 @@ from   apsis import procstar
 from   apsis.lib import asyn
 from   apsis.lib.api import (
     response_json, error, time_to_jso, to_bool, encode_response,
+    accepts_encoding,
     runs_to_jso, run_to_summary_jso, job_to_jso,
-    output_metadata_to_jso, run_log_to_jso, output_to_http_message
+    output_metadata_to_jso, run_log_to_jso, output_to_http_message,
+    output_delta_to_http_message,
 )
 import apsis.lib.itr
-from   apsis.lib.parse import parse_duration
+from   apsis.lib.parse import parse_duration, parse_range
 from   apsis.lib.sys import to_signal
+from   apsis.program import OutputDelta
 from   apsis.states import to_state
 from   ..jobs import jso_to_job
 from   ..runs import Instance, RunError
@@ -31,6 +36,8 @@ WS_DRAIN_TIME = 0.5
 WS_CHUNK = 4096
 # Time to sleep between websocket messages.
 WS_CHUNK_SLEEP = 0.001
+# Max number of bytes of output data to send at once.
+OUTPUT_CHUNK_SIZE = 1024 * 1024
 
 #-------------------------------------------------------------------------------
 
@@ -268,19 +275,178 @@ async def run_output_meta(request, run_id):
     return response_json(jso)
 
 
+async def _respond_mapped(request, metadata, compression, data):
+    """
+    Responds with output data from a mapped file, in chunks.
+    """
+    headers = {
+        "Content-Type"      : metadata.content_type,
+        "Content-Length"    : str(len(data)),
+        "Accept-Ranges"     : "bytes",
+    }
+    if compression is not None:
+        headers["Content-Encoding"] = compression
+
+    # Construct the response explicitly; otherwise, sanic reuses the previous
+    # response on a keepalive connection.
+    response = await request.respond(sanic.response.HTTPResponse(
+        headers=headers, content_type=metadata.content_type))
+    for i in range(0, len(data), OUTPUT_CHUNK_SIZE):
+        # Copy each chunk, as the transport may hold on to it after we unmap
+        # the file.
+        await response.send(data[i : i + OUTPUT_CHUNK_SIZE])
+    await response.eof()
+
+
+async def _respond_blob(request, metadata, compression, path):
+    """
+    Responds with the stored data of an output from its blob file.
+
+    Maps the file and sends it in chunks, so that the entire data is never read
+    into memory.
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            await _respond_mapped(request, metadata, compression, b"")
+        else:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                await _respond_mapped(request, metadata, compression, data)
+
+
 @API.route("/runs/<run_id>/output/<output_id>", methods={"GET"})
 async def run_output(request, run_id, output_id):
+    outputs = request.app.apsis.outputs
+
+    if (range_header := request.headers.get("Range")) is not None:
+        # Byte ranges refer to the uncompressed data, which we send without
+        # content encoding.
+        try:
+            length = outputs.get_metadata(run_id)[output_id].length
+        except LookupError as exc:
+            return error(exc, 404)
+        try:
+            byte_range = parse_range(range_header, length)
+        except ValueError as exc:
+            response = error(exc, 416)
+            response.headers["Content-Range"] = f"bytes */{length}"
+            return response
+        if byte_range is not None:
+            try:
+                data = outputs.get_output_range(run_id, output_id, *byte_range)
+            except LookupError as exc:
+                return error(exc, 404)
+            return sanic.response.raw(data.data, status=206, headers={
+                "Content-Type"      : data.metadata.content_type,
+                "Content-Range"     :
+                    f"bytes {data.start}-{data.stop - 1}/{length}",
+                "Accept-Ranges"     : "bytes",
+            })
+
+    try:
+        blob = outputs.get_output_blob(run_id, output_id)
+    except LookupError as exc:
+        return error(exc, 404)
+    if blob is not None and accepts_encoding(request.headers, blob[1]):
+        # Serve directly from the blob file.
+        return await _respond_blob(request, *blob)
+
+    if (mapped := outputs.map_output(run_id, output_id)) is not None:
+        # A running output spilled to a file; serve it from the file.
+        metadata, data = mapped
+        with data:
+            return await _respond_mapped(request, metadata, None, data)
+
     try:
-        output = request.app.apsis.outputs.get_output(run_id, output_id)
+        output = outputs.get_output(run_id, output_id)
     except LookupError as exc:
         return error(exc, 404)
     else:
         headers, data = encode_response(
             request.headers, output.data, output.compression)
         headers["Content-Type"] = output.metadata.content_type
+        headers["Accept-Ranges"] = "bytes"
         return sanic.response.raw(data, headers=headers)
 
 
+@API.route("/runs/<run_id>/output/<output_id>/lines", methods={"GET"})
+async def run_output_lines(request, run_id, output_id):
+    """
+    Returns a range of lines of output.
+
+    Query `start` and `stop` specify the line range, or `tail` the number of
+    lines at the end.  The response header `X-Lines` contains the start and
+    stop line numbers of the returned lines, and the total number of lines.
+    """
+    query = parse_query(request.query_string)
+    try:
+        start = int(query.get("start", 0))
+        stop = None if (s := query.get("stop")) is None else int(s)
+        tail = None if (t := query.get("tail")) is None else int(t)
+    except ValueError as exc:
+        return error(exc, 400)
+    if start < 0 or (stop is not None and stop < 0) or (
+            tail is not None and tail < 0):
+        return error("negative line number", 400)
+
+    try:
+        lines = request.app.apsis.outputs.get_output_lines(
+            run_id, output_id, start, stop, tail=tail)
+    except LookupError as exc:
+        return error(exc, 404)
+    return sanic.response.raw(lines.data, headers={
+        "Content-Type"  : lines.metadata.content_type,
+        "X-Lines"       : f"{lines.start} {lines.stop} {lines.num_lines}",
+    })
+
+
+@API.route("/outputs/search", methods={"GET"})
+async def outputs_search(request):
+    """
+    Searches the text of finished outputs.
+
+    Query `q` is an SQLite FTS5 query.  Optional `job_id` limits to runs of a
+    job, `since` to runs with timestamps since a time or a duration ago, and
+    `limit` the number of matches.
+    """
+    query = parse_query(request.query_string)
+    try:
+        q = query["q"]
+    except KeyError:
+        return error("missing q", 400)
+    job_id = query.get("job_id", None)
+
+    since = query.get("since", None)
+    if since is not None:
+        # Either an absolute time or a duration ago.
+        try:
+            since = ora.Time(since)
+        except ValueError:
+            try:
+                since = ora.now() - parse_duration(since)
+            except ValueError:
+                return error(f"invalid since: {since}", 400)
+
+    try:
+        limit = int(query.get("limit", 100))
+    except ValueError as exc:
+        return error(exc, 400)
+
+    try:
+        matches = request.app.apsis.outputs.search(
+            q, job_id=job_id, since=since, limit=limit)
+    except RuntimeError as exc:
+        return error(exc, 404)
+    except ValueError as exc:
+        return error(exc, 400)
+
+    return response_json({
+        "matches": [
+            m | {"timestamp": time_to_jso(m["timestamp"])}
+            for m in matches
+        ],
+    })
+
+
 @API.websocket("/runs/<run_id>/output/<output_id>/updates")
 async def websocket_output_updates(request, ws, run_id, output_id):
     query = parse_query(request.query_string)
@@ -302,33 +468,44 @@ async def websocket_output_updates(request, ws, run_id, output_id):
         if start is not None:
             # Send existing outputs.
             try:
-                output = apsis.outputs.get_output(run_id, output_id)
+                data = apsis.outputs.get_output_range(run_id, output_id, start)
             except LookupError:
                 log.warning(f"no output: {run_id} {output_id}")
             else:
-                msg = output_to_http_message(output, interval=(start, None))
-                await ws.send(msg)
+                await ws.send(output_delta_to_http_message(data))
 
     else:
         # The run is not finished, so subscribe for live updates.
         with apsis.output_update_publisher.subscription(run_id) as sub:
             try:
-                output = apsis.outputs.get_output(run_id, output_id)
-                if start is not None and output.compression is None:
+                if start is None:
+                    metadata = apsis.outputs.get_metadata(run_id)[output_id]
+                    cur = metadata.length
+                else:
                     # Send the output data up to now.
-                    msg = output_to_http_message(output, interval=(start, None))
-                    await ws.send(msg)
-                cur = output.metadata.length
+                    data = apsis.outputs.get_output_range(
+                        run_id, output_id, start)
+                    await ws.send(output_delta_to_http_message(data))
+                    cur = data.stop
             except LookupError:
                 # No output yet.
                 cur = 0
 
             async for output in sub:
-                if output.compression is not None:
+                if isinstance(output, OutputDelta):
+                    # Only newly appended data.
+                    if output.stop <= cur:
+                        continue
+                    msg = output_delta_to_http_message(
+                        output, start=max(cur, output.start))
+
+                elif output.compression is not None:
                     # Compressed output means the run is finished.
                     break
 
-                msg = output_to_http_message(output, interval=(cur, None))
+                else:
+                    msg = output_to_http_message(output, interval=(cur, None))
+
                 await ws.send(msg)
                 cur = output.metadata.length
 
@@ -212,13 +212,65 @@ class Client:
         return resp.json()
 
 
-    def get_output(self, run_id, output_id) -> bytes:
+    def get_output(self, run_id, output_id, *, start=None, stop=None) -> bytes:
+        """
+        Returns output data.
+
+        :param start:
+          If not none, the offset of the first byte to return.
+        :param stop:
+          If not none, the offset past the last byte to return.
+        """
         url = self.__url("/api/v1/runs", run_id, "output", output_id)
+        if start is None and stop is None:
+            headers = {}
+        else:
+            # Not a suffix range, which would count from the end.
+            first = 0 if start is None else start
+            last = "" if stop is None else stop - 1
+            headers = {"Range": f"bytes={first}-{last}"}
+        resp = requests.get(url, headers=headers)
+        resp.raise_for_status()
+        return resp.content
+
+
+    def get_output_lines(
+            self, run_id, output_id, *, start=None, stop=None, tail=None
+    ) -> bytes:
+        """
+        Returns lines of output data.
+
+        :param start:
+          If not none, the number of the first line to return.
+        :param stop:
+          If not none, the number past the last line to return.
+        :param tail:
+          If not none, returns this many lines at the end instead.
+        """
+        url = self.__url(
+            "/api/v1/runs", run_id, "output", output_id, "lines",
+            start=start, stop=stop, tail=tail
+        )
         resp = requests.get(url)
         resp.raise_for_status()
         return resp.content
 
 
+    def search_outputs(self, query, *, job_id=None, since=None, limit=None):
+        """
+        Searches the text of finished outputs.
+
+        :param query:
+          An SQLite FTS5 query.
+        :return:
+          Matches, most recent runs first.
+        """
+        return self.__get(
+            "/api/v1/outputs/search",
+            q=query, job_id=job_id, since=since, limit=limit
+        )["matches"]
+
+
     @asynccontextmanager
     async def get_output_data_updates(self, run_id, output_id, start=None):
         """
@@ -11,6 +11,8 @@ from   apsis.apsis import Apsis
 from   apsis.exc import JobsDirErrors
 from   apsis.jobs import load_jobs_dir
 from   apsis.lib.asyn import cancel_task
+from   apsis.lib.blob import BlobStore
+from   apsis.lib.py import get_cfg
 from   apsis.sqlite import SqliteDB
 from   . import api, control, procstar
 from   . import DEFAULT_PORT
@@ -68,8 +70,22 @@ def build_apsis(cfg):
     db_cfg = cfg["database"]
     db_path = db_cfg["path"]
 
+    blob_cfg = get_cfg(cfg, "output.blob", {})
+    if blob_cfg.get("enable", False):
+        blob_path = blob_cfg["path"]
+        log.info(f"opening output blob store {blob_path}")
+        blobs = BlobStore(blob_path)
+    else:
+        blobs = None
+
     log.info(f"opening state file {db_path}")
-    db = SqliteDB.open(db_path, timeout=db_cfg.get("timeout"))
+    db = SqliteDB.open(
+        db_path,
+        timeout         =db_cfg.get("timeout"),
+        blobs           =blobs,
+        blob_min_size   =blob_cfg.get("min_size", 1024 * 1024),
+        search          =get_cfg(cfg, "output.search.enable", False),
+    )
 
     job_dir = cfg["job_dir"]
     log.info(f"opening jobs dir {job_dir}")
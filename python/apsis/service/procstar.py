@@ -2,7 +2,7 @@ import logging
 import sanic
 
 from   apsis.lib.api import error, response_json
-from   apsis.procstar import get_agent_server, NoServerError
+from   apsis.procstar import get_agent_server, get_placement, NoServerError
 
 log = logging.getLogger(__name__)
 
@@ -29,13 +29,20 @@ def on_connections(request):
 def on_groups(request):
     """
     Returns a mapping from group ID to list of connection info.
+
+    Each connection's info includes `num_runs`, the number of its running runs.
     """
     try:
         server = get_agent_server()
     except NoServerError as err:
         return error(str(err))
+    placement = get_placement()
     return response_json({
-        i: [ server.connections[c].to_jso() for c in g ]
+        i: [
+            server.connections[c].to_jso()
+            | {"num_runs": placement.get_num_runs(c)}
+            for c in g
+        ]
         for i, g in server.connections.groups.items()
     })
 
@@ -2,21 +2,27 @@
 Persistent state stored in a sqlite file.
 """
 
+import brotli
 import contextlib
 import logging
 import ora
+import os
 from   pathlib import Path
 import sqlalchemy as sa
+import sqlite3
 import ujson
 
 from   .actions.base import Action
 from   .cond.base import Condition
 from   .jobs import jso_to_job, job_to_jso
 from   .lib import itr
+from   .lib.api import decompress
+from   .lib.blob import new_hash
+from   .lib.cmpr import BR_CHUNKED, FRAME_SIZE, read_frames
 from   .lib.timing import Timer
 from   .runs import Instance, Run
 from   .states import State
-from   .program import Program, Output, OutputMetadata
+from   .program import Program, Output, OutputDelta, OutputMetadata
 
 log = logging.getLogger(__name__)
 
@@ -215,46 +221,90 @@ class JobDB:
     Deprecated.
 
     Ad hoc runs serialize the entire job in the run; this table isn't needed.
+
+    Jobs are loaded into memory on first access, and the in-memory index is
+    maintained write-through, so lookups and queries don't touch the DB.
     """
 
     def __init__(self, engine):
         self.__engine = engine
+        # Mapping from job ID to job; none until loaded.
+        self.__jobs = None
+
+
+    def __load(self):
+        if self.__jobs is None:
+            jobs = {}
+            with Timer() as timer, self.__engine.begin() as conn:
+                for job_id, job in conn.execute(sa.select([TBL_JOBS])):
+                    try:
+                        jobs[job_id] = jso_to_job(ujson.loads(job), job_id)
+                    except Exception as exc:
+                        log.error(f"failed to load job from DB: {exc}")
+            log.info(f"loaded {len(jobs)} jobs in {timer.elapsed:.3f} s")
+            self.__jobs = jobs
+        return self.__jobs
 
 
     def insert(self, job):
+        jobs = self.__load()
         # FIXME: Check that the job ID doesn't exist already
         with self.__engine.begin() as conn:
             conn.execute(TBL_JOBS.insert().values(
                 job_id  =job.job_id,
                 job     =ujson.dumps(job_to_jso(job)),
             ))
+        jobs[job.job_id] = job
 
 
     def get(self, job_id):
-        with self.__engine.begin() as conn:
-            query = sa.select([TBL_JOBS]).where(TBL_JOBS.c.job_id == job_id)
-            rows = list(conn.execute(query))
-            assert len(rows) <= 1
-
-            if len(rows) == 0:
-                raise LookupError(job_id)
-            else:
-                (_, job), = rows
-                return jso_to_job(ujson.loads(job), job_id)
+        try:
+            return self.__load()[job_id]
+        except KeyError:
+            raise LookupError(job_id) from None
 
 
     def query(self, *, ad_hoc=None):
-        query = sa.select([TBL_JOBS])
-        with self.__engine.begin() as conn:
-            for job_id, job in conn.execute(query):
-                # FIXME: Filter ad hoc jobs in the query.
-                try:
-                    job = jso_to_job(ujson.loads(job), job_id)
-                except Exception as exc:
-                    logging.error(f"failed to load job from DB: {exc}")
-                    continue
-                if ad_hoc is None or job.ad_hoc == ad_hoc:
-                    yield job
+        for job in self.__load().values():
+            if ad_hoc is None or job.ad_hoc == ad_hoc:
+                yield job
+
+
+    def delete_orphans(self, conn):
+        """
+        Deletes jobs that no longer have associated runs.
+
+        :param conn:
+          Connection in which to perform the deletion.  The caller must call
+          `discard()` with the result after this transaction commits.
+        :return:
+          The deleted job IDs.
+        """
+        job_ids = [
+            job_id
+            for job_id, in conn.execute(
+                """
+                SELECT jobs.job_id
+                FROM jobs
+                LEFT OUTER JOIN runs
+                ON runs.job_id = jobs.job_id
+                WHERE runs.run_id IS NULL
+                """
+            )
+        ]
+        if len(job_ids) > 0:
+            conn.execute(
+                sa.delete(TBL_JOBS).where(TBL_JOBS.c.job_id.in_(job_ids)))
+        return job_ids
+
+
+    def discard(self, job_ids):
+        """
+        Removes `job_ids` from the in-memory index.
+        """
+        if self.__jobs is not None:
+            for job_id in job_ids:
+                self.__jobs.pop(job_id, None)
 
 
 
@@ -542,10 +592,31 @@ class RunLogDB:
 
 #-------------------------------------------------------------------------------
 
+def _reader(file):
+    """
+    Returns a function that reads `length` bytes at `offset` from `file`.
+    """
+    def read(offset, length):
+        file.seek(offset)
+        return file.read(length)
+
+    return read
+
+
 class OutputDB:
     """
     We store even large outputs in the SQLite database, which should generally
     be efficient.  See https://www.sqlite.org/intern-v-extern-blob.html.
+
+    Optionally, outputs whose stored data is at least `blob_min_size` are
+    instead written to an external content-addressed blob store.  The output
+    row then contains empty data, and a row in the blob table holds the
+    digest of the blob.  Blobs are keyed on the uncompressed data, so an output
+    whose data is already stored, with any compression, shares that blob, and
+    takes on its compression.
+
+    For an output truncated by a retention policy, a row in the total length
+    table holds the length of the complete output.
     """
 
     TABLE = sa.Table(
@@ -560,14 +631,107 @@ class OutputDB:
         sa.PrimaryKeyConstraint("run_id", "output_id")
     )
 
-    def __init__(self, engine):
+    BLOB_TABLE = sa.Table(
+        "output_blob", METADATA,
+        sa.Column("run_id"      , sa.String()   , nullable=False),
+        sa.Column("output_id"   , sa.String()   , nullable=False),
+        sa.Column("digest"      , sa.String()   , nullable=False),
+        sa.PrimaryKeyConstraint("run_id", "output_id")
+    )
+
+    LINE_INDEX_TABLE = sa.Table(
+        "output_line_index", METADATA,
+        sa.Column("run_id"      , sa.String()   , nullable=False),
+        sa.Column("output_id"   , sa.String()   , nullable=False),
+        sa.Column("data"        , sa.BINARY()   , nullable=False),
+        sa.PrimaryKeyConstraint("run_id", "output_id")
+    )
+
+    TOTAL_LENGTH_TABLE = sa.Table(
+        "output_total_length", METADATA,
+        sa.Column("run_id"      , sa.String()   , nullable=False),
+        sa.Column("output_id"   , sa.String()   , nullable=False),
+        sa.Column("total_length", sa.Integer()  , nullable=False),
+        sa.PrimaryKeyConstraint("run_id", "output_id")
+    )
+
+    # Size of chunks for incremental BLOB I/O.
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(
+            self, engine, *, blobs=None, blob_min_size=1024 * 1024,
+            timeout=None
+    ):
+        """
+        :param blobs:
+          A `BlobStore` for large outputs, or none to store all outputs in the
+          database.
+        :param blob_min_size:
+          Minimum size of stored data to write to `blobs`.
+        :param timeout:
+          Timeout for connections from `connect()` waiting on database locks.
+        """
         self.__engine = engine
+        self.__timeout = timeout
         self.__connection = engine.connect().connection
+        self.__blobs = blobs
+        self.__blob_min_size = blob_min_size
+        self.BLOB_TABLE.create(engine, checkfirst=True)
+        self.LINE_INDEX_TABLE.create(engine, checkfirst=True)
+        self.TOTAL_LENGTH_TABLE.create(engine, checkfirst=True)
 
 
-    def upsert(self, run_id: str, output_id: str, output: Output):
-        self.__connection.connection.execute(
-            """
+    @property
+    def blobs(self):
+        return self.__blobs
+
+
+    def connect(self):
+        """
+        Opens a new connection to the database, for writing outputs in another
+        thread.
+
+        """
+        path = self.__engine.url.database
+        if not path:
+            raise RuntimeError("can't share a memory database")
+        kw_args = {} if self.__timeout is None else {"timeout": self.__timeout}
+        return sqlite3.connect(path, **kw_args)
+
+
+    def __use_blob(self, length):
+        return self.__blobs is not None and length >= self.__blob_min_size
+
+
+    def __upsert_line_index(self, run_id, output_id, line_index, con=None):
+        con = self.__connection.connection if con is None else con
+        if line_index is None:
+            con.execute(
+                """
+                DELETE FROM output_line_index
+                 WHERE run_id = ? AND output_id = ?
+                """,
+                (run_id, output_id)
+            )
+        else:
+            con.execute(
+                """
+                INSERT INTO output_line_index (run_id, output_id, data)
+                VALUES (?, ?, ?)
+                ON CONFLICT(run_id, output_id)
+                DO UPDATE SET data = excluded.data
+                """,
+                (run_id, output_id, line_index)
+            )
+
+
+    def __upsert_row(
+            self, run_id, output_id, metadata, compression, data, *,
+            zeroblob=False, digest=None, line_index=None, con=None
+    ):
+        con = self.__connection.connection if con is None else con
+        con.execute(
+            f"""
             INSERT INTO output (
                 run_id,
                 output_id,
@@ -577,7 +741,7 @@ class OutputDB:
                 compression,
                 data
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, {"zeroblob(?)" if zeroblob else "?"})
             ON CONFLICT(run_id, output_id)
             DO UPDATE SET
                 name            = excluded.name,
@@ -589,16 +753,129 @@ class OutputDB:
             (
                 run_id,
                 output_id,
-                output.metadata.name,
-                output.metadata.content_type,
-                output.metadata.length,
-                output.compression,
-                output.data,
+                metadata.name,
+                metadata.content_type,
+                metadata.length,
+                compression,
+                data,
             )
         )
+
+        if digest is None:
+            con.execute(
+                "DELETE FROM output_blob WHERE run_id = ? AND output_id = ?",
+                (run_id, output_id)
+            )
+        else:
+            con.execute(
+                """
+                INSERT INTO output_blob (run_id, output_id, digest)
+                VALUES (?, ?, ?)
+                ON CONFLICT(run_id, output_id)
+                DO UPDATE SET digest = excluded.digest
+                """,
+                (run_id, output_id, digest)
+            )
+
+        if metadata.total_length is None:
+            con.execute(
+                """
+                DELETE FROM output_total_length
+                 WHERE run_id = ? AND output_id = ?
+                """,
+                (run_id, output_id)
+            )
+        else:
+            con.execute(
+                """
+                INSERT INTO output_total_length
+                    (run_id, output_id, total_length)
+                VALUES (?, ?, ?)
+                ON CONFLICT(run_id, output_id)
+                DO UPDATE SET total_length = excluded.total_length
+                """,
+                (run_id, output_id, metadata.total_length)
+            )
+
+        self.__upsert_line_index(run_id, output_id, line_index, con)
+
+
+    def upsert(
+            self, run_id: str, output_id: str, output: Output, *,
+            line_index=None
+    ):
+        """
+        Inserts or replaces an output.
+
+        :param line_index:
+          Serialized line index for the output, or none.
+        """
+        if self.__use_blob(len(output.data)):
+            if output.compression is None:
+                digest = None
+            else:
+                digest = new_hash()
+                digest.update(output.get_uncompressed_data())
+                digest = digest.hexdigest()
+            digest, compression = self.__blobs.put(
+                output.data, digest=digest, encoding=output.compression)
+            self.__upsert_row(
+                run_id, output_id, output.metadata, compression, b"",
+                digest=digest, line_index=line_index,
+            )
+        else:
+            self.__upsert_row(
+                run_id, output_id, output.metadata, output.compression,
+                output.data, line_index=line_index,
+            )
         self.__connection.connection.commit()
 
 
+    def upsert_file(
+            self, run_id: str, output_id: str, metadata: OutputMetadata,
+            file, length: int, *, compression=None, digest=None,
+            line_index=None, con=None
+    ):
+        """
+        Inserts or replaces an output, streaming data from `file`.
+
+        Reads `length` bytes of (possibly compressed) data from the current
+        position of `file` in chunks, and writes them into the database using
+        incremental BLOB I/O, or into the blob store, so the data is never held
+        in memory at once.
+
+        :param digest:
+          Blob digest of the uncompressed data.  Required to write compressed
+          data to the blob store.
+        :param con:
+          Connection to use, for example one from `connect()` to write in
+          another thread, or none for this instance's connection.
+        """
+        con = self.__connection.connection if con is None else con
+        if self.__use_blob(length):
+            digest, compression = self.__blobs.put_file(
+                file, length, digest=digest, encoding=compression)
+            self.__upsert_row(
+                run_id, output_id, metadata, compression, b"",
+                digest=digest, line_index=line_index, con=con,
+            )
+            con.commit()
+            return
+
+        self.__upsert_row(
+            run_id, output_id, metadata, compression, length,
+            zeroblob=True, line_index=line_index, con=con,
+        )
+        (rowid, ), = con.execute(
+            "SELECT rowid FROM output WHERE run_id = ? AND output_id = ?",
+            (run_id, output_id)
+        )
+        with con.blobopen("output", "data", rowid) as blob:
+            while len(chunk := file.read(self.CHUNK_SIZE)) > 0:
+                blob.write(chunk)
+        con.commit()
+
+
     def get_metadata(self, run_id):
         """
         Returns all output metadata for run `run_id`.
@@ -607,14 +884,34 @@ class OutputDB:
           A mapping from output ID to `OutputMetadata` instances.  If no output
           is stored for `run_id`, returns an empty dict.
         """
-        cols    = self.TABLE.c
-        columns = [cols.output_id, cols.name, cols.content_type, cols.length]
-        query   = sa.select(*columns).where(cols.run_id == run_id)
-        with self.__engine.connect() as conn:
-            return {
-                r[0]: OutputMetadata(name=r[1], length=r[3], content_type=r[2])
-                for r in conn.execute(query)
-            }
+        rows = self.__connection.connection.execute(
+            """
+            SELECT output_id, name, content_type, length, total_length
+              FROM output
+              LEFT JOIN output_total_length USING (run_id, output_id)
+             WHERE run_id = ?
+            """,
+            (run_id, )
+        )
+        return {
+            r[0]: OutputMetadata(
+                name=r[1], length=r[3], content_type=r[2], total_length=r[4])
+            for r in rows
+        }
+
+
+    def __get_digest(self, run_id, output_id):
+        rows = list(self.__connection.connection.execute(
+            "SELECT digest FROM output_blob WHERE run_id = ? AND output_id = ?",
+            (run_id, output_id)
+        ))
+        return None if len(rows) == 0 else rows[0][0]
+
+
+    def __get_blobs(self):
+        if self.__blobs is None:
+            raise RuntimeError("output is in blob store, but none configured")
+        return self.__blobs
 
 
     def get_output(self, run_id, output_id) -> Output:
@@ -624,35 +921,457 @@ class OutputDB:
         :raise LookupError:
           No output for `run_id, output_id`.
         """
-        cols = self.TABLE.c
-        query = (
-            sa.select(
-                cols.name,
-                cols.length,
-                cols.content_type,
-                cols.data,
-                cols.compression,
-            )
-            .where((cols.run_id == run_id) & ((cols.output_id == output_id)))
-        )
-        with self.__engine.connect() as conn:
-            rows = list(conn.execute(query))
+        rows = list(self.__connection.connection.execute(
+            """
+            SELECT name, length, content_type, data, compression, total_length
+              FROM output
+              LEFT JOIN output_total_length USING (run_id, output_id)
+             WHERE run_id = ? AND output_id = ?
+            """,
+            (run_id, output_id)
+        ))
         if len(rows) == 0:
             raise LookupError(f"no output {output_id} for {run_id}")
         else:
             r, = rows
+            data = r[3]
+            if (digest := self.__get_digest(run_id, output_id)) is not None:
+                data = self.__get_blobs().read(digest)
             return Output(
-                OutputMetadata(r[0], r[1], content_type=r[2]),
-                data=r[3],
+                OutputMetadata(r[0], r[1], content_type=r[2], total_length=r[5]),
+                data=data,
                 compression=r[4],
             )
 
 
+    def __get_row(self, run_id, output_id, con=None):
+        con = self.__connection.connection if con is None else con
+        rows = list(con.execute(
+            """
+            SELECT output.rowid, name, length, content_type, compression,
+                   digest, total_length
+              FROM output
+              LEFT JOIN output_blob USING (run_id, output_id)
+              LEFT JOIN output_total_length USING (run_id, output_id)
+             WHERE run_id = ? AND output_id = ?
+            """,
+            (run_id, output_id)
+        ))
+        if len(rows) == 0:
+            raise LookupError(f"no output {output_id} for {run_id}")
+        (
+            rowid, name, length, content_type, compression, digest,
+            total_length
+        ), = rows
+        metadata = OutputMetadata(
+            name, length, content_type=content_type, total_length=total_length)
+        return rowid, metadata, compression, digest
+
+
+    @contextlib.contextmanager
+    def __open_data(self, rowid, digest, con=None):
+        """
+        Opens stored data for reading, from the blob store or database.
+
+        :return:
+          The open file, and its size.
+        """
+        if digest is None:
+            con = self.__connection.connection if con is None else con
+            with con.blobopen("output", "data", rowid, readonly=True) as blob:
+                yield blob, len(blob)
+        else:
+            with self.__get_blobs().open(digest) as file:
+                yield file, os.fstat(file.fileno()).st_size
+
+
+    def get_output_range(
+            self, run_id, output_id, start=0, stop=None
+    ) -> OutputDelta:
+        """
+        Returns uncompressed output data in `[start, stop)`.
+
+        Reads only the requested range, or for chunked compressed outputs only
+        the frames containing it, with incremental BLOB I/O or from the blob
+        file.
+
+        :raise LookupError:
+          No output for `run_id, output_id`.
+        """
+        rowid, metadata, compression, digest = self.__get_row(
+            run_id, output_id)
+        length = metadata.length
+        start = min(start, length)
+        stop = length if stop is None else max(start, min(stop, length))
+        if stop <= start:
+            return OutputDelta(metadata, start, b"")
+
+        with self.__open_data(rowid, digest) as (file, size):
+            if compression is None:
+                file.seek(start)
+                data = file.read(stop - start)
+            elif compression == BR_CHUNKED:
+                # Decompress only the frames we need.
+                data = read_frames(_reader(file), size, start, stop)
+            else:
+                # Decompress the entire output.
+                data = decompress(file.read(), compression)[start : stop]
+        return OutputDelta(metadata, start, data)
+
+
+    def iter_output_data(self, run_id, output_id, *, con=None):
+        """
+        Generates the uncompressed data of an output, in chunks.
+
+        :param con:
+          A DB-API connection to use instead of our own, for use in another
+          thread.
+        :raise LookupError:
+          No output for `run_id, output_id`.
+        """
+        rowid, metadata, compression, digest = self.__get_row(
+            run_id, output_id, con)
+        with self.__open_data(rowid, digest, con) as (file, size):
+            if compression is None:
+                while len(chunk := file.read(self.CHUNK_SIZE)) > 0:
+                    yield chunk
+            elif compression == BR_CHUNKED:
+                read = _reader(file)
+                for start in range(0, metadata.length, FRAME_SIZE):
+                    yield read_frames(read, size, start, start + FRAME_SIZE)
+            elif compression == "br":
+                decompressor = brotli.Decompressor()
+                while len(chunk := file.read(self.CHUNK_SIZE)) > 0:
+                    yield decompressor.process(chunk)
+            else:
+                yield decompress(file.read(), compression)
+
+
+    def get_line_index(self, run_id, output_id):
+        """
+        Returns the serialized line index for an output, or none if none is
+        stored.
+        """
+        rows = list(self.__connection.connection.execute(
+            """
+            SELECT data FROM output_line_index
+             WHERE run_id = ? AND output_id = ?
+            """,
+            (run_id, output_id)
+        ))
+        return None if len(rows) == 0 else rows[0][0]
+
+
+    def upsert_line_index(self, run_id, output_id, line_index: bytes):
+        """
+        Stores the serialized line index for an existing output.
+        """
+        self.__upsert_line_index(run_id, output_id, line_index)
+        self.__connection.connection.commit()
+
+
+    @staticmethod
+    def get_blob_digests(path):
+        """
+        Returns the digests of blobs referenced by outputs in the database or
+        archive file at `path`.
+        """
+        with contextlib.closing(
+                sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        ) as con:
+            try:
+                rows = con.execute("SELECT DISTINCT digest FROM output_blob")
+            except sqlite3.OperationalError:
+                # No blob table; an older file.
+                return set()
+            return { d for d, in rows }
+
+
+    def get_output_blob(self, run_id, output_id):
+        """
+        Returns the blob file for an output, if it is in the blob store.
+
+        :return:
+          The output metadata, compression, and path to the file containing
+          its stored data; or none if the output is stored in the database.
+        :raise LookupError:
+          No output for `run_id, output_id`.
+        """
+        digest = self.__get_digest(run_id, output_id)
+        if digest is None:
+            return None
+        path, _ = self.__get_blobs().find(digest)
+
+        rows = list(self.__connection.connection.execute(
+            """
+            SELECT name, length, content_type, compression, total_length
+              FROM output
+              LEFT JOIN output_total_length USING (run_id, output_id)
+             WHERE run_id = ? AND output_id = ?
+            """,
+            (run_id, output_id)
+        ))
+        if len(rows) == 0:
+            raise LookupError(f"no output {output_id} for {run_id}")
+        (name, length, content_type, compression, total_length), = rows
+        metadata = OutputMetadata(
+            name, length, content_type=content_type, total_length=total_length)
+        return metadata, compression, path
+
+
+
+def _find_split(buf, size):
+    """
+    Returns where to split the first chunk of at most `size` bytes from `buf`,
+    so as not to split a line, or failing that a word or UTF-8 character.
+
+    `buf` must be longer than `size`.
+    """
+    # After the last newline.
+    end = buf.rfind(b"\n", 0, size) + 1
+    if end > 0:
+        return end
+    # A line longer than a chunk; after the last whitespace.
+    end = max(buf.rfind(b" ", 0, size), buf.rfind(b"\t", 0, size)) + 1
+    if end > 0:
+        return end
+    # Not in the middle of a UTF-8 sequence.
+    end = size
+    while end > size - 3 and buf[end] & 0xc0 == 0x80:
+        end -= 1
+    return end
+
+
+class OutputSearchDB:
+    """
+    Full-text index of finished outputs, using SQLite FTS5.
+
+    Each output is indexed in chunks of at most `CHUNK_SIZE` bytes, split at
+    line boundaries where possible, so that a match is located by the offset of
+    its chunk.  The
+    `output_search` table records the range of FTS rowids for each output, so
+    they can be removed without scanning the index.
+    """
+
+    TABLE = sa.Table(
+        "output_search", METADATA,
+        sa.Column("run_id"      , sa.String()   , nullable=False),
+        sa.Column("output_id"   , sa.String()   , nullable=False),
+        sa.Column("rowid_start" , sa.Integer()  , nullable=False),
+        sa.Column("rowid_stop"  , sa.Integer()  , nullable=False),
+        sa.PrimaryKeyConstraint("run_id", "output_id")
+    )
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, engine, output_db, *, timeout=None):
+        self.__engine = engine
+        self.__output_db = output_db
+        self.__timeout = timeout
+        self.__connection = engine.connect().connection
+        self.TABLE.create(engine, checkfirst=True)
+        self.__connection.connection.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS output_fts USING fts5(
+                text,
+                run_id UNINDEXED,
+                output_id UNINDEXED,
+                "offset" UNINDEXED
+            )
+            """
+        )
+        self.__connection.connection.commit()
+
+
+    def connect(self):
+        """
+        Opens a new connection to the database, for indexing in another thread.
+        """
+        path = self.__engine.url.database
+        if not path:
+            raise RuntimeError("can't index outputs in a memory database")
+        kw_args = {} if self.__timeout is None else {"timeout": self.__timeout}
+        return sqlite3.connect(path, **kw_args)
+
+
+    @staticmethod
+    def _delete(con, run_id, output_id):
+        """
+        Removes index entries for an output.
+        """
+        rows = list(con.execute(
+            """
+            SELECT rowid_start, rowid_stop FROM output_search
+             WHERE run_id = ? AND output_id = ?
+            """,
+            (run_id, output_id)
+        ))
+        for start, stop in rows:
+            con.execute(
+                "DELETE FROM output_fts WHERE rowid >= ? AND rowid < ?",
+                (start, stop)
+            )
+        con.execute(
+            "DELETE FROM output_search WHERE run_id = ? AND output_id = ?",
+            (run_id, output_id)
+        )
+
+
+    def index_output(self, con, run_id, output_id) -> int:
+        """
+        Indexes output, replacing any previous index for it.
+
+        Commits after each chunk of output data, so that the database isn't
+        locked for long.
+
+        :param con:
+          A DB-API connection, from `connect()`.
+        :return:
+          The number of bytes indexed.
+        """
+        self._delete(con, run_id, output_id)
+        con.commit()
+
+        rowid_start = rowid_stop = None
+        offset = 0
+        buf = bytearray()
+
+        def insert(data):
+            nonlocal rowid_start, rowid_stop, offset
+            cursor = con.execute(
+                """
+                INSERT INTO output_fts (text, run_id, output_id, "offset")
+                VALUES (?, ?, ?, ?)
+                """,
+                (data.decode(errors="replace"), run_id, output_id, offset)
+            )
+            if rowid_start is None:
+                rowid_start = cursor.lastrowid
+            rowid_stop = cursor.lastrowid + 1
+            offset += len(data)
+
+        def record():
+            if rowid_start is not None:
+                con.execute(
+                    """
+                    INSERT INTO output_search
+                        (run_id, output_id, rowid_start, rowid_stop)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(run_id, output_id)
+                    DO UPDATE SET rowid_stop = excluded.rowid_stop
+                    """,
+                    (run_id, output_id, rowid_start, rowid_stop)
+                )
+            con.commit()
+
+        for chunk in self.__output_db.iter_output_data(
+                run_id, output_id, con=con):
+            buf += chunk
+            # Index a chunk only once we have data after it, so we know
+            # whether it ends mid-line.
+            while len(buf) > self.CHUNK_SIZE:
+                end = _find_split(buf, self.CHUNK_SIZE)
+                insert(bytes(buf[: end]))
+                del buf[: end]
+            record()
+        if len(buf) > 0:
+            insert(bytes(buf))
+        record()
+        return offset
+
+
+    def search(self, query, *, job_id=None, since=None, limit=100):
+        """
+        Searches indexed outputs.
+
+        :param query:
+          An FTS5 query string.
+        :param since:
+          If not none, limits to runs with timestamps at or after this time.
+        :return:
+          Matches, most recent runs first, as dicts with run and output ID, job
+          ID, run timestamp, the offset of the matching chunk of output, and a
+          snippet of the match.
+        :raise ValueError:
+          The query is invalid.
+        """
+        where = ["output_fts MATCH ?"]
+        params = [query]
+        if job_id is not None:
+            where.append("runs.job_id = ?")
+            params.append(job_id)
+        if since is not None:
+            where.append("runs.timestamp >= ?")
+            params.append(dump_time(since))
+        params.append(limit)
+
+        try:
+            rows = list(self.__connection.connection.execute(
+                f"""
+                SELECT output_fts.run_id,
+                       output_fts.output_id,
+                       runs.job_id,
+                       runs.timestamp,
+                       output_fts."offset",
+                       snippet(output_fts, 0, '', '', '…', 16)
+                  FROM output_fts
+                  JOIN runs
+                    ON runs.run_id = output_fts.run_id
+                 WHERE {" AND ".join(where)}
+                 ORDER BY runs.timestamp DESC, output_fts.rowid
+                 LIMIT ?
+                """,
+                params
+            ))
+        except sqlite3.OperationalError as exc:
+            raise ValueError(f"invalid search: {exc}") from None
+
+        return [
+            {
+                "run_id"    : run_id,
+                "output_id" : output_id,
+                "job_id"    : job_id,
+                "timestamp" : load_time(timestamp),
+                "offset"    : offset,
+                "snippet"   : snippet,
+            }
+            for run_id, output_id, job_id, timestamp, offset, snippet in rows
+        ]
+
+
+    @classmethod
+    def prune(cls, tx, run_ids):
+        """
+        Removes index entries for `run_ids`, if there is an index.
+        """
+        con = tx.connection.connection
+        (exists, ), = con.execute(
+            """
+            SELECT COUNT(*) FROM sqlite_master
+             WHERE type = 'table' AND name = 'output_fts'
+            """
+        )
+        if exists:
+            for run_id in run_ids:
+                rows = list(con.execute(
+                    "SELECT output_id FROM output_search WHERE run_id = ?",
+                    (run_id, )
+                ))
+                for output_id, in rows:
+                    cls._delete(con, run_id, output_id)
+
+
 
 #-------------------------------------------------------------------------------
 
 # Tables other than "runs" that need to be archived.
-RUN_TABLES = (RunLogDB.TABLE, OutputDB.TABLE)
+RUN_TABLES = (
+    RunLogDB.TABLE,
+    OutputDB.TABLE,
+    OutputDB.BLOB_TABLE,
+    OutputDB.LINE_INDEX_TABLE,
+    OutputDB.TOTAL_LENGTH_TABLE,
+)
 ARCHIVE_TABLES = (*RUN_TABLES, TBL_RUNS)
 
 class SqliteDB:
@@ -660,10 +1379,17 @@ class SqliteDB:
     A SQLite3 file containing persistent state.
     """
 
-    def __init__(self, engine):
+    def __init__(
+            self, engine, *, blobs=None, blob_min_size=1024 * 1024,
+            search=False, timeout=None
+    ):
         """
         :param path:
           Path to SQLite file.  If `None`, use a memory DB (for testing).
+        :param blobs:
+          Optional `BlobStore` for large outputs.
+        :param search:
+          If true, maintain a full-text index of outputs.
         """
         self.__engine       = engine
         self.clock_db       = ClockDB(engine)
@@ -671,7 +1397,12 @@ class SqliteDB:
         self.job_db         = JobDB(engine)
         self.run_db         = RunDB(engine)
         self.run_log_db     = RunLogDB(engine)
-        self.output_db      = OutputDB(engine)
+        self.output_db      = OutputDB(
+            engine, blobs=blobs, blob_min_size=blob_min_size, timeout=timeout)
+        self.output_search_db = (
+            OutputSearchDB(engine, self.output_db, timeout=timeout)
+            if search else None
+        )
 
 
     @classmethod
@@ -733,7 +1464,10 @@ class SqliteDB:
 
 
     @classmethod
-    def open(cls, path, *, timeout=None):
+    def open(
+            cls, path, *, timeout=None, blobs=None, blob_min_size=1024 * 1024,
+            search=False
+    ):
         if path is not None:
             path = Path(path).absolute()
             if not path.exists():
@@ -741,7 +1475,13 @@ class SqliteDB:
 
         engine  = cls.__get_engine(path, timeout=timeout)
         # FIXME: Check that tables exist.
-        return cls(engine)
+        return cls(
+            engine,
+            blobs           =blobs,
+            blob_min_size   =blob_min_size,
+            search          =search,
+            timeout         =timeout,
+        )
 
 
     def check(self):
@@ -887,20 +1627,16 @@ class SqliteDB:
                     # Keep count of how many rows we archived from each table.
                     row_counts[table.name] = len(rows)
 
+                # Drop archived runs from the output search index.
+                OutputSearchDB.prune(src_tx, run_ids)
+
                 # Clean up any jobs that no longer have associated runs.
-                src_tx.execute(
-                    """
-                    DELETE FROM jobs
-                    WHERE job_id IN (
-                        SELECT jobs.job_id
-                        FROM jobs
-                        LEFT OUTER JOIN runs
-                        ON runs.job_id = jobs.job_id
-                        WHERE runs.run_id IS NULL
-                    )
-                    """
-                )
+                job_ids = self.job_db.delete_orphans(src_tx)
+
+            else:
+                job_ids = []
 
+        self.job_db.discard(job_ids)
         log.info(f"archived in {timer.elapsed:.3f} s")
         return row_counts
 
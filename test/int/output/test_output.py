@@ -1,10 +1,13 @@
 import brotli
 from   contextlib import closing
+from   functools import partial
 from   pathlib import Path
 import pytest
+import requests
 import sqlite3
 from   time import sleep
 
+from   apsis.service.client import APIError
 from   instance import ApsisService
 
 #-------------------------------------------------------------------------------
@@ -78,3 +81,111 @@ def test_large_output_compression(inst):
         assert len(brotli.decompress(data)) == 1048576
 
 
+def test_output_blob():
+    cfg = {"output": {"blob": {"enable": True, "min_size": 4}}}
+    with closing(ApsisService(job_dir=job_dir, cfg=cfg)) as inst:
+        inst.create_db()
+        inst.write_cfg()
+        inst.start_serve()
+        inst.wait_for_serve()
+        client = inst.client
+
+        run_ids = [
+            client.schedule("printf", {"string": "hello, world\n"})["run_id"]
+            for _ in range(2)
+        ]
+        for run_id in run_ids:
+            assert inst.wait_run(run_id)["state"] == "success"
+            assert client.get_output(run_id, "output") == b"hello, world\n"
+
+        # Both outputs refer to the same blob file.
+        blob_dir = Path(str(inst.db_path) + ".blobs")
+        files = [ p for p in blob_dir.rglob("*") if p.is_file() ]
+        assert len(files) == 1
+        assert files[0].read_bytes() == b"hello, world\n"
+        with sqlite3.connect(inst.db_path) as conn:
+            rows = list(conn.execute("SELECT DISTINCT digest FROM output_blob"))
+            assert rows == [(files[0].name, )]
+
+        # Request ranges.
+        url = (
+            f"http://localhost:{inst.port}"
+            f"/api/v1/runs/{run_ids[0]}/output/output"
+        )
+        resp = requests.get(url, headers={"Range": "bytes=7-11"})
+        assert resp.status_code == 206
+        assert resp.headers["Content-Range"] == "bytes 7-11/13"
+        assert resp.content == b"world"
+        resp = requests.get(url, headers={"Range": "bytes=-6"})
+        assert resp.status_code == 206
+        assert resp.content == b"world\n"
+        resp = requests.get(url, headers={"Range": "bytes=20-"})
+        assert resp.status_code == 416
+
+
+def test_output_range(client, inst):
+    run_id = client.schedule("printf", {"string": "hello, world\n"})["run_id"]
+    assert inst.wait_run(run_id)["state"] == "success"
+
+    assert client.get_output(run_id, "output", start=7) == b"world\n"
+    assert client.get_output(run_id, "output", start=0, stop=5) == b"hello"
+    assert client.get_output(run_id, "output", stop=5) == b"hello"
+    assert client.get_output(run_id, "output", start=7, stop=100) == b"world\n"
+    with pytest.raises(requests.HTTPError):
+        client.get_output(run_id, "output", start=13)
+
+
+def test_output_lines(client, inst):
+    run_id = client.schedule(
+        "printf", {"string": "".join( f"line {i}\\n" for i in range(5000) )}
+    )["run_id"]
+    assert inst.wait_run(run_id)["state"] == "success"
+
+    def lines(*numbers):
+        return "".join( f"line {i}\n" for i in numbers ).encode()
+
+    get = partial(client.get_output_lines, run_id, "output")
+    assert get(tail=3) == lines(4997, 4998, 4999)
+    assert get(start=1023, stop=1026) == lines(1023, 1024, 1025)
+    assert get(start=4999) == lines(4999)
+    assert get(start=6000) == b""
+    assert get(stop=2) == lines(0, 1)
+    assert get(tail=0) == b""
+    assert get() == client.get_output(run_id, "output")
+
+
+def test_output_search():
+    cfg = {"output": {"search": {"enable": True}}}
+    with closing(ApsisService(job_dir=job_dir, cfg=cfg)) as inst:
+        inst.create_db()
+        inst.write_cfg()
+        inst.start_serve()
+        inst.wait_for_serve()
+        client = inst.client
+
+        run_id0 = client.schedule("printf", {"string": "hello, world\n"})["run_id"]
+        run_id1 = client.schedule("printf", {"string": "goodbye\n"})["run_id"]
+        for run_id in (run_id0, run_id1):
+            assert inst.wait_run(run_id)["state"] == "success"
+
+        # Indexing is asynchronous.
+        for _ in range(50):
+            matches = client.search_outputs("hello OR goodbye")
+            if len(matches) == 2:
+                break
+            sleep(0.1)
+        assert { m["run_id"] for m in matches } == {run_id0, run_id1}
+
+        matches = client.search_outputs("world")
+        assert len(matches) == 1
+        assert matches[0]["run_id"] == run_id0
+        assert matches[0]["output_id"] == "output"
+        assert matches[0]["job_id"] == "printf"
+        assert "world" in matches[0]["snippet"]
+
+        assert client.search_outputs("hello", since="1h") != []
+        assert client.search_outputs("hello", job_id="other") == []
+        with pytest.raises(APIError):
+            client.search_outputs("AND (")
+
+
@@ -0,0 +1,60 @@
+from   contextlib import closing
+import time
+
+from   instance import ApsisService
+
+#-------------------------------------------------------------------------------
+
+JOB = """
+program:
+  type: no-op
+schedule:
+  type: interval
+  interval: {interval}
+"""
+
+def wait_for(fn, timeout=5):
+    start = time.monotonic()
+    while not fn():
+        assert time.monotonic() - start < timeout, "timeout"
+        time.sleep(0.1)
+
+
+def test_job_dir_watch(tmp_path):
+    job_dir = tmp_path / "jobs"
+    job_dir.mkdir()
+    (job_dir / "a.yaml").write_text(JOB.format(interval=3600))
+
+    cfg = {"job_dir_watch": {"enable": True, "delay": 0.1}}
+    with closing(ApsisService(job_dir=job_dir, cfg=cfg)) as inst:
+        inst.create_db()
+        inst.write_cfg()
+        inst.start_serve()
+        inst.wait_for_serve()
+        client = inst.client
+
+        def job_ids():
+            return { j["job_id"] for j in client.get_jobs() }
+
+        assert job_ids() == {"a"}
+
+        # Add a job.
+        (job_dir / "sub").mkdir()
+        (job_dir / "sub" / "b.yaml").write_text(JOB.format(interval=3600))
+        wait_for(lambda: job_ids() == {"a", "sub/b"})
+
+        # Change a job.
+        (job_dir / "a.yaml").write_text(JOB.format(interval=1800))
+        wait_for(
+            lambda: client.get_job("a")["schedule"][0]["interval"] == 1800)
+
+        # Remove a job.
+        (job_dir / "sub" / "b.yaml").unlink()
+        wait_for(lambda: job_ids() == {"a"})
+
+        # A bad job file is not applied.
+        (job_dir / "c.yaml").write_text("program: {type: no-op}\nbogus: 42\n")
+        time.sleep(0.5)
+        assert job_ids() == {"a"}
+
+
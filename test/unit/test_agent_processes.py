@@ -0,0 +1,70 @@
+import os
+import pytest
+
+from   apsis.agent.processes import Processes, NoSuchProcessError
+
+#-------------------------------------------------------------------------------
+
+async def _wait_all(procs, proc_ids):
+    proc_ids = set(proc_ids)
+    while len(proc_ids) > 0:
+        done, missing = await procs.wait(list(proc_ids), 10)
+        assert len(missing) == 0
+        assert len(done) > 0
+        proc_ids -= { p.proc_id for p in done }
+
+
+@pytest.mark.asyncio
+async def test_reap(tmp_path):
+    procs = Processes(tmp_path)
+    if not procs.use_pidfd:
+        pytest.skip("pidfd not supported")
+
+    proc = procs.start(["/bin/sh", "-c", "exit 3"], "/", None, None)
+    assert proc.state == "run"
+    await _wait_all(procs, [proc.proc_id])
+    assert proc.state == "done"
+    assert proc.return_code == 3
+    assert proc.rusage is not None
+
+    # Reap many.
+    proc_ids = [
+        procs.start(["/bin/true"], "/", None, None).proc_id
+        for _ in range(200)
+    ]
+    await _wait_all(procs, proc_ids)
+    assert all( procs[i].return_code == 0 for i in proc_ids )
+
+
+@pytest.mark.asyncio
+async def test_collect(tmp_path):
+    procs = Processes(tmp_path)
+    if not procs.use_pidfd:
+        pytest.skip("pidfd not supported")
+
+    done = procs.start(["/bin/true"], "/", None, None)
+    run = procs.start(["/bin/sleep", "10"], "/", None, None)
+    await _wait_all(procs, [done.proc_id])
+    path = done.proc_dir.path
+    assert path.is_dir()
+
+    # Recently accessed.
+    assert procs.collect(60) == 0
+    assert len(procs) == 2
+
+    # Finished and orphaned.
+    assert procs.collect(0) == 1
+    assert len(procs) == 1
+    assert not path.exists()
+    with pytest.raises(NoSuchProcessError):
+        procs[done.proc_id]
+
+    # Still running, so not collected.
+    assert procs[run.proc_id].state == "run"
+    procs.kill(run.proc_id, 9)
+    await _wait_all(procs, [run.proc_id])
+    assert procs.collect(0) == 1
+    assert len(procs) == 0
+    assert os.listdir(tmp_path) == []
+
+
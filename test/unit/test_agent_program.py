@@ -28,3 +28,39 @@ async def test_agent_program_concurrent():
     assert all( r.meta["status"] == 0 for r in results )
 
 
+
+
+@pytest.mark.asyncio
+async def test_agent_program_output():
+    prog = apsis.program.AgentProgram(["/usr/bin/seq", "500000"]).bind({})
+    running = prog.run("testrun", cfg={})
+    data = b""
+    async for update in running.updates:
+        if isinstance(update, apsis.program.base.ProgramUpdate):
+            delta = update.output_deltas["output"]
+            assert delta.start == len(data)
+            data += delta.data
+            assert delta.metadata.length == len(data)
+
+    assert isinstance(update, apsis.program.ProgramSuccess)
+    assert update.outputs == {}
+    assert data == "".join( f"{i}\n" for i in range(1, 500001) ).encode()
+
+
+@pytest.mark.asyncio
+async def test_agent_program_live_output():
+    prog = apsis.program.AgentShellProgram(
+        "echo hello; sleep 1; echo goodbye").bind({})
+    cfg = {"agent": {"run": {"output_interval": 0.1}}}
+    running = prog.run("testrun", cfg=cfg)
+    data = []
+    async for update in running.updates:
+        if isinstance(update, apsis.program.base.ProgramUpdate):
+            data.append(update.output_deltas["output"].data)
+
+    assert isinstance(update, apsis.program.ProgramSuccess)
+    # The first line arrives while the program is still running.
+    assert data[0] == b"hello\n"
+    assert b"".join(data) == b"hello\ngoodbye\n"
+
+
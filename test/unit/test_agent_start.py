@@ -1,4 +1,6 @@
 import asyncio
+import gzip
+import httpx
 import time
 import pytest
 
@@ -92,3 +94,205 @@ async def test_concurrent_start():
     assert all( not r for r in res )
 
 
+@pytest.mark.asyncio
+async def test_single_flight_discovery(tmp_path, monkeypatch):
+    """
+    Checks that concurrent clients share one agent discovery.
+    """
+    get_stats = apsis.agent.client.get_stats
+    stats0 = get_stats()
+    agents = [
+        apsis.agent.client.Agent(state_dir=tmp_path) for _ in range(20) ]
+    res = await asyncio.gather(*( a.connect() for a in agents ))
+    assert len(set(res)) == 1
+
+    stats1 = get_stats()
+    assert stats1["num_discoveries"] - stats0["num_discoveries"] == 1
+    assert stats1["num_discovery_shared"] - stats0["num_discovery_shared"] == 19
+
+    # Once the TTL expires, the cached agent is health-checked.
+    monkeypatch.setattr(apsis.agent.client.AgentSupervisor, "TTL", 0)
+    assert await agents[1].connect() == res[0]
+    stats2 = get_stats()
+    assert stats2["num_health_checks"] - stats1["num_health_checks"] == 1
+    assert stats2["num_discoveries"] == stats1["num_discoveries"]
+
+    assert await agents[0].stop()
+
+
+@pytest.mark.asyncio
+async def test_wait_process():
+    """
+    Tests waiting concurrently for several processes on one agent.
+    """
+    agent = apsis.agent.client.Agent()
+    await agent.connect()
+
+    proc_ids = [
+        (await agent.start_process(["/bin/sleep", str(t)]))["proc_id"]
+        for t in (0.5, 0, 1, 0.2)
+    ]
+    procs = await asyncio.wait_for(
+        asyncio.gather(*( agent.wait_process(i) for i in proc_ids )),
+        timeout=10,
+    )
+    assert [ p["proc_id"] for p in procs ] == proc_ids
+    assert all( p["state"] == "done" for p in procs )
+    assert all( p["status"] == 0 for p in procs )
+
+    # A process started while waiting for another is included.
+    proc_id0 = (await agent.start_process(["/bin/sleep", "1"]))["proc_id"]
+    wait0 = asyncio.ensure_future(agent.wait_process(proc_id0))
+    await asyncio.sleep(0.2)
+    proc_id1 = (await agent.start_process(["/bin/true"]))["proc_id"]
+    proc = await asyncio.wait_for(agent.wait_process(proc_id1), timeout=0.8)
+    assert proc["proc_id"] == proc_id1
+    assert not wait0.done()
+    assert (await wait0)["proc_id"] == proc_id0
+
+    with pytest.raises(apsis.agent.client.NoSuchProcessError):
+        await agent.wait_process("bogus")
+
+    for proc_id in proc_ids + [proc_id0, proc_id1]:
+        await agent.del_process(proc_id)
+    assert await agent.stop()
+
+
+@pytest.mark.asyncio
+async def test_get_processes():
+    agent = apsis.agent.client.Agent()
+    await agent.connect()
+
+    proc_id0 = (await agent.start_process(["/bin/true"]))["proc_id"]
+    proc_id1 = (await agent.start_process(["/bin/sleep", "10"]))["proc_id"]
+    proc_id2 = (await agent.start_process(["/bin/true"]))["proc_id"]
+    await agent.wait_process(proc_id0)
+    await agent.wait_process(proc_id2)
+
+    procs = await agent.get_processes(proc_ids=[proc_id0, proc_id1, "bogus"])
+    assert { p["proc_id"] for p in procs } == {proc_id0, proc_id1}
+
+    procs = await agent.get_processes(
+        proc_ids=[proc_id0, proc_id1, "bogus"], state="done")
+    assert [ p["proc_id"] for p in procs ] == [proc_id0]
+
+    procs = await agent.get_processes(state="run")
+    assert [ p["proc_id"] for p in procs ] == [proc_id1]
+
+    await agent.signal(proc_id1, "SIGKILL")
+    await agent.wait_process(proc_id1)
+    for proc_id in (proc_id0, proc_id1, proc_id2):
+        await agent.del_process(proc_id)
+    assert await agent.stop()
+
+
+@pytest.mark.asyncio
+async def test_get_load():
+    agent = apsis.agent.client.Agent()
+    proc_id = (await agent.start_process(["/bin/sleep", "10"]))["proc_id"]
+
+    load = await agent.get_load()
+    assert len(load["loadavg"]) == 3
+    assert load["num_cpus"] > 0
+    assert load["num_running"] == 1
+
+    await agent.signal(proc_id, "SIGKILL")
+    await agent.wait_process(proc_id)
+    await agent.del_process(proc_id)
+    assert await agent.stop()
+
+
+@pytest.mark.asyncio
+async def test_connection_reuse():
+    agent = apsis.agent.client.Agent()
+    await agent.connect()
+    stats0 = apsis.agent.client.get_stats()
+
+    for _ in range(10):
+        assert await agent.is_running()
+
+    stats1 = apsis.agent.client.get_stats()
+    assert stats1["num_requests"] - stats0["num_requests"] == 10
+    # One new connection; the rest reuse it.
+    assert stats1["num_connects"] - stats0["num_connects"] == 1
+    assert stats1["num_handshakes"] - stats0["num_handshakes"] == 1
+    assert stats1["num_reused"] - stats0["num_reused"] == 9
+
+    assert await agent.stop()
+
+
+@pytest.mark.asyncio
+async def test_stream_output():
+    agent = apsis.agent.client.Agent()
+    await agent.connect()
+
+    expected = "".join( f"{i}\n" for i in range(1, 500001) ).encode()
+    proc_id = (await agent.start_process(["/usr/bin/seq", "500000"]))["proc_id"]
+    await agent.wait_process(proc_id)
+
+    async def get(**kw_args):
+        chunks = [
+            c async for c in agent.iter_process_output(
+                proc_id, chunk_size=65536, **kw_args)
+        ]
+        assert all( len(c) <= 65536 for c in chunks )
+        return b"".join(chunks)
+
+    assert await get() == expected
+    assert await get(start=1000) == expected[1000 :]
+    assert await get(start=1000, stop=2000000) == expected[1000 : 2000000]
+    assert await get(stop=10) == expected[: 10]
+    assert await get(start=len(expected)) == b""
+    assert await get(start=len(expected) + 10) == b""
+    assert await get(start=10, stop=10) == b""
+
+    # Compressed in chunks.
+    data, length, cmpr = await agent.get_process_output(
+        proc_id, compression="gzip")
+    assert length == len(expected)
+    assert cmpr == "gzip"
+    assert gzip.decompress(data) == expected
+
+    await agent.del_process(proc_id)
+    assert await agent.stop()
+
+
+@pytest.mark.asyncio
+async def test_request_error_isolated():
+    """
+    Checks that a failed request doesn't affect others in flight.
+    """
+    agent = apsis.agent.client.Agent()
+    await agent.connect()
+
+    expected = "".join( f"{i}\n" for i in range(1, 2000001) ).encode()
+    proc = await agent.start_process(["/usr/bin/seq", "2000000"])
+    proc_id0 = proc["proc_id"]
+    await agent.wait_process(proc_id0)
+    proc_id1 = (await agent.start_process(["/bin/sleep", "1"]))["proc_id"]
+
+    # A long-poll wait, and a streamed output, in flight.
+    wait = asyncio.ensure_future(agent.wait_process(proc_id1))
+    chunks = agent.iter_process_output(proc_id0, chunk_size=65536)
+    data = await anext(chunks)
+    await asyncio.sleep(0.2)
+
+    # A request whose connection fails.
+    def fail(request):
+        raise httpx.ReadTimeout("timed out", request=request)
+
+    async with httpx.AsyncClient(transport=httpx.MockTransport(fail)) as client:
+        with pytest.raises(apsis.agent.client.NoAgentError):
+            await agent.get_process(proc_id1, client=client)
+
+    # The others complete.
+    data += b"".join([ c async for c in chunks ])
+    assert data == expected
+    proc = await asyncio.wait_for(wait, timeout=5)
+    assert proc["status"] == 0
+
+    for proc_id in (proc_id0, proc_id1):
+        await agent.del_process(proc_id)
+    assert await agent.stop()
+
+
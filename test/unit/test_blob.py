@@ -0,0 +1,108 @@
+import brotli
+import gzip
+import io
+import pytest
+
+from   apsis.lib.parse import parse_range
+from   apsis.lib.blob import BlobStore, new_hash
+
+#-------------------------------------------------------------------------------
+
+def test_blob_store(tmp_path):
+    blobs = BlobStore(tmp_path / "blobs")
+    data = b"The quick brown fox jumped over the lazy dogs.\n" * 1000
+
+    digest, encoding = blobs.put(data)
+    assert encoding is None
+    assert blobs.get_path(digest).is_file()
+    assert blobs.read(digest) == data
+
+    # Identical data is stored once.
+    assert blobs.put_file(io.BytesIO(data)) == (digest, None)
+    # Read only part of the file.
+    other, _ = blobs.put_file(io.BytesIO(data), 100)
+    assert other != digest
+    assert blobs.read(other) == data[: 100]
+
+    stats = blobs.get_stats()
+    assert stats["num_put"] == 3
+    assert stats["num_dup"] == 1
+    assert stats["bytes_written"] == len(data) + 100
+    # No temporary files left behind.
+    assert sum( 1 for p in blobs.path.rglob("*") if p.is_file() ) == 2
+
+    with pytest.raises(LookupError):
+        blobs.read("0" * 40)
+
+
+def test_blob_store_encoding(tmp_path):
+    blobs = BlobStore(tmp_path / "blobs")
+    data = b"The quick brown fox jumped over the lazy dogs.\n" * 1000
+    hash = new_hash()
+    hash.update(data)
+    key = hash.hexdigest()
+
+    # Encoded data is keyed on the digest of the decoded data.
+    with pytest.raises(ValueError):
+        blobs.put(gzip.compress(data), encoding="gzip")
+    digest, encoding = blobs.put(
+        gzip.compress(data), digest=key, encoding="gzip")
+    assert (digest, encoding) == (key, "gzip")
+    assert blobs.find(digest) == (blobs.get_path(digest, "gzip"), "gzip")
+    assert gzip.decompress(blobs.read(digest)) == data
+
+    # The same data, encoded otherwise or not at all, shares the blob.
+    assert blobs.put(data) == (key, "gzip")
+    file = io.BytesIO(brotli.compress(data))
+    assert blobs.put_file(file, digest=key, encoding="br") == (key, "gzip")
+    # The file wasn't read.
+    assert file.tell() == 0
+    assert blobs.get_stats()["num_dup"] == 2
+    assert sum( 1 for p in blobs.path.rglob("*") if p.is_file() ) == 1
+
+
+def test_blob_store_collect(tmp_path):
+    blobs = BlobStore(tmp_path / "blobs")
+    keep, _ = blobs.put(b"keep" * 100)
+    drop, _ = blobs.put(b"drop" * 100)
+    hash = new_hash()
+    hash.update(b"encoded")
+    encoded, _ = blobs.put(
+        gzip.compress(b"encoded"), digest=hash.hexdigest(), encoding="gzip")
+    temp = blobs.path / "tmpleftover"
+    temp.write_bytes(b"partial")
+
+    with pytest.raises(ValueError):
+        blobs.put(b"data", digest=keep, encoding="rot13")
+
+    # Recent files are kept.
+    assert blobs.collect({keep}) == (0, 0)
+    assert blobs.collect({keep}, min_age=0, dry_run=True)[0] == 3
+    assert blobs.read(drop) == b"drop" * 100
+
+    num, size = blobs.collect({keep}, min_age=0)
+    assert num == 3
+    assert blobs.read(keep) == b"keep" * 100
+    for digest in (drop, encoded):
+        with pytest.raises(LookupError):
+            blobs.find(digest)
+    assert not temp.exists()
+
+
+def test_parse_range():
+    assert parse_range(None, 100) is None
+    assert parse_range("bytes=0-9", 100) == (0, 10)
+    assert parse_range("bytes=90-", 100) == (90, 100)
+    assert parse_range("bytes=90-200", 100) == (90, 100)
+    assert parse_range("bytes=-10", 100) == (90, 100)
+    assert parse_range("bytes=-200", 100) == (0, 100)
+    # Unsupported or invalid ranges are ignored.
+    assert parse_range("bytes=0-9,20-29", 100) is None
+    assert parse_range("lines=0-9", 100) is None
+    assert parse_range("bytes=9-0", 100) is None
+    with pytest.raises(ValueError):
+        parse_range("bytes=100-", 100)
+    with pytest.raises(ValueError):
+        parse_range("bytes=-0", 100)
+
+
@@ -2,7 +2,12 @@ import asyncio
 import brotli
 import pytest
 
-from   apsis.lib.cmpr import compress_async
+from   apsis.lib.api import decompress
+from   apsis.lib.cmpr import (
+    BR_CHUNKED, CompressionService, choose_compression, choose_quality,
+    compress_async, compress_chunks, compress_frames, decompress_frames,
+    read_frames,
+)
 
 #-------------------------------------------------------------------------------
 
@@ -44,3 +49,103 @@ async def test_compress_async_timing():
     assert await task == 499500
 
 
+def test_frames():
+    data = bytes(range(256)) * 10000 + b"The end.\n"
+    chunks = [ data[i : i + 100000] for i in range(0, len(data), 100000) ]
+    compressed = b"".join(compress_frames(chunks, frame_size=65536))
+    assert len(compressed) < len(data)
+    assert decompress_frames(compressed) == data
+
+    # Ranges read only the frames needed.
+    reads = []
+    def read(offset, length):
+        reads.append(length)
+        return compressed[offset : offset + length]
+
+    for start, stop in (
+            (0, 10),
+            (65530, 65540),
+            (1000000, None),
+            (len(data) - 9, len(data)),
+            (len(data), None),
+            (0, 10000000),
+    ):
+        reads.clear()
+        result = read_frames(read, len(compressed), start, stop)
+        assert result == data[start : stop]
+        # Trailer, index, and one read for the frames.
+        assert len(reads) <= 3
+
+    assert decompress_frames(b"".join(compress_frames([]))) == b""
+    with pytest.raises(RuntimeError):
+        decompress_frames(brotli.compress(data))
+
+
+def test_choose_compression():
+    assert choose_compression("br", 1024) == "br"
+    assert choose_compression("br", 16 * 1024 * 1024) == BR_CHUNKED
+    assert choose_compression(None, 16 * 1024 * 1024) is None
+
+
+@pytest.mark.asyncio
+async def test_compress_async_chunked():
+    data = b"alkjsdhtlkqjhwetrnabsdcvlkjhqaweljkh" * 65536
+    compressed = await compress_async(data, BR_CHUNKED)
+    assert len(compressed) < len(data)
+    assert decompress(compressed, BR_CHUNKED) == data
+
+
+
+
+def test_choose_quality():
+    assert choose_quality("br", 1024) == 5
+    assert choose_quality("br", 4 * 1024 * 1024) == 4
+    assert choose_quality("br", 4 * 1024 * 1024, backlog=1) == 3
+    assert choose_quality("br", 1024 * 1024 * 1024) == 1
+    assert choose_quality("gzip", 1024, backlog=10) == 1
+
+
+@pytest.mark.parametrize("compression", ["br", BR_CHUNKED, "deflate", "gzip"])
+def test_compress_chunks(compression):
+    data = b"alkjsdhtlkqjhwetrnabsdcvlkjhqaweljkh" * 65536
+    chunks = [ data[i : i + 100000] for i in range(0, len(data), 100000) ]
+    compressed = b"".join(compress_chunks(chunks, compression, quality=1))
+    assert len(compressed) < len(data)
+    assert decompress(compressed, compression) == data
+
+
+@pytest.mark.asyncio
+async def test_compression_service():
+    service = CompressionService(max_threads=2)
+    data = b"alkjsdhtlkqjhwetrnabsdcvlkjhqaweljkh" * 65536
+
+    results = await asyncio.gather(*(
+        service.compress(data, c)
+        for c in ("br", BR_CHUNKED, "deflate", "gzip", None)
+    ))
+    for compression, result in zip(
+            ("br", BR_CHUNKED, "deflate", "gzip", None), results):
+        assert decompress(result, compression) == data
+
+    with pytest.raises(NotImplementedError):
+        await service.compress(data, "lzma")
+
+    stats = service.get_stats()
+    assert stats["num_compressed"] == 4
+    assert stats["num_pending"] == 0
+    assert stats["bytes_in"] == 4 * len(data)
+    assert 0 < stats["bytes_out"] < stats["bytes_in"]
+    assert stats["latency"] >= stats["elapsed"] > 0
+
+
+@pytest.mark.asyncio
+async def test_compression_service_process():
+    service = CompressionService(
+        max_threads=1, max_processes=1, process_min_size=65536)
+    small = b"hello, world\n" * 16
+    large = b"alkjsdhtlkqjhwetrnabsdcvlkjhqaweljkh" * 65536
+    assert brotli.decompress(await service.compress(small, "br")) == small
+    assert brotli.decompress(await service.compress(large, "br")) == large
+    stats = service.get_stats()
+    assert stats["num_compressed"] == 2
+    assert stats["num_process"] == 1
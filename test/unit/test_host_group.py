@@ -1,3 +1,8 @@
+import asyncio
+import gc
+import pytest
+
+from   apsis.agent.client import get_agent
 import apsis.host_group as hg
 from   apsis.lib import itr
 
@@ -35,3 +40,79 @@ def test_round_robin_from_jso():
     assert hosts == list(itr.take(len(hosts), itr.cycle(HOSTS)))
 
 
+def test_least_loaded():
+    HOSTS = ["ll-foo", "ll-bar", "ll-baz"]
+    load = hg.HOST_LOAD
+
+    g = hg.HostGroup.from_jso({
+        "type": "least-loaded",
+        "hosts": HOSTS,
+    })
+    assert isinstance(g, hg.LeastLoadedHostGroup)
+    assert g.hosts == tuple(HOSTS)
+
+    # Each run started goes to a host with the fewest runs.
+    hosts = []
+    for _ in range(6):
+        host = g.choose()
+        load.add_run(host)
+        hosts.append(host)
+    assert sorted(hosts) == sorted(HOSTS * 2)
+    assert all( load.get_runs(h) == 2 for h in HOSTS )
+    assert hg.get_stats()["ll-bar"] == {"num_runs": 2, "load": None}
+
+    # A host on which runs finish becomes least loaded.
+    load.remove_run("ll-baz")
+    load.remove_run("ll-baz")
+    assert g.choose() == "ll-baz"
+
+    # Agent-reported load counts with the weight.
+    g = g.bind({})
+    g.load_weight = 2
+    load.set_reported("ll-baz", 1.5)
+    g._update("ll-baz")
+    assert g.choose() in {"ll-foo", "ll-bar"}
+
+    for _ in range(2):
+        for host in ("ll-foo", "ll-bar"):
+            load.remove_run(host)
+    assert all( load.get_runs(h) == 0 for h in HOSTS )
+
+
+@pytest.mark.asyncio
+async def test_least_loaded_refresh(monkeypatch):
+    hosts = []
+
+    async def refresh_loads(h, interval):
+        hosts.extend(h)
+        await asyncio.sleep(3600)
+
+    monkeypatch.setattr(hg, "_refresh_loads", refresh_loads)
+
+    def start():
+        g = hg.LeastLoadedHostGroup(["ll-qux"], load_weight=1)
+        g.choose()
+        task = g._LeastLoadedHostGroup__refresh_task
+        return g, task
+
+    # Closing the group stops the refresh.
+    g, task = start()
+    await asyncio.sleep(0)
+    assert hosts == ["ll-qux"]
+    g.close()
+    await asyncio.sleep(0)
+    assert task.cancelled()
+
+    # So does discarding it.
+    g, task = start()
+    await asyncio.sleep(0)
+    del g
+    gc.collect()
+    await asyncio.sleep(0)
+    assert task.cancelled()
+
+
+def test_least_loaded_shares_agents():
+    # Load refresh and agent programs use the same agent clients.
+    assert get_agent("ll-qux") is get_agent("ll-qux")
+    assert get_agent("ll-qux") is get_agent("ll-qux", None)
@@ -82,3 +82,44 @@ def test_schedule_jso_start_stop():
     assert jso["stop"]["duration"] == 900
 
 
+def test_fingerprint():
+    def make_job(job_id, command="echo hello", duration="15m"):
+        return Job.from_jso({
+            "params": ["date", "label"],
+            "program": {"type": "shell", "command": command},
+            "schedule": {
+                "start": {
+                    "type"      : "daily",
+                    "tz"        : "UTC",
+                    "daytime"   : "12:00:00",
+                    "args"      : {"label": "foo"},
+                },
+                "stop": {"type": "duration", "duration": duration},
+            },
+            "condition": {"type": "dependency", "job_id": "other"},
+        }, job_id)
+
+    job0 = make_job("job0")
+    # The fingerprint doesn't depend on the job ID.
+    job1 = make_job("job1")
+    assert job1.fingerprint == job0.fingerprint
+    assert job1 == job0
+    assert job1.program.fingerprint == job0.program.fingerprint
+    assert job1.conds[0].fingerprint == job0.conds[0].fingerprint
+
+    job2 = make_job("job0", command="echo goodbye")
+    assert job2.fingerprint != job0.fingerprint
+    assert job2.program != job0.program
+    assert job2 != job0
+
+    # The stop schedule is part of the job fingerprint.
+    job3 = make_job("job0", duration="30m")
+    assert job3.fingerprint != job0.fingerprint
+
+    # Ad hoc jobs never compare equal.
+    job4 = make_job("job0")
+    job4.ad_hoc = True
+    assert job4.fingerprint == job0.fingerprint
+    assert job4 != job0
+
+
@@ -0,0 +1,41 @@
+import pytest
+
+from   apsis.jobs import Job, Jobs, InMemoryJobs
+from   apsis.program import NoOpProgram
+from   apsis.sqlite import SqliteDB
+
+#-------------------------------------------------------------------------------
+
+def test_jobs_ad_hoc(tmp_path):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path)
+
+    jobs_dir = InMemoryJobs([Job("job0", program=NoOpProgram())])
+    jobs = Jobs(jobs_dir, db.job_db)
+    assert [ j.job_id for j in jobs.get_jobs() ] == ["job0"]
+
+    job = Job.from_jso({"program": {"type": "no-op"}, "ad_hoc": True}, None)
+    jobs.add(job)
+    job_id = job.job_id
+    assert job_id.startswith("adhoc-")
+    assert jobs.get_job(job_id) is job
+
+    assert [ j.job_id for j in jobs.get_jobs(ad_hoc=False) ] == ["job0"]
+    assert [ j.job_id for j in jobs.get_jobs(ad_hoc=True) ] == [job_id]
+    assert { j.job_id for j in jobs.get_jobs() } == {"job0", job_id}
+
+    # A fresh DB loads the job.
+    job_db = SqliteDB.open(path).job_db
+    assert job_db.get(job_id).fingerprint == job.fingerprint
+    assert [ j.job_id for j in job_db.query(ad_hoc=True) ] == [job_id]
+
+    # The job has no runs, so archiving cleans it up.
+    db.archive(tmp_path / "archive.db", [])
+    db.archive(tmp_path / "archive.db", ["r1"])
+    with pytest.raises(LookupError):
+        jobs.get_job(job_id)
+    assert list(jobs.get_jobs(ad_hoc=True)) == []
+    assert list(SqliteDB.open(path).job_db.query()) == []
+
+
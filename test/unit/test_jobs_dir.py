@@ -0,0 +1,116 @@
+import asyncio
+import pytest
+
+from   apsis.exc import JobsDirErrors
+from   apsis.jobs import load_jobs_dir, update_jobs_dir
+from   apsis.lib.inotify import TreeWatcher
+
+#-------------------------------------------------------------------------------
+
+JOB = """
+params: [date]
+program:
+  type: no-op
+schedule:
+  type: daily
+  tz: UTC
+  daytime: {daytime}
+"""
+
+def write_job(path, daytime="12:00:00"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(JOB.format(daytime=daytime))
+
+
+def test_update_jobs_dir(tmp_path):
+    write_job(tmp_path / "a.yaml")
+    write_job(tmp_path / "b.yaml")
+    write_job(tmp_path / "sub" / "c.yaml")
+    write_job(tmp_path / "sub" / "d.yaml")
+    jobs_dir0 = load_jobs_dir(tmp_path)
+
+    # No changes.
+    jobs_dir1, rem, add, chg = update_jobs_dir(jobs_dir0, [tmp_path / "a.yaml"])
+    assert (rem, add, chg) == (set(), set(), set())
+
+    # Change one job, add one, and remove one.
+    write_job(tmp_path / "a.yaml", daytime="13:00:00")
+    write_job(tmp_path / "e.yaml")
+    (tmp_path / "b.yaml").unlink()
+    jobs_dir1, rem, add, chg = update_jobs_dir(
+        jobs_dir0,
+        [tmp_path / "a.yaml", tmp_path / "b.yaml", tmp_path / "e.yaml"],
+    )
+    assert rem == {"b"}
+    assert add == {"e"}
+    assert chg == {"a"}
+    assert sorted( j.job_id for j in jobs_dir1.get_jobs() ) \
+        == ["a", "e", "sub/c", "sub/d"]
+    # The original is unchanged.
+    assert sorted( j.job_id for j in jobs_dir0.get_jobs() ) \
+        == ["a", "b", "sub/c", "sub/d"]
+
+    # Rename a directory.
+    (tmp_path / "sub").rename(tmp_path / "new")
+    jobs_dir2, rem, add, chg = update_jobs_dir(
+        jobs_dir1, [tmp_path / "sub", tmp_path / "new"])
+    assert rem == {"sub/c", "sub/d"}
+    assert add == {"new/c", "new/d"}
+    assert chg == set()
+
+
+def test_update_jobs_dir_error(tmp_path):
+    write_job(tmp_path / "a.yaml")
+    jobs_dir = load_jobs_dir(tmp_path)
+
+    (tmp_path / "a.yaml").write_text("program: {type: no-op}\nbogus: 42\n")
+    with pytest.raises(JobsDirErrors):
+        update_jobs_dir(jobs_dir, [tmp_path / "a.yaml"])
+
+
+
+def test_update_jobs_dir_dependency(tmp_path):
+    write_job(tmp_path / "a.yaml")
+    (tmp_path / "b.yaml").write_text(
+        "program: {type: no-op}\n"
+        "condition: {type: dependency, job_id: a, args: {date: '2024-01-01'}}\n"
+    )
+    jobs_dir = load_jobs_dir(tmp_path)
+
+    # Removing a job that another depends on is an error, as for a full load.
+    (tmp_path / "a.yaml").unlink()
+    with pytest.raises(JobsDirErrors):
+        load_jobs_dir(tmp_path)
+    with pytest.raises(JobsDirErrors) as exc_info:
+        update_jobs_dir(jobs_dir, [tmp_path / "a.yaml"])
+    assert [ e.job_id for e in exc_info.value.errors ] == ["b"]
+
+    # Likewise changing its params.
+    (tmp_path / "a.yaml").write_text(
+        JOB.format(daytime="12:00:00").replace("[date]", "[date, color]"))
+    with pytest.raises(JobsDirErrors):
+        update_jobs_dir(jobs_dir, [tmp_path / "a.yaml"])
+
+
+@pytest.mark.asyncio
+async def test_tree_watcher(tmp_path):
+    write_job(tmp_path / "a.yaml")
+    watcher = TreeWatcher(tmp_path)
+    watcher.start()
+    try:
+        write_job(tmp_path / "a.yaml", daytime="13:00:00")
+        write_job(tmp_path / "sub" / "b.yaml")
+        paths = await asyncio.wait_for(watcher.wait(0.1), 5)
+        assert tmp_path / "a.yaml" in paths
+        # The new subdir is reported as a whole.
+        assert tmp_path / "sub" in paths
+
+        # The new subdir is now watched too.
+        write_job(tmp_path / "sub" / "c.yaml")
+        paths = await asyncio.wait_for(watcher.wait(0.1), 5)
+        assert paths == {tmp_path / "sub" / "c.yaml"}
+
+    finally:
+        watcher.stop()
+
+
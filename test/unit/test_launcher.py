@@ -0,0 +1,121 @@
+import asyncio
+import os
+import pytest
+from   signal import Signals
+
+from   apsis.launcher import Launcher, ProcessLostError, read_status
+
+#-------------------------------------------------------------------------------
+
+@pytest.mark.asyncio
+async def test_launch(tmp_path):
+    launcher = Launcher()
+    output_path = tmp_path / "out"
+    status_path = tmp_path / "status"
+    pid, start_time = await launcher.start(
+        ["/bin/sh", "-c", "echo hello; echo world >&2; exit 2"],
+        output_path, status_path
+    )
+    status = await launcher.wait(pid, status_path, start_time)
+    assert os.waitstatus_to_exitcode(status) == 2
+    assert read_status(status_path) == status
+    assert output_path.read_bytes() == b"hello\nworld\n"
+
+    with pytest.raises(OSError):
+        await launcher.start(["/nonexistent"], output_path, status_path)
+    await launcher.close()
+
+
+@pytest.mark.asyncio
+async def test_launch_concurrent(tmp_path):
+    """
+    Tests starting programs concurrently, before the launcher is running.
+    """
+    launcher = Launcher()
+    procs = await asyncio.wait_for(
+        asyncio.gather(*(
+            launcher.start(
+                ["/bin/sh", "-c", f"exit {i}"],
+                tmp_path / f"out{i}", tmp_path / f"status{i}"
+            )
+            for i in range(8)
+        )),
+        10
+    )
+    for i, (pid, start_time) in enumerate(procs):
+        status = await asyncio.wait_for(
+            launcher.wait(pid, tmp_path / f"status{i}", start_time), 10)
+        assert os.waitstatus_to_exitcode(status) == i
+    assert launcher.get_stats()["num_launched"] == 8
+    await launcher.close()
+
+
+@pytest.mark.asyncio
+async def test_signal(tmp_path):
+    launcher = Launcher()
+    status_path = tmp_path / "status"
+    pid, start_time = await launcher.start(
+        ["/bin/sleep", "10"], tmp_path / "out", status_path)
+    await launcher.signal(pid, Signals.SIGUSR1, status_path, start_time)
+    status = await launcher.wait(pid, status_path, start_time)
+    assert os.waitstatus_to_exitcode(status) == -Signals.SIGUSR1
+
+    # The program is gone.
+    with pytest.raises(ProcessLookupError):
+        await launcher.signal(pid, Signals.SIGUSR1, status_path, start_time)
+    await launcher.close()
+
+
+@pytest.mark.asyncio
+async def test_wait_other(tmp_path):
+    """
+    Tests waiting for and signalling a program started by another launcher.
+    """
+    status_path = tmp_path / "status"
+    launcher = Launcher()
+    pid, start_time = await launcher.start(
+        ["/bin/sleep", "10"], tmp_path / "out", status_path)
+    # The launcher keeps running until its program terminates.
+    close = asyncio.ensure_future(launcher.close())
+    assert read_status(status_path) is None
+
+    other = Launcher()
+    # Not the same process, if the start time differs.
+    with pytest.raises(ProcessLookupError):
+        await other.signal(pid, Signals.SIGUSR1, status_path, start_time + 1)
+    await other.signal(pid, Signals.SIGUSR1, status_path, start_time)
+    status = await other.wait(pid, status_path, start_time)
+    assert os.waitstatus_to_exitcode(status) == -Signals.SIGUSR1
+    await close
+
+    with pytest.raises(ProcessLookupError):
+        await other.signal(pid, Signals.SIGUSR1, status_path, start_time)
+    # No status file.
+    with pytest.raises(ProcessLostError):
+        await other.wait(pid, tmp_path / "missing", start_time)
+
+
+@pytest.mark.asyncio
+async def test_launcher_terminated(tmp_path):
+    """
+    Tests waiting for a program whose launcher terminates.
+    """
+    status_path = tmp_path / "status"
+    launcher = Launcher()
+    pid, start_time = await launcher.start(
+        ["/bin/sleep", "10"], tmp_path / "out", status_path)
+    wait = asyncio.ensure_future(launcher.wait(pid, status_path, start_time))
+    await asyncio.sleep(0.1)
+
+    # Kill the launcher.  The program keeps running, and we keep waiting.
+    launcher._Launcher__launcher.proc.kill()
+    await asyncio.sleep(0.5)
+    assert not wait.done()
+
+    await launcher.signal(pid, Signals.SIGKILL, status_path, start_time)
+    # No launcher recorded the status.
+    with pytest.raises(ProcessLostError):
+        await asyncio.wait_for(wait, 5)
+    await launcher.close()
+
+
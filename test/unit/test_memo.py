@@ -52,3 +52,30 @@ def test_property():
     assert C.count == 4
 
 
+def test_memoize_lru():
+    calls = []
+
+    @memo.memoize_lru(2)
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert square(2) == 4
+    assert square(3) == 9
+    assert square(2) == 4
+    assert calls == [2, 3]
+
+    # Evicts the least recently used, 3.
+    assert square(4) == 16
+    assert square(2) == 4
+    assert calls == [2, 3, 4]
+    assert square(3) == 9
+    assert calls == [2, 3, 4, 3]
+
+    stats = square.__memo__.get_stats()
+    assert stats["size"] == 2
+    assert stats["maxsize"] == 2
+    assert stats["hits"] == 2
+    assert stats["misses"] == 4
+
+
@@ -1,8 +1,15 @@
 import brotli
+import gzip
+import io
+import ora
 import pytest
 
-from   apsis.sqlite import SqliteDB
-from   apsis.program import OutputMetadata, Output
+from   apsis.lib.blob import BlobStore
+from   apsis.lib.cmpr import BR_CHUNKED, compress_frames
+from   apsis.output import LineIndex, OutputStore
+from   apsis.sqlite import OutputSearchDB, SqliteDB
+from   apsis.program import OutputMetadata, Output, OutputDelta
+from   apsis.runs import Instance, Run
 
 #-------------------------------------------------------------------------------
 
@@ -50,3 +57,392 @@ def test_br(tmp_path):
     assert data == DATA
 
 
+def test_output_store_delta(tmp_path):
+    path = tmp_path / "apsis.db"
+
+    SqliteDB.create(path=path)
+    store = OutputStore(SqliteDB.open(path).output_db)
+
+    def delta(start, data):
+        metadata = OutputMetadata("output", start + len(data))
+        return OutputDelta(metadata, start, data)
+
+    store.write_delta("r1", "output", delta(0, b"hello, "))
+    store.write_delta("r1", "output", delta(7, b"world"))
+    assert store.get_metadata("r1")["output"].length == 12
+    assert store.get_output("r1", "output").data == b"hello, world"
+    # Overlapping data is ignored.
+    store.write_delta("r1", "output", delta(5, b", world!\n"))
+    assert store.get_output("r1", "output").data == b"hello, world!\n"
+
+    data = b"hello, world!\n"
+    store.write_through(
+        "r1", "output", Output(OutputMetadata("output", len(data)), data))
+    assert store.get_stats()["num_cached"] == 0
+    assert store.get_output("r1", "output").data == data
+
+
+@pytest.mark.asyncio
+async def test_output_store_spill(tmp_path):
+    path = tmp_path / "apsis.db"
+    spill_dir = tmp_path / "spill"
+    spill_dir.mkdir()
+
+    SqliteDB.create(path=path)
+    store = OutputStore(
+        SqliteDB.open(path).output_db,
+        run_max=4096, total_max=5000, spill_dir=spill_dir,
+    )
+
+    def write(run_id, start, data):
+        metadata = OutputMetadata("output", start + len(data))
+        store.write_delta(run_id, "output", OutputDelta(metadata, start, data))
+
+    write("r1", 0, 2048 * b"a")
+    write("r2", 0, 2048 * b"b")
+    stats = store.get_stats()
+    assert stats["resident_bytes"] == 4096
+    assert stats["spilled_bytes"] == 0
+
+    # Exceeds the per-run budget.
+    write("r1", 2048, 4096 * b"c")
+    stats = store.get_stats()
+    assert stats["num_spilled"] == 1
+    assert stats["resident_bytes"] == 2048
+    assert stats["spilled_bytes"] == 6144
+    assert store.get_output("r1", "output").data == 2048 * b"a" + 4096 * b"c"
+    delta = store.get_output_range("r1", "output", 2000, 2100)
+    assert delta.start == 2000
+    assert delta.data == 48 * b"a" + 52 * b"c"
+
+    # Appending to a spilled output.
+    write("r1", 6144, b"done\n")
+    assert store.get_output("r1", "output").data.endswith(b"ccdone\n")
+
+    # A spilled output is mapped from its file; others aren't.
+    metadata, data = store.map_output("r1", "output")
+    with data:
+        assert metadata.length == 6149
+        assert data[:] == 2048 * b"a" + 4096 * b"c" + b"done\n"
+    assert store.map_output("r2", "output") is None
+    assert store.map_output("r9", "output") is None
+
+    # Exceeds the total budget.
+    write("r3", 0, 3072 * b"d")
+    stats = store.get_stats()
+    assert stats["num_spilled"] == 2
+    assert stats["resident_bytes"] == 2048
+    write("r3", 3072, 1024 * b"e")
+    assert store.get_output_range("r3", "output", 3070).data == (
+        2 * b"d" + 1024 * b"e")
+
+    # Commit streams into the DB, compressed.
+    await store.commit("r1", min_size=4096)
+    await store.commit("r2", min_size=4096)
+    stats = store.get_stats()
+    assert stats["num_cached"] == 1
+    assert stats["resident_bytes"] == 0
+    output = store.get_output("r1", "output")
+    assert output.compression == "br"
+    assert output.metadata.length == 6149
+    assert output.get_uncompressed_data() == (
+        2048 * b"a" + 4096 * b"c" + b"done\n")
+    # Short output isn't compressed.
+    output = store.get_output("r2", "output")
+    assert output.compression is None
+    assert output.data == 2048 * b"b"
+
+    # The mapping outlives the output.
+    metadata, data = store.map_output("r3", "output")
+    store.discard("r3")
+    assert store.get_stats()["num_cached"] == 0
+    with data:
+        assert data[-3 :] == 3 * b"e"
+
+
+def test_blob(tmp_path):
+    path = tmp_path / "apsis.db"
+    blobs = BlobStore(tmp_path / "apsis.db.blobs")
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path, blobs=blobs, blob_min_size=1024).output_db
+
+    small = b"hello, world\n"
+    large = bytes(range(256)) * 64
+    metadata = OutputMetadata("output", len(large))
+    db.upsert("r1", "output", Output(OutputMetadata("output", 13), small))
+    db.upsert("r2", "output", Output(metadata, large))
+    with io.BytesIO(large) as file:
+        db.upsert_file("r3", "output", metadata, file, len(large))
+
+    # The small output is in the DB.
+    assert db.get_output_blob("r1", "output") is None
+    assert db.get_output("r1", "output").data == small
+    # The large outputs share a blob.
+    _, compression, path2 = db.get_output_blob("r2", "output")
+    assert compression is None
+    _, _, path3 = db.get_output_blob("r3", "output")
+    assert path3 == path2
+    assert path2.read_bytes() == large
+    assert db.get_output("r3", "output").data == large
+    assert blobs.get_stats()["num_dup"] == 1
+
+    # A compressed output with the same data shares the blob, and takes on its
+    # compression.
+    data = gzip.compress(large, compresslevel=0)
+    db.upsert("r4", "output", Output(metadata, data, "gzip"))
+    _, compression, path4 = db.get_output_blob("r4", "output")
+    assert compression is None
+    assert path4 == path2
+    assert db.get_output("r4", "output").data == large
+    assert blobs.get_stats()["num_dup"] == 2
+
+    # Replacing with a small output moves it back into the DB.
+    db.upsert("r2", "output", Output(OutputMetadata("output", 13), small))
+    assert db.get_output_blob("r2", "output") is None
+    assert db.get_output("r2", "output").data == small
+
+    assert db.get_blob_digests(path) == {path2.name}
+
+
+def test_output_range(tmp_path):
+    path = tmp_path / "apsis.db"
+    blobs = BlobStore(tmp_path / "apsis.db.blobs")
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path, blobs=blobs, blob_min_size=4096).output_db
+
+    data = bytes(range(256)) * 64
+    metadata = OutputMetadata("output", len(data))
+    db.upsert(
+        "r1", "output", Output(OutputMetadata("output", 1000), data[: 1000]))
+    db.upsert("r2", "output", Output(metadata, data))
+    db.upsert("r3", "output", Output(metadata, brotli.compress(data), "br"))
+
+    delta = db.get_output_range("r1", "output", 100, 200)
+    assert delta.start == 100
+    assert delta.data == data[100 : 200]
+    assert db.get_output_range("r1", "output", 900).data == data[900 : 1000]
+    assert db.get_output_range("r1", "output", 2000).data == b""
+
+    for run_id in ("r2", "r3"):
+        delta = db.get_output_range(run_id, "output", 10000, 10100)
+        assert delta.metadata.length == len(data)
+        assert delta.data == data[10000 : 10100]
+        assert db.get_output_range(run_id, "output").data == data
+
+    with pytest.raises(LookupError):
+        db.get_output_range("r4", "output")
+
+    # The store reads ranges through to the database.
+    store = OutputStore(db)
+    assert store.get_output_range("r1", "output", 10, 20).data == data[10 : 20]
+
+
+@pytest.mark.parametrize("blob_min_size", [None, 1024])
+def test_output_range_chunked(tmp_path, blob_min_size):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    blobs = None if blob_min_size is None else BlobStore(tmp_path / "blobs")
+    db = SqliteDB.open(path, blobs=blobs, blob_min_size=blob_min_size).output_db
+
+    data = bytes(range(256)) * 12288 + b"The end.\n"
+    compressed = b"".join(compress_frames([data]))
+    metadata = OutputMetadata("output", len(data))
+    db.upsert("r1", "output", Output(metadata, compressed, BR_CHUNKED))
+
+    delta = db.get_output_range("r1", "output", len(data) - 9)
+    assert delta.data == b"The end.\n"
+    delta = db.get_output_range("r1", "output", 1048570, 1048580)
+    assert delta.data == data[1048570 : 1048580]
+    assert db.get_output("r1", "output").get_uncompressed_data() == data
+
+
+def test_line_index():
+    data = b"".join( b"x" * (i % 7) + b"\n" for i in range(1000) ) + b"partial"
+    starts = [0] + [ i + 1 for i, c in enumerate(data) if c == ord("\n") ]
+
+    for size in (1, 10, 333, len(data)):
+        index = LineIndex(interval=16)
+        for i in range(0, len(data), size):
+            index.append(data[i : i + size])
+        assert index.num_lines == 1001
+        assert index.offsets == starts[:: 16]
+
+        index = LineIndex.from_bytes(index.to_bytes())
+        assert index.num_lines == 1001
+        assert index.length == len(data)
+        first, byte_start, byte_stop = index.get_byte_range(100, 120)
+        assert first <= 100
+        assert byte_start == starts[first]
+        assert byte_stop >= starts[120]
+
+
+@pytest.mark.asyncio
+async def test_output_lines(tmp_path):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path).output_db
+    store = OutputStore(db)
+
+    data = b"".join( f"line {i}\n".encode() for i in range(10000) )
+    for i in range(0, len(data), 1000):
+        chunk = data[i : i + 1000]
+        metadata = OutputMetadata("output", i + len(chunk))
+        store.write_delta("r1", "output", OutputDelta(metadata, i, chunk))
+
+    lines = store.get_output_lines("r1", "output", tail=2)
+    assert (lines.start, lines.stop, lines.num_lines) == (9998, 10000, 10000)
+    assert lines.data == b"line 9998\nline 9999\n"
+
+    # The line index is stored with the output.
+    await store.commit("r1")
+    assert db.get_line_index("r1", "output") is not None
+    lines = store.get_output_lines("r1", "output", 2047, 2049)
+    assert lines.data == b"line 2047\nline 2048\n"
+
+    # An output stored without a line index.
+    db.upsert("r2", "output", Output(
+        OutputMetadata("output", len(data)), brotli.compress(data), "br"))
+    assert db.get_line_index("r2", "output") is None
+    lines = store.get_output_lines("r2", "output", 5000, 5001)
+    assert lines.data == b"line 5000\n"
+    assert db.get_line_index("r2", "output") is not None
+
+    with pytest.raises(LookupError):
+        store.get_output_lines("r3", "output")
+
+
+@pytest.mark.parametrize("final", [b"", b"last"])
+def test_output_lines_end(tmp_path, final):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    store = OutputStore(SqliteDB.open(path).output_db)
+    # A multiple of the index interval.
+    data = b"x\n" * LineIndex.INTERVAL + final
+    num_lines = LineIndex.INTERVAL + (len(final) > 0)
+    store.write("r1", "output", Output(
+        OutputMetadata("output", len(data)), data))
+
+    lines = store.get_output_lines("r1", "output", tail=0)
+    assert (lines.start, lines.stop, lines.data) == (num_lines, num_lines, b"")
+    for start in (LineIndex.INTERVAL, num_lines, 5000):
+        lines = store.get_output_lines("r1", "output", start)
+        assert lines.num_lines == num_lines
+        assert lines.data == (final if start == LineIndex.INTERVAL else b"")
+
+    index = LineIndex()
+    index.append(data)
+    assert index.get_byte_range(5000, 5001) == (5000, len(data), len(data))
+
+
+def test_output_search(tmp_path):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path, search=True)
+    search_db = db.output_search_db
+    t0 = ora.now()
+
+    for run_id, job_id, timestamp, data in [
+            ("r1", "job0", t0 - 3600, b"hello world\nall is well\n"),
+            ("r2", "job1", t0, b"starting\n" * 20000 + b"error: disk full\n"),
+    ]:
+        run = Run(Instance(job_id, {}))
+        run.run_id = run_id
+        run.timestamp = timestamp
+        db.run_db.upsert(run)
+        output = Output(OutputMetadata("output", len(data)), data)
+        db.output_db.upsert(run_id, "output", output)
+
+    con = search_db.connect()
+    assert search_db.index_output(con, "r1", "output") == 24
+    assert search_db.index_output(con, "r2", "output") == 180017
+    # Reindexing replaces the previous index.
+    search_db.index_output(con, "r1", "output")
+
+    matches = search_db.search("well")
+    assert [ m["run_id"] for m in matches ] == ["r1"]
+    assert matches[0]["job_id"] == "job0"
+    assert "well" in matches[0]["snippet"]
+
+    # The match is located in a chunk after the first.
+    matches = search_db.search('"disk full"')
+    assert [ m["run_id"] for m in matches ] == ["r2"]
+    assert matches[0]["offset"] > 0
+    assert "disk full" in matches[0]["snippet"]
+
+    assert len(search_db.search("hello OR error")) == 2
+    assert len(search_db.search("hello OR error", job_id="job1")) == 1
+    assert len(search_db.search("hello OR error", since=t0 - 60)) == 1
+    assert search_db.search("missing") == []
+    with pytest.raises(ValueError):
+        search_db.search("AND (")
+
+    # Archiving removes runs from the index.
+    db.archive(tmp_path / "archive.db", ["r1"])
+    assert [ m["run_id"] for m in search_db.search("hello OR error") ] == ["r2"]
+
+
+def test_output_search_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(OutputSearchDB, "CHUNK_SIZE", 64)
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path, search=True)
+    search_db = db.output_search_db
+
+    for run_id, data in [
+            # A match across the chunk size, in a line.
+            ("r1", b"starting\n" * 7 + b"error: disk full\n" * 4),
+            # A match across the chunk size, in a long line.
+            ("r2", b"word " * 12 + b"needle " + b"word " * 20),
+            # A character across the chunk size, in a long word.
+            ("r3", b"x" * 63 + "\u00e9t\u00e9".encode() + b"y" * 10),
+    ]:
+        run = Run(Instance("job", {}))
+        run.run_id = run_id
+        run.timestamp = ora.now()
+        db.run_db.upsert(run)
+        output = Output(OutputMetadata("output", len(data)), data)
+        db.output_db.upsert(run_id, "output", output)
+        con = search_db.connect()
+        assert search_db.index_output(con, run_id, "output") == len(data)
+
+    # Chunks split after lines.
+    matches = search_db.search('"disk full"')
+    assert [ (m["run_id"], m["offset"]) for m in matches ] == [
+        ("r1", 63), ("r1", 114)]
+    assert all( "disk full" in m["snippet"] for m in matches )
+
+    # Chunks split after words.
+    matches = search_db.search("needle")
+    assert [ (m["run_id"], m["offset"]) for m in matches ] == [("r2", 60)]
+
+    # Chunks split after characters.
+    texts = [ t for t, in con.execute(
+        "SELECT text FROM output_fts WHERE run_id = 'r3' ORDER BY rowid") ]
+    assert texts == ["x" * 63, "\u00e9t\u00e9" + "y" * 10]
+
+
+def test_total_length(tmp_path):
+    path = tmp_path / "apsis.db"
+    SqliteDB.create(path=path)
+    db = SqliteDB.open(path).output_db
+
+    data = b"head\n[apsis: 1000 bytes of output omitted]\ntail\n"
+    metadata = OutputMetadata("output", len(data), total_length=1010)
+    db.upsert("r1", "output", Output(metadata, data))
+    db.upsert("r1", "other", Output(OutputMetadata("other", 3), b"abc"))
+
+    meta = db.get_metadata("r1")
+    assert meta["output"].length == len(data)
+    assert meta["output"].total_length == 1010
+    assert meta["other"].total_length is None
+    output = db.get_output("r1", "output")
+    assert output.data == data
+    assert output.metadata.total_length == 1010
+    assert output.metadata.to_jso()["total_length"] == 1010
+    assert "total_length" not in meta["other"].to_jso()
+
+    # Replacing the output with an untruncated one clears the total length.
+    db.upsert("r1", "output", Output(OutputMetadata("output", 3), b"xyz"))
+    assert db.get_metadata("r1")["output"].total_length is None
+
+
@@ -0,0 +1,73 @@
+import pytest
+
+from   apsis.program import OutputRetention, RetainedOutput
+
+#-------------------------------------------------------------------------------
+
+DATA = bytes(range(256)) * 64
+
+def retain(retention, chunk_size):
+    retained = RetainedOutput(retention)
+    for i in range(0, len(DATA), chunk_size):
+        retained.append(DATA[i : i + chunk_size])
+    return retained
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1000, 100000])
+def test_retained_output(chunk_size):
+    def marker(n):
+        return f"\n[apsis: {n} bytes of output omitted]\n".encode()
+
+    retained = retain(OutputRetention(1000, "head"), chunk_size)
+    assert retained.length == len(DATA)
+    assert retained.total_length == len(DATA)
+    assert retained.get() == DATA[: 1000] + marker(len(DATA) - 1000)
+
+    retained = retain(OutputRetention(1000, "tail"), chunk_size)
+    assert retained.total_length == len(DATA)
+    assert retained.get() == marker(len(DATA) - 1000) + DATA[-1000 :]
+
+    retained = retain(OutputRetention(1001, "head+tail"), chunk_size)
+    assert retained.total_length == len(DATA)
+    assert retained.get() == (
+        DATA[: 500] + marker(len(DATA) - 1001) + DATA[-501 :])
+
+    retained = retain(OutputRetention(len(DATA)), chunk_size)
+    assert retained.total_length is None
+    assert retained.get() == DATA
+
+
+def test_retained_output_start():
+    retained = RetainedOutput(OutputRetention(100))
+    retained.append(DATA[: 30])
+    # Overlapping data is skipped.
+    retained.append(DATA[20 : 80], start=20)
+    # Skip to the tail.
+    retained.append(DATA[-50 :], start=len(DATA) - 50)
+    assert retained.total_length == len(DATA)
+    assert retained.get() == (
+        DATA[: 50]
+        + f"\n[apsis: {len(DATA) - 100} bytes of output omitted]\n".encode()
+        + DATA[-50 :]
+    )
+
+    # Can't skip part of the head.
+    retained = RetainedOutput(OutputRetention(100))
+    with pytest.raises(RuntimeError):
+        retained.append(DATA[-50 :], start=len(DATA) - 50)
+
+
+def test_output_retention_jso():
+    retention = OutputRetention.from_jso({"max_bytes": "16 MB", "keep": "tail"})
+    assert retention.max_bytes == 16 * 1024 * 1024
+    assert retention.head_size == 0
+    assert retention.tail_size == 16 * 1024 * 1024
+    assert OutputRetention.from_jso(retention.to_jso()) == retention
+
+    assert OutputRetention.from_jso({"max_bytes": 1000}).keep == "head+tail"
+    with pytest.raises(ValueError):
+        OutputRetention.from_jso({"max_bytes": 1000, "keep": "middle"})
+    with pytest.raises(ValueError):
+        OutputRetention.from_jso({"max_bytes": 0})
+
+
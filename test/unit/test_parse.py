@@ -61,3 +61,21 @@ def test_parse_duration():
     assert p("-10 d") == -864000
 
 
+def test_parse_size():
+    from apsis.lib.parse import parse_size as p
+
+    assert p(0) == 0
+    assert p("1024") == 1024
+    assert p("16 B") == 16
+    assert p("2 KB") == 2048
+    assert p("1.5MiB") == 1536 * 1024
+    assert p("1 GB") == 1024 ** 3
+
+    with pytest.raises(ValueError):
+        p("")
+    with pytest.raises(ValueError):
+        p("10 parsecs")
+    with pytest.raises(ValueError):
+        p(None)
+
+
@@ -1,10 +1,34 @@
+import asyncio
+import os
 import pytest
 from   signal import Signals
 
-from   apsis.program import Program, ProgramSuccess
+from   apsis.program import (
+    Program, ProgramError, ProgramFailure, ProgramRunning, ProgramSuccess)
+from   apsis.program.base import ProgramUpdate
+from   apsis.program.process import OUTPUT_CHUNK_SIZE
 
 #-------------------------------------------------------------------------------
 
+async def _run(running):
+    """
+    Runs `running` to completion.
+
+    :return:
+      The last update, and the complete output.
+    """
+    data = b""
+    async for update in running.updates:
+        if isinstance(update, ProgramUpdate):
+            delta = update.output_deltas["output"]
+            assert delta.start == len(data)
+            data += delta.data
+    output = update.outputs.get("output")
+    if output is not None:
+        data += output.data
+    return update, data
+
+
 @pytest.mark.asyncio
 async def test_process_program():
     program = Program.from_jso({
@@ -14,13 +38,11 @@ async def test_process_program():
     program = program.bind({"name": "world"})
 
     running = program.run("testrun", cfg={})
-    async for update in running.updates:
-        pass
+    update, output = await _run(running)
 
     assert isinstance(update, ProgramSuccess)
     assert update.meta["return_code"] == 0
-    output = update.outputs["output"]
-    assert output.data == b"Hello, world!\n"
+    assert output == b"Hello, world!\n"
 
 
 @pytest.mark.asyncio
@@ -32,13 +54,11 @@ async def test_shell_command_program():
     program = program.bind({"name": "world"})
 
     running = program.run("testrun", cfg={})
-    async for update in running.updates:
-        pass
+    update, output = await _run(running)
 
     assert isinstance(update, ProgramSuccess)
     assert update.meta["return_code"] == 0
-    output = update.outputs["output"]
-    assert output.data == b"Hello, world!\n"
+    assert output == b"Hello, world!\n"
 
 
 def test_process_program_jso():
@@ -83,3 +103,227 @@ def test_shell_command_program_jso():
     assert program.stop.grace_period == 30
 
 
+@pytest.mark.parametrize(
+    "keep,head,tail",
+    [("head", 1000, 0), ("tail", 0, 1000), ("head+tail", 500, 500)]
+)
+@pytest.mark.asyncio
+async def test_output_retention(keep, head, tail):
+    program = Program.from_jso({
+        "type": "apsis.program.process.ShellCommandProgram",
+        "command": "seq 100000",
+        "output": {"max_bytes": 1000, "keep": keep},
+    })
+    program = Program.from_jso(program.to_jso()).bind({})
+    assert program.retention.keep == keep
+
+    running = program.run("testrun", cfg={})
+    async for update in running.updates:
+        pass
+
+    assert isinstance(update, ProgramSuccess)
+    full = "".join( f"{i}\n" for i in range(1, 100001) ).encode()
+    output = update.outputs["output"]
+    assert output.metadata.total_length == len(full)
+    assert output.metadata.length == len(output.data)
+    marker = f"\n[apsis: {len(full) - 1000} bytes of output omitted]\n"
+    assert output.data == (
+        full[: head] + marker.encode() + full[len(full) - tail :])
+
+
+@pytest.mark.parametrize(
+    "keep,head",
+    [("head", 1000), ("tail", 0), ("head+tail", 500)]
+)
+@pytest.mark.asyncio
+async def test_output_retention_interval(keep, head):
+    program = Program.from_jso({
+        "type": "apsis.program.process.ShellCommandProgram",
+        "command": "seq 1000; sleep 0.5; seq 1000",
+        "output": {"max_bytes": 1000, "keep": keep},
+    }).bind({})
+
+    cfg = {"process": {"run": {"output_interval": 0.1}}}
+    running = program.run("testrun", cfg=cfg)
+    data = b""
+    async for update in running.updates:
+        if isinstance(update, ProgramUpdate):
+            delta = update.output_deltas["output"]
+            assert delta.start == len(data)
+            data += delta.data
+
+    # Only the head is published while running, which the retained output
+    # keeps.
+    assert isinstance(update, ProgramSuccess)
+    assert len(data) == head
+    assert update.outputs["output"].data[: head] == data
+
+
+@pytest.mark.asyncio
+async def test_output_retention_short():
+    program = Program.from_jso({
+        "type": "apsis.program.process.ShellCommandProgram",
+        "command": "seq 10",
+        "output": {"max_bytes": "1 KiB"},
+    }).bind({})
+    assert program.retention.max_bytes == 1024
+
+    running = program.run("testrun", cfg={})
+    async for update in running.updates:
+        pass
+
+    output = update.outputs["output"]
+    assert output.data == b"1\n2\n3\n4\n5\n6\n7\n8\n9\n10\n"
+    assert output.metadata.total_length is None
+
+
+@pytest.mark.asyncio
+async def test_process_program_error():
+    program = Program.from_jso({
+        "type": "apsis.program.process.ProcessProgram",
+        "argv": ["/nonexistent/program"],
+    }).bind({})
+
+    running = program.run("testrun", cfg={})
+    with pytest.raises(ProgramError):
+        async for update in running.updates:
+            pass
+
+
+@pytest.mark.asyncio
+async def test_output_interval():
+    program = Program.from_jso({
+        "type": "apsis.program.process.ShellCommandProgram",
+        "command": "echo hello; sleep 0.5; echo world",
+    }).bind({})
+
+    cfg = {"process": {"run": {"output_interval": 0.1}}}
+    running = program.run("testrun", cfg=cfg)
+    data = b""
+    async for update in running.updates:
+        if isinstance(update, ProgramUpdate):
+            delta = update.output_deltas["output"]
+            assert delta.start == len(data)
+            data += delta.data
+            if data == b"hello\n":
+                # Published while running.
+                assert running.run_state is not None
+
+    assert isinstance(update, ProgramSuccess)
+    assert data == b"hello\nworld\n"
+    assert update.outputs == {}
+
+
+@pytest.mark.asyncio
+async def test_reconnect():
+    program = Program.from_jso({
+        "type": "apsis.program.process.ShellCommandProgram",
+        "command": "sleep 0.5; echo done; exit 3",
+    }).bind({})
+
+    running = program.run("testrun", cfg={})
+    updates = running.updates
+    update = await anext(updates)
+    assert isinstance(update, ProgramRunning)
+    run_state = update.run_state
+    pid = run_state["pid"]
+    # Abandon the running program, as if Apsis shut down.
+    await updates.aclose()
+
+    # Reconnect from the run state.
+    program = Program.from_jso(program.to_jso())
+    running = program.connect("testrun", run_state, cfg={})
+    update, output = await _run(running)
+
+    assert isinstance(update, ProgramFailure)
+    assert update.meta["return_code"] == 3
+    assert output == b"done\n"
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+
+@pytest.mark.asyncio
+async def test_stop():
+    program = Program.from_jso({
+        "type": "apsis.program.process.ProcessProgram",
+        "argv": ["/bin/sleep", "10"],
+        "stop": {"signal": "SIGUSR1"},
+    }).bind({})
+
+    running = program.run("testrun", cfg={})
+    updates = running.updates
+    assert isinstance(await anext(updates), ProgramRunning)
+    stop = asyncio.ensure_future(running.stop())
+    async for update in updates:
+        pass
+    stop.cancel()
+
+    assert isinstance(update, ProgramFailure)
+    assert update.meta["return_code"] == -Signals.SIGUSR1
+
+
+@pytest.mark.asyncio
+async def test_large_output():
+    program = Program.from_jso({
+        "type": "apsis.program.process.ShellCommandProgram",
+        "command": "seq 100000",
+    }).bind({})
+
+    running = program.run("testrun", cfg={})
+    num_updates = 0
+    data = b""
+    async for update in running.updates:
+        if isinstance(update, ProgramUpdate):
+            num_updates += 1
+            data += update.output_deltas["output"].data
+
+    # Published as several deltas, not all at once.
+    assert num_updates > 1
+    assert isinstance(update, ProgramSuccess)
+    assert data == "".join( f"{i}\n" for i in range(1, 100001) ).encode()
+
+
+@pytest.mark.asyncio
+async def test_files_removed():
+    """
+    Tests that output and status files are removed once the program
+    terminates, even if we stop reading its updates.
+    """
+    program = Program.from_jso({
+        "type": "apsis.program.process.ShellCommandProgram",
+        "command": "seq 1000000",
+    }).bind({})
+
+    running = program.run("testrun", cfg={})
+    updates = running.updates
+    update = await anext(updates)
+    assert isinstance(update, ProgramRunning)
+    paths = [ update.run_state[k] for k in ("output_path", "status_path") ]
+    # The program has terminated once we receive output.
+    assert isinstance(await anext(updates), ProgramUpdate)
+    assert os.path.exists(paths[0])
+    await updates.aclose()
+    assert not any( os.path.exists(p) for p in paths )
+
+
+@pytest.mark.asyncio
+async def test_output_interval_chunks():
+    program = Program.from_jso({
+        "type": "apsis.program.process.ShellCommandProgram",
+        "command": "seq 1000000; sleep 0.5",
+    }).bind({})
+
+    cfg = {"process": {"run": {"output_interval": 0.2}}}
+    running = program.run("testrun", cfg=cfg)
+    data = b""
+    async for update in running.updates:
+        if isinstance(update, ProgramUpdate):
+            delta = update.output_deltas["output"]
+            # Read a chunk at a time.
+            assert len(delta.data) <= OUTPUT_CHUNK_SIZE
+            data += delta.data
+
+    assert isinstance(update, ProgramSuccess)
+    assert data == "".join( f"{i}\n" for i in range(1, 1000001) ).encode()
+
+
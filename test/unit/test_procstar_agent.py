@@ -1,56 +1,42 @@
 import pytest
 
-from   apsis.program.procstar.agent import _combine_fd_data
+from   apsis.program.procstar.agent import _get_new_fd_data, _make_output_deltas
 from   procstar.agent.proc import FdData, Interval
 
 #-------------------------------------------------------------------------------
 
-FD = "output"
-ENC = "utf-8"
-
-def test_combine_fd_data_normal():
-    data = _combine_fd_data(
-        FdData(FD, Interval(   0, 2048), ENC, 2048 * b"x"),
-        FdData(FD, Interval(2048, 3072), ENC, 1024 * b"y")
-    )
-    assert data.interval.start == 0
-    assert data.interval.stop == 3072
-    assert data.data == 2048 * b"x" + 1024 * b"y"
-
-
-def test_combine_fd_data_dup():
-    data = _combine_fd_data(
-        FdData(FD, Interval(0, 2048), ENC, 2048 * b"x"),
-        FdData(FD, Interval(0, 2048), ENC, 2048 * b"x")
-    )
-    assert data.interval.start == 0
-    assert data.interval.stop == 2048
-    assert data.data == 2048 * b"x"
-
-
-def test_combine_fd_data_overlap():
-    data = _combine_fd_data(
-        FdData(FD, Interval(   0, 2048), ENC, 2048 * b"x"),
-        FdData(FD, Interval(   0, 3072), ENC, 3072 * b"y")
-    )
-    assert data.interval.start == 0
-    assert data.interval.stop == 3072
-    assert data.data == 2048 * b"x" + 1024 * b"y"
-
-    data = _combine_fd_data(
-        FdData(FD, Interval(   0, 2048), ENC, 2048 * b"x"),
-        FdData(FD, Interval(1024, 3072), ENC, 2048 * b"x")
-    )
-    assert data.interval.start == 0
-    assert data.interval.stop == 3072
-    assert data.data == 3072 * b"x"
-
-
-def test_combine_fd_data_gap():
+FD = "stdout"
+ENC = None
+
+def test_get_new_fd_data_normal():
+    data = _get_new_fd_data(0, FdData(FD, Interval(0, 2048), ENC, 2048 * b"x"))
+    assert data == 2048 * b"x"
+    data = _get_new_fd_data(2048, FdData(FD, Interval(2048, 3072), ENC, 1024 * b"y"))
+    assert data == 1024 * b"y"
+
+    delta = _make_output_deltas(2048, data)["output"]
+    assert delta.start == 2048
+    assert delta.stop == 3072
+    assert delta.metadata.length == 3072
+    assert delta.data == 1024 * b"y"
+
+
+def test_get_new_fd_data_dup():
+    data = _get_new_fd_data(2048, FdData(FD, Interval(0, 2048), ENC, 2048 * b"x"))
+    assert data == b""
+
+
+def test_get_new_fd_data_overlap():
+    data = _get_new_fd_data(2048, FdData(FD, Interval(0, 3072), ENC, 3072 * b"y"))
+    assert data == 1024 * b"y"
+
+    data = _get_new_fd_data(
+        2048, FdData(FD, Interval(1024, 3072), ENC, 1024 * b"x" + 1024 * b"z"))
+    assert data == 1024 * b"z"
+
+
+def test_get_new_fd_data_gap():
     with pytest.raises(RuntimeError):
-        _combine_fd_data(
-            FdData(FD, Interval(   0, 2048), ENC, 2048 * b"x"),
-            FdData(FD, Interval(3072, 4096), ENC, 1024 * b"y")
-        )
+        _get_new_fd_data(2048, FdData(FD, Interval(3072, 4096), ENC, 1024 * b"y"))
 
 
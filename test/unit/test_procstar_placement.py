@@ -0,0 +1,70 @@
+from   types import SimpleNamespace
+import pytest
+
+from   apsis.procstar import Placement
+
+#-------------------------------------------------------------------------------
+
+def _conn(conn_id, hostname=None):
+    return SimpleNamespace(
+        conn_id =conn_id,
+        info    =SimpleNamespace(proc=SimpleNamespace(hostname=hostname)),
+    )
+
+
+JOBS = {"r1": "a", "r2": "a", "r3": "b", "r4": "a"}
+
+def test_index():
+    placement = Placement("least-runs", get_job_id=JOBS.__getitem__)
+    placement.add("c0", "r1")
+    placement.add("c0", "r2")
+    placement.add("c0", "r2")
+    placement.add("c1", "r3")
+    assert placement.get_num_runs("c0") == 2
+    assert placement.get_num_runs("c1") == 1
+    assert placement.get_num_runs("c2") == 0
+
+    placement.remove("c0", "r1")
+    placement.remove("c0", "r1")
+    placement.remove("c1", "r3")
+    assert placement.get_num_runs("c0") == 1
+    assert placement.get_num_runs("c1") == 0
+
+
+def test_least_runs():
+    conns = [_conn("c0"), _conn("c1"), _conn("c2")]
+    placement = Placement("least-runs")
+    for i in range(9):
+        placement.add(placement.choose(conns, f"r{i}").conn_id, f"r{i}")
+    assert [ placement.get_num_runs(c.conn_id) for c in conns ] == [3, 3, 3]
+
+
+def test_weighted():
+    conns = [_conn("c0", "big"), _conn("c1", "small"), _conn("c2")]
+    placement = Placement("weighted", capacities={"big": 4, "c2": 2})
+    for i in range(14):
+        placement.add(placement.choose(conns, f"r{i}").conn_id, f"r{i}")
+    assert [ placement.get_num_runs(c.conn_id) for c in conns ] == [8, 2, 4]
+
+
+def test_spread_by_job():
+    conns = [_conn("c0"), _conn("c1")]
+    placement = Placement("spread-by-job", get_job_id=JOBS.__getitem__)
+    placement.add("c0", "r1")
+    placement.add("c0", "r3")
+    # Fewest runs of job a, despite more runs overall.
+    placement.add("c1", "r9")
+    placement.add("c1", "r8")
+    assert placement.choose(conns, "r2").conn_id == "c1"
+    placement.add("c1", "r2")
+    # Tied on job a; fewer runs overall.
+    placement.remove("c1", "r9")
+    placement.remove("c1", "r8")
+    assert placement.choose(conns, "r4").conn_id == "c1"
+
+
+def test_bad_policy():
+    with pytest.raises(ValueError):
+        Placement("most-runs")
+
+
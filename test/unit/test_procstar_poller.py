@@ -0,0 +1,61 @@
+import asyncio
+import pytest
+
+from   apsis.procstar import Poller
+
+#-------------------------------------------------------------------------------
+
+class FakeProc:
+
+    def __init__(self, conn_id, proc_id):
+        self.conn_id = conn_id
+        self.proc_id = proc_id
+        self.num_results = 0
+        self.fd_intervals = []
+
+
+    async def request_result(self):
+        self.num_results += 1
+
+
+    async def request_fd_data(self, fd, *, interval):
+        assert fd == "stdout"
+        self.fd_intervals.append(interval)
+
+
+
+@pytest.mark.asyncio
+async def test_poller():
+    poller = Poller(jitter=0)
+    procs = [ FakeProc(f"c{i % 2}", f"p{i}") for i in range(6) ]
+    for proc in procs:
+        poller.add(
+            proc,
+            update_interval =0.1,
+            output_interval =0.1,
+            # Skip output for odd procs.
+            get_output      =lambda p=proc: (
+                None if int(p.proc_id[1 :]) % 2 else (0, None)),
+        )
+    assert poller.get_stats()["num_conns"] == 2
+    assert poller.get_stats()["num_procs"] == 6
+
+    await asyncio.sleep(0.55)
+    for proc in procs:
+        poller.remove(proc.conn_id, proc.proc_id)
+    stats = poller.get_stats()
+    assert stats["num_conns"] == stats["num_procs"] == 0
+
+    for i, proc in enumerate(procs):
+        assert 4 <= proc.num_results <= 6
+        assert len(proc.fd_intervals) == (0 if i % 2 else proc.num_results)
+    # One tick per conn per interval, for all procs on the conn, plus the
+    # initial offset.
+    assert stats["num_ticks"] <= 12
+    assert stats["num_skipped"] == sum( p.num_results for p in procs[1 :: 2] )
+
+    # No more polls.
+    await asyncio.sleep(0.2)
+    assert poller.get_stats()["num_ticks"] == stats["num_ticks"]
+
+
@@ -55,3 +55,23 @@ def test_shell_command_program_jso():
     assert program.stop.grace_period == 60
 
 
+
+
+def test_output_retention_jso():
+    program = Program.from_jso({
+        "type"      : "apsis.program.procstar.agent.ProcstarShellProgram",
+        "command"   : "seq 1000000",
+        "output"    : {"max_bytes": "1 MB", "keep": "tail"},
+    })
+
+    program = Program.from_jso(program.to_jso())
+    assert program.retention.max_bytes == 1024 * 1024
+    assert program.retention.keep == "tail"
+
+    program = Program.from_jso(program.bind({}).to_jso())
+    assert program.retention.max_bytes == 1024 * 1024
+    assert program.retention.keep == "tail"
+    assert program.to_jso()["output"] == {
+        "max_bytes": 1024 * 1024, "keep": "tail"}
+
+
@@ -1,4 +1,10 @@
-from   apsis.runs import Instance
+import ora
+import pytest
+import time
+
+from   apsis.jobs import Job, InMemoryJobs
+import apsis.runs
+from   apsis.runs import Instance, Run, bind, template_expand
 
 #-------------------------------------------------------------------------------
 
@@ -8,3 +14,94 @@ def test_instance_args_sort():
     assert tuple(i.args.values()) == ("17", "0", "42")
 
 
+def test_template_expand():
+    args = {"date": "2024-03-01", "label": "foo", "count": 3}
+
+    assert template_expand("echo hello", args) == "echo hello"
+    assert template_expand("echo ${HOME}\n", args) == "echo ${HOME}"
+    assert template_expand("{{ date }}", args) == "2024-03-01"
+    assert template_expand("{{label}}-{{ count }}.txt", args) == "foo-3.txt"
+    assert template_expand("{{ true }}", args) == "True"
+    assert template_expand("{{ label|upper }}", args) == "FOO"
+    assert template_expand("{% if count > 2 %}many{% endif %}", args) == "many"
+
+    with pytest.raises(NameError):
+        template_expand("{{ missing }}", args)
+    with pytest.raises(NameError):
+        template_expand("echo {{ label }} {{ other }}", args)
+    with pytest.raises(SyntaxError):
+        template_expand("{{ label", args)
+
+
+def test_bind_shared():
+    def make_run(job_id, run_id, label):
+        run = Run(Instance(job_id, {"label": label}))
+        run.run_id = run_id
+        return run
+
+    job = Job.from_jso({
+        "params": ["label"],
+        "program": {"type": "shell", "command": "echo {{ label }}"},
+        "condition": [
+            {"type": "max_running", "count": 2},
+            {"type": "skip_duplicate"},
+        ],
+    }, "job0")
+    jobs = InMemoryJobs([job])
+
+    run0 = make_run("job0", "r1", "foo")
+    bind(run0, job, jobs)
+    assert run0.program.argv[-1] == "echo foo"
+    run1 = make_run("job0", "r2", "foo")
+    bind(run1, job, jobs)
+    # The program and max_running cond are shared.
+    assert run1.program is run0.program
+    assert run1.conds[0] is run0.conds[0]
+    # The skip_duplicate cond refers to the run, so isn't.
+    assert run1.conds[1] is not run0.conds[1]
+
+    run2 = make_run("job0", "r3", "bar")
+    bind(run2, job, jobs)
+    assert run2.program.argv[-1] == "echo bar"
+
+    # A program that refers to the run ID isn't shared.
+    job = Job.from_jso({
+        "params": ["label"],
+        "program": {"type": "shell", "command": "echo {{ label }} {{ run_id }}"},
+    }, "job1")
+    run3 = make_run("job1", "r4", "foo")
+    bind(run3, job, jobs)
+    run4 = make_run("job1", "r5", "foo")
+    bind(run4, job, jobs)
+    assert run3.program.argv[-1] == "echo foo r4"
+    assert run4.program.argv[-1] == "echo foo r5"
+
+
+
+
+def test_bind_shared_time(monkeypatch):
+    """
+    Tests that a program whose templates aren't constant isn't shared.
+    """
+    monkeypatch.setitem(apsis.runs.BIND_ARGS, "now", ora.now)
+    job = Job.from_jso({
+        "program": {
+            "type": "shell",
+            "command": "echo {{ now() }} {{ job_id }}",
+        },
+        "condition": [{"type": "max_running", "count": "{{ 1 + 1 }}"}],
+    }, "job2")
+    jobs = InMemoryJobs([job])
+
+    runs = []
+    for run_id in ("r6", "r7"):
+        run = Run(Instance("job2", {}))
+        run.run_id = run_id
+        bind(run, job, jobs)
+        runs.append(run)
+        time.sleep(0.01)
+
+    assert runs[1].program is not runs[0].program
+    assert runs[1].conds[0] is not runs[0].conds[0]
+    assert runs[1].program.argv[-1] != runs[0].program.argv[-1]
+    assert runs[1].program.argv[-1].endswith(" job2")